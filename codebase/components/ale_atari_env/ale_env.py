@@ -8,6 +8,7 @@ import os
 import random
 from collections import deque
 
+import numpy as np
 import torch
 from ale_py import ALEInterface, LoggerMode, roms
 from gym.spaces import Discrete
@@ -74,6 +75,7 @@ class ALEModern:
         difficulty=None,
         minimal_action_set=True,
         record_dir=None,
+        preallocated_buffers=False,
     ):
         # pylint: enable=bad-continuation
         self.game_name = game
@@ -86,6 +88,9 @@ class ALEModern:
         self.max_episode_length = max_episode_length
         self.sdl = sdl
         self.record_dir = record_dir
+        self.preallocated_buffers = preallocated_buffers
+        if self.preallocated_buffers and torch.device(self.device).type != "cpu":
+            raise ValueError("Preallocated buffers are supported only on the cpu device.")
 
         # configure ALE
         self.ale = ALEInterface()
@@ -120,14 +125,20 @@ class ALEModern:
         )
         self.actions = dict([i, e] for i, e in zip(range(len(actions)), actions))
         self.action_space = Discrete(len(self.actions))
+
+        if self.preallocated_buffers:
+            self._allocate_buffers()
         
     def __getstate__(self):
         state = self.__dict__.copy()
         state["ale"] = None
+        state.pop("frame_stack_numpy", None)  # recreated as a view of the (copied) frame stack
         return state
     
     def __setstate__(self, state):
         self.__dict__ = state
+        if getattr(self, "preallocated_buffers", False):
+            self.frame_stack_numpy = self.frame_stack.numpy()
 
         # configure ALE
         self.ale = ALEInterface()
@@ -146,6 +157,18 @@ class ALEModern:
             )
 
         self.ale.loadROM(_get_rom(self.game_name))
+        self._set_mode(getattr(self, "mode", None))
+        self._set_difficulty(getattr(self, "difficulty", None))
+
+    def set_seed(self, seed):
+        """Reseeds the ALE. The seed takes effect only once the ROM is reloaded
+        (which also resets the game, so the mode and difficulty are set again)
+        and it is kept, so that the copies of the environment are seeded by it as well."""
+        self.seed = seed
+        self.ale.setInt("random_seed", self.seed)
+        self.ale.loadROM(_get_rom(self.game_name))
+        self._set_mode(self.mode)
+        self._set_difficulty(self.difficulty)
 
     def _get_state(self):
         state = cv2.resize(
@@ -153,6 +176,60 @@ class ALEModern:
         )
         return torch.tensor(state, dtype=torch.uint8, device=self.device)
 
+    def _allocate_buffers(self):
+        """ Buffers for the zero-allocation path of reset and step (with `preallocated_buffers`).
+
+            The frame stack is kept in a circular buffer, in which each frame is stored twice
+            (at positions `i` and `i + window`), so the last `window` frames always form a contiguous
+            slice of it and the observation can be returned as a view, without any copying.
+        """
+        self.screen_buffer = np.empty(self.ale.getScreenDims(), dtype=np.uint8)
+        self.frame_buffer = np.zeros((2, 84, 84), dtype=np.uint8)
+        self.frame_stack = torch.zeros(2 * self.window, 84, 84, dtype=torch.uint8)
+        self.frame_stack_numpy = self.frame_stack.numpy()  # shares the memory
+        self.frame_stack_position = 0
+
+    def _get_state_into(self, out):
+        self.ale.getScreenGrayscale(self.screen_buffer)
+        cv2.resize(self.screen_buffer, (84, 84), dst=out, interpolation=cv2.INTER_AREA)
+
+    def _push_frame(self, frame=None):
+        """ Push the frame (max pooled from the frame buffer, if not given) into the frame stack
+            and return the observation as a view of the stack, valid only until the next reset or step.
+        """
+        position = self.frame_stack_position
+        if frame is None:
+            np.maximum(self.frame_buffer[0], self.frame_buffer[1], out=self.frame_stack_numpy[position])
+        else:
+            self.frame_stack_numpy[position] = frame
+        self.frame_stack_numpy[position + self.window] = self.frame_stack_numpy[position]
+        self.frame_stack_position = (position + 1) % self.window
+
+        end = self.frame_stack_position + self.window
+        return self.frame_stack[end - self.window : end].unsqueeze(0)
+
+    def _reset_without_allocations(self):
+        self.frame_stack_numpy.fill(0)
+        self.frame_stack_position = 0
+        self.ale.reset_game()
+
+        self._get_state_into(self.frame_buffer[0])
+        return self._push_frame(self.frame_buffer[0])
+
+    def _step_without_allocations(self, action):
+        self.frame_buffer.fill(0)
+        reward, done = 0, False
+        for t in range(4):
+            reward += self.ale.act(self.actions.get(action))
+            if t == 2:
+                self._get_state_into(self.frame_buffer[0])
+            elif t == 3:
+                self._get_state_into(self.frame_buffer[1])
+            done = self.ale.game_over()
+            if done:
+                break
+        return self._push_frame(), reward, done
+
     def _reset_buffer(self):
         for _ in range(self.window):
             self.state_buffer.append(
@@ -161,6 +238,9 @@ class ALEModern:
 
     def reset(self):
         """ Reset the environment, return initial observation. """
+        if self.preallocated_buffers:
+            return self._reset_without_allocations()
+
         # reset internals
         self._reset_buffer()
         self.ale.reset_game()
@@ -178,20 +258,24 @@ class ALEModern:
         Returns:
             tuple: The environment's observation.
         """
-        # repeat action 4 times, max pool over last 2 frames
-        frame_buffer = torch.zeros(2, 84, 84, device=self.device, dtype=torch.uint8)
-        reward, done = 0, False
-        for t in range(4):
-            reward += self.ale.act(self.actions.get(action))
-            if t == 2:
-                frame_buffer[0] = self._get_state()
-            elif t == 3:
-                frame_buffer[1] = self._get_state()
-            done = self.ale.game_over()
-            if done:
-                break
-        observation = frame_buffer.max(0)[0]
-        self.state_buffer.append(observation)
+        if self.preallocated_buffers:
+            # the observation is a view of the frame stack (see _allocate_buffers)
+            state, reward, done = self._step_without_allocations(action)
+        else:
+            # repeat action 4 times, max pool over last 2 frames
+            frame_buffer = torch.zeros(2, 84, 84, device=self.device, dtype=torch.uint8)
+            reward, done = 0, False
+            for t in range(4):
+                reward += self.ale.act(self.actions.get(action))
+                if t == 2:
+                    frame_buffer[0] = self._get_state()
+                elif t == 3:
+                    frame_buffer[1] = self._get_state()
+                done = self.ale.game_over()
+                if done:
+                    break
+            observation = frame_buffer.max(0)[0]
+            self.state_buffer.append(observation)
 
         # clip the reward
         if self.clip_val:
@@ -200,19 +284,22 @@ class ALEModern:
             clipped_reward = reward
 
         # return state, reward, done
-        state = torch.stack(list(self.state_buffer), 0).unsqueeze(0).byte()
+        if not self.preallocated_buffers:
+            state = torch.stack(list(self.state_buffer), 0).unsqueeze(0).byte()
         return state, clipped_reward, done, {"true_reward": reward}
 
     def close(self):
         pass
 
     def _set_mode(self, mode):
+        self.mode = mode  # kept, as reloading the ROM resets it
         if mode is not None:
             available_modes = self.ale.getAvailableModes()
             assert mode in available_modes, f"mode not in {available_modes}"
             self.ale.setMode(mode)
 
     def _set_difficulty(self, difficulty):
+        self.difficulty = difficulty  # kept, as reloading the ROM resets it
         if difficulty is not None:
             available_difficulties = self.ale.getAvailableDifficulties()
             assert (
@@ -242,6 +329,8 @@ class ALEModern:
 
 class ALEClassic(ALEModern):
     def __init__(self, game, seed, device, training=False, **kwargs):
+        if kwargs.get("preallocated_buffers", False):
+            raise ValueError("Preallocated buffers are not supported by ALEClassic.")
         super().__init__(game, seed, device, sticky_action_p=0.0, **kwargs)
 
         self.training = training
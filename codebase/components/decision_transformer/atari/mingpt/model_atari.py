@@ -156,6 +156,9 @@ class GPT(nn.Module):
         self.action_embeddings = nn.Sequential(nn.Embedding(config.vocab_size, config.n_embd), nn.Tanh())
         nn.init.normal_(self.action_embeddings[0].weight, mean=0.0, std=0.02)
 
+        # rolling window of the token embeddings for the incremental inference (see incremental_forward)
+        self.incremental_token_embeddings = None
+
     def get_block_size(self):
         return self.block_size
 
@@ -216,15 +219,64 @@ class GPT(nn.Module):
         optimizer = torch.optim.AdamW(optim_groups, lr=train_config.learning_rate, betas=train_config.betas)
         return optimizer
 
+    def encode_states(self, states, state_normalization=None):
+        # states: (batch * block_size, 4, 84, 84)
+        # state_normalization: optional (mean, inv_std) pair of float32 tensors of shape (1, 4, 84, 84) for raw (e.g. uint8) states
+        if state_normalization is None:
+            return self.state_encoder(states.type(torch.float32).contiguous())
+
+        # the normalization is folded into the first conv - conv((x - mean) / std) = conv(x * inv_std) - conv(mean * inv_std),
+        # so the mean becomes a part of the bias (a per-position one, computed from the current weights) and the scaling is fused with the conversion to float
+        mean, inv_std = state_normalization
+        first_conv = self.state_encoder[0]
+        folded_bias = first_conv.bias.view(1, -1, 1, 1) - F.conv2d(mean * inv_std, first_conv.weight, stride=first_conv.stride, padding=first_conv.padding)
+        x = F.conv2d(torch.mul(states, inv_std), first_conv.weight, stride=first_conv.stride, padding=first_conv.padding) + folded_bias
+        return self.state_encoder[1:](x)
+
+    def reset_incremental_state(self):
+        self.incremental_token_embeddings = None
+
+    @torch.no_grad()
+    def incremental_forward(self, state, rtg, timesteps, previous_action=None, state_normalization=None):
+        # one step of the evaluation of the reward conditioned model, giving the same logits as forward (for the last state) over the whole window would -
+        # only the new tokens (the action taken in the last step, the current rtg and the current state) are embedded, the embeddings of the older ones are kept
+        # in a rolling window of the last block_size - 1 tokens (reset it by reset_incremental_state before each episode)
+        # (the keys and values of the older tokens cannot be cached, as the embedding of the current timestep is added to all the tokens of the window
+        # and their positional embeddings shift as the window rolls, so the transformer itself is still run over the whole window)
+        # state: (batch, 4, 84, 84)
+        # rtg: (batch, 1)
+        # timesteps: (batch, 1, 1)
+        # previous_action: (batch, 1), None in the very first step
+        if self.model_type != 'reward_conditioned':
+            raise NotImplementedError()
+
+        new_token_embeddings = [self.ret_emb(rtg.type(torch.float32)), self.encode_states(state.reshape(-1, 4, 84, 84), state_normalization)]
+        if previous_action is not None:
+            new_token_embeddings.insert(0, self.action_embeddings(previous_action.type(torch.long).reshape(-1)))
+        new_token_embeddings = torch.stack(new_token_embeddings, dim=1) # (batch, 2 or 3, n_embd)
+
+        if self.incremental_token_embeddings is None:
+            token_embeddings = new_token_embeddings
+        else:
+            token_embeddings = torch.cat((self.incremental_token_embeddings, new_token_embeddings), dim=1)[:, -(self.block_size - 1):, :]
+        self.incremental_token_embeddings = token_embeddings
+
+        global_position_embeddings = self.global_pos_emb[0, timesteps.reshape(-1), :].unsqueeze(1) # (batch, 1, n_embd)
+        x = self.drop(token_embeddings + global_position_embeddings + self.pos_emb[:, :token_embeddings.shape[1], :])
+        x = self.blocks(x)
+        x = self.ln_f(x[:, -1, :]) # only the prediction from the last state embedding is needed
+        return self.head(x) # (batch, vocab_size)
+
     # state, action, and return
-    def forward(self, states, actions, targets=None, rtgs=None, timesteps=None):
+    def forward(self, states, actions, targets=None, rtgs=None, timesteps=None, state_normalization=None):
         # states: (batch, block_size, 4*84*84)
         # actions: (batch, block_size, 1)
         # targets: (batch, block_size, 1)
         # rtgs: (batch, block_size, 1)
         # timesteps: (batch, 1, 1)
+        # state_normalization: (mean, inv_std), if the states are passed in unnormalized (see encode_states)
 
-        state_embeddings = self.state_encoder(states.reshape(-1, 4, 84, 84).type(torch.float32).contiguous()) # (batch * block_size, n_embd)
+        state_embeddings = self.encode_states(states.reshape(-1, 4, 84, 84), state_normalization) # (batch * block_size, n_embd)
         state_embeddings = state_embeddings.reshape(states.shape[0], states.shape[1], self.config.n_embd) # (batch, block_size, n_embd)
         
         if actions is not None and self.model_type == 'reward_conditioned': 
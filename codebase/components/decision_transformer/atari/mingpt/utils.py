@@ -27,7 +27,7 @@ def top_k_logits(logits, k):
     return out
 
 @torch.no_grad()
-def sample(model, x, steps, temperature=1.0, sample=False, top_k=None, actions=None, rtgs=None, timesteps=None):
+def sample(model, x, steps, temperature=1.0, sample=False, top_k=None, actions=None, rtgs=None, timesteps=None, state_normalization=None):
     """
     take a conditioning sequence of indices in x (of shape (b,t)) and predict the next token in
     the sequence, feeding the predictions back into the model each time. Clearly the sampling
@@ -42,7 +42,7 @@ def sample(model, x, steps, temperature=1.0, sample=False, top_k=None, actions=N
         if actions is not None:
             actions = actions if actions.size(1) <= block_size//3 else actions[:, -block_size//3:] # crop context if needed
         rtgs = rtgs if rtgs.size(1) <= block_size//3 else rtgs[:, -block_size//3:] # crop context if needed
-        logits, _ = model(x_cond, actions=actions, targets=None, rtgs=rtgs, timesteps=timesteps)
+        logits, _ = model(x_cond, actions=actions, targets=None, rtgs=rtgs, timesteps=timesteps, state_normalization=state_normalization)
         # pluck the logits at the final step and scale by temperature
         logits = logits[:, -1, :] / temperature
         # optionally crop probabilities to only the top k options
@@ -60,3 +60,22 @@ def sample(model, x, steps, temperature=1.0, sample=False, top_k=None, actions=N
         x = ix
 
     return x
+
+@torch.no_grad()
+def sample_incremental(model, state, rtg, timesteps, previous_action=None, temperature=1.0, sample=False, top_k=None, state_normalization=None):
+    """
+    take just the current state and rtg (and the action taken in the last step) and predict the next action the same way
+    as sample with steps=1 does, the older part of the context being kept in the model (see GPT.incremental_forward)
+    """
+    model.eval()
+    logits = model.incremental_forward(state, rtg, timesteps, previous_action=previous_action, state_normalization=state_normalization)
+    logits = logits / temperature
+    if top_k is not None:
+        logits = top_k_logits(logits, top_k)
+    probs = F.softmax(logits, dim=-1)
+    if sample:
+        ix = torch.multinomial(probs, num_samples=1)
+    else:
+        _, ix = torch.topk(probs, k=1, dim=-1)
+
+    return ix
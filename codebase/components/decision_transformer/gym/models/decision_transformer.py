@@ -138,7 +138,41 @@ class DecisionTransformer(TrajectoryModel):
             states, actions, None, returns_to_go, timesteps, attention_mask=attention_mask, **kwargs)
 
         return action_preds[0,-1]
-    
+
+    def get_action_with_cache(self, state, return_to_go, timestep, previous_action=None, previous_timestep=None, past_key_values=None):
+        # Incremental version of get_action - only the tokens which are new since the last call (the action taken in the previous step, if any,
+        # and the current return-to-go and state) are run through the transformer, keys and values of the older tokens are taken from the cache.
+        # The cache is kept as a sliding window, so that the state token attends to at most as many tokens as it would in get_action.
+        # (Once the window is full, the results are no longer identical to those of get_action, as the cached keys and values
+        # of the tokens in the window were computed while the older, already dropped, tokens were still attended to.)
+
+        time_embedding = self.embed_timestep(timestep.reshape(1, 1))
+        new_embeddings = [
+            self.embed_return(return_to_go.reshape(1, 1, 1)) + time_embedding,
+            self.embed_state(state.reshape(1, 1, self.state_dim)) + time_embedding,
+        ]
+        if previous_action is not None and (self.max_length is None or self.max_length > 1): # (with context of length 1 the state token does not see the previous action)
+            previous_action_embedding = self.embed_action(previous_action.reshape(1, 1, self.act_dim)) + self.embed_timestep(previous_timestep.reshape(1, 1))
+            new_embeddings.insert(0, previous_action_embedding)
+
+        stacked_inputs = self.embed_ln(torch.cat(new_embeddings, dim=1))
+
+        # Slide the window of the cached keys and values
+        if past_key_values is not None and self.max_length is not None:
+            max_cached_length = 3*self.max_length - 1 - stacked_inputs.shape[1]
+            past_key_values = tuple(layer_past[:, :, :, max(layer_past.shape[3] - max_cached_length, 0):] for layer_past in past_key_values)
+
+        transformer_outputs = self.transformer(
+            inputs_embeds=stacked_inputs,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        x = transformer_outputs['last_hidden_state']
+
+        action_pred = self.predict_action(x[:,-1])  # predict next action given state (the last token)
+
+        return action_pred[0], transformer_outputs['past_key_values']
+
 
     def get_batch_actions(self, states, actions, returns_to_go, timesteps, attention_masks, batch_size, device, **kwargs):
         # Similar to get_action, but for a batch of inputs and for usage in TD3, also takes attention_masks as input
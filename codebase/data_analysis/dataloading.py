@@ -1,5 +1,10 @@
+import numpy as np
 import pandas as pd
 import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tqdm import tqdm
 
 
 def load_fitnesses_from_csv(path, nrows=200):
@@ -20,6 +25,35 @@ def load_fitnesses_from_csv(path, nrows=200):
     return data
 
 
+def load_population_data_from_npy(path, nrows=200):
+    # Binary log of the fitnesses or runtimes (see funcs.log_iteration_population_data_binary), memory-mapped instead of being read
+    # (the number of rows is given by the size of the file, in case the header was not updated after the last append)
+    with open(path, "rb") as log:
+        np.lib.format.read_magic(log)
+        (_, row_length), _, dtype = np.lib.format.read_array_header_1_0(log)
+        data_offset = log.tell()
+        
+    num_of_rows = (os.path.getsize(path) - data_offset) // (row_length * dtype.itemsize)
+    if nrows is not None:
+        num_of_rows = min(num_of_rows, nrows)
+    
+    values = np.memmap(path, dtype=dtype, mode="r", offset=data_offset, shape=(num_of_rows, row_length)) if num_of_rows > 0 else np.empty((0, row_length), dtype=dtype)
+    
+    column_names = [str(i//2) + ("+" if i % 2 == 0 else "-") for i in range(row_length)]
+    data = pd.DataFrame(values, columns=column_names, copy=False)
+    
+    # Adjust the index to start at 1 instead of 0 - row index = number of iteration
+    data.index = data.index + 1
+    
+    return data
+
+
+def load_population_data(path, nrows=200): # Population log (fitnesses or runtimes) in either of the formats
+    if str(path).endswith(".npy"):
+        return load_population_data_from_npy(path, nrows)
+    return load_fitnesses_from_csv(path, nrows)
+
+
 def load_evaluation_fitnesses_from_csv(path, nrows=200):
     data = pd.read_csv(
         path,
@@ -69,10 +103,111 @@ def load_times_from_csv(path, nrows=200):
     return data
 
 
+def load_phase_timings_from_jsonl(path, nrows=200):
+    # Durations of the individual phases of the iterations (one column per phase) followed by the statistics of the noise evaluations summed up over the workers
+    # and the slowest worker's compute time (the one everybody waits for)
+    rows = list()
+    with open(path, "r") as log:
+        for line in log:
+            if nrows is not None and len(rows) >= nrows:
+                break
+            
+            record = json.loads(line)
+            row = {"Iteration": record["iteration"] + 1} # Row index = number of iteration
+            row.update(record["phases"])
+            
+            workers = pd.DataFrame(record["workers"])
+            if len(workers) > 0:
+                row["Environment steps"] = workers["environment_steps"].sum()
+                row["Environment step time"] = workers["environment_step_time"].sum()
+                row["Model forward time"] = workers["model_forward_time"].sum()
+                row["Max worker compute time"] = workers["compute_time"].max()
+                row["Environment steps per second"] = workers["environment_steps"].sum() / workers["compute_time"].max()
+                
+            rows.append(row)
+    
+    return pd.DataFrame(rows).set_index("Iteration").rename_axis(None)
+
+
+AGGREGATED_QUANTILES = (0.025, 0.25, 0.5, 0.75, 0.975)
+
+
+def iterate_population_data_rows(path, nrows=200):
+    # Rows (iterations) of a population log (either .csv, or .npy) one by one as numpy arrays, without ever loading the whole log
+    path = str(path)
+    if path.endswith(".npy"):
+        data = load_population_data_from_npy(path, nrows)
+        for row in data.values:
+            yield row
+        return
+    
+    with open(path, "r") as log:
+        for i, line in enumerate(log):
+            if nrows is not None and i >= nrows:
+                break
+            yield np.fromstring(line, sep=";")
+
+
+def load_aggregated_population_data(path, nrows=200, use_cache=True):
+    # Per-iteration aggregates (count of the non-nan values, mean, min, max and the AGGREGATED_QUANTILES) of a population log (fitnesses or runtimes),
+    # computed while streaming through its rows, so that just one row is in the memory at a time.
+    # The aggregates are cached next to the log and reused as long as the log is not modified (the cache being keyed by its modification time and size).
+    path = str(path)
+    cache_path = path + ".aggregates.npz"
+    stat = os.stat(path)
+    cache_key = np.array([stat.st_mtime_ns, stat.st_size, -1 if nrows is None else nrows], dtype=np.int64)
+    
+    if use_cache and os.path.isfile(cache_path):
+        with np.load(cache_path) as cache:
+            if np.array_equal(cache["key"], cache_key):
+                return pd.DataFrame(cache["aggregates"], columns=cache["columns"], index=cache["index"])
+    
+    columns = ["Count", "Mean", "Min", "Max"] + [f"Q{quantile}" for quantile in AGGREGATED_QUANTILES]
+    aggregates = list()
+    for row in iterate_population_data_rows(path, nrows):
+        row = row[~np.isnan(row)] # (nan marks the tasks cancelled by the straggler cutoff)
+        if len(row) == 0:
+            aggregates.append([0] + [np.nan] * (len(columns) - 1))
+            continue
+        
+        aggregates.append([len(row), row.mean(), row.min(), row.max()] + list(np.quantile(row, AGGREGATED_QUANTILES)))
+        
+    aggregates = np.array(aggregates, dtype=np.float64).reshape(-1, len(columns))
+    index = np.arange(1, len(aggregates) + 1) # Row index = number of iteration
+    
+    if use_cache:
+        # Saved into a temporary file first and then moved in place, so that a partial cache is never read
+        temporary_cache_path = cache_path + "." + str(os.getpid()) + ".tmp.npz"
+        np.savez(temporary_cache_path, key=cache_key, aggregates=aggregates, columns=np.array(columns), index=index)
+        os.replace(temporary_cache_path, cache_path)
+    
+    return pd.DataFrame(aggregates, columns=columns, index=index)
+
+
+def load_in_parallel(load_function, arguments_of_calls, num_of_processes=None, description="Loading runs"):
+    # Calls the (module-level) load_function with each of the tuples of arguments in a pool of processes, reporting the progress,
+    # and returns the results in the order of the arguments (with one process, everything is loaded in the main process)
+    if num_of_processes == 1:
+        return [load_function(*arguments) for arguments in tqdm(arguments_of_calls, desc=description)]
+    
+    with ProcessPoolExecutor(num_of_processes) as executor:
+        futures = [executor.submit(load_function, *arguments) for arguments in arguments_of_calls]
+        for _ in tqdm(as_completed(futures), total=len(futures), desc=description):
+            pass
+        
+    return [future.result() for future in futures]
+
+
 def load_es_data(path, nrows=200):
     evaluation_fitness_path = path + ".evaluations.csv"
     fitness_path = path + ".fitness.csv"
     runtime_path = path + ".runtime.csv"
+    
+    # The population data may have been logged in the binary format instead
+    binary_population_logs = os.path.isfile(path + ".fitness.npy")
+    if binary_population_logs:
+        fitness_path = path + ".fitness.npy"
+        runtime_path = path + ".runtime.npy"
     time_path = path + ".time.csv"
     
     assert os.path.isfile(evaluation_fitness_path)
@@ -81,8 +216,12 @@ def load_es_data(path, nrows=200):
     assert os.path.isfile(time_path)
     
     evaluation_fitnesses = load_evaluation_fitnesses_from_csv(evaluation_fitness_path, nrows)
-    fitnesses = load_fitnesses_from_csv(fitness_path, nrows)
-    runtimes = load_runtimes_from_csv(runtime_path, nrows)
+    if binary_population_logs:
+        fitnesses = load_population_data_from_npy(fitness_path, nrows)
+        runtimes = load_population_data_from_npy(runtime_path, nrows)
+    else:
+        fitnesses = load_fitnesses_from_csv(fitness_path, nrows)
+        runtimes = load_runtimes_from_csv(runtime_path, nrows)
     iteration_times = load_times_from_csv(time_path, nrows)
     
     return evaluation_fitnesses, fitnesses, runtimes, iteration_times
@@ -217,6 +217,28 @@ def plot_time(*dataframes, num_of_iterations_to_plot=200, values_range=(0,None),
     plt.show()
 
 
+def plot_phase_times(dataframe, phases=None, num_of_iterations_to_plot=200, values_range=(0,None), plot_dimensions=(3.8,2.7), plot_title=None):
+    # Stacked durations of the individual phases of the iterations of a single run (see dataloading.load_phase_timings_from_jsonl)
+    if phases is None:
+        phases = [column for column in ("seed_broadcast", "dispatch", "model_evaluation", "result_gathering", "ranking_and_logging", "weights_and_vbn_broadcast", "update", "max_runtime_broadcast", "barrier") if column in dataframe.columns]
+    
+    df = dataframe[phases].fillna(0)
+
+    plt.figure(figsize=plot_dimensions)
+    
+    plt.stackplot(df.index, *(df[phase] for phase in phases), labels=phases)
+    
+    plt.legend(loc="upper left", shadow=True)
+    plt.xlabel("Iteration")
+    plt.ylabel("Wall-clock time (seconds)")
+    plt.ylim(values_range)
+    plt.xlim(1, num_of_iterations_to_plot)
+    if plot_title is not None:
+        plt.title(plot_title)
+    plt.tight_layout()
+    plt.show()
+
+
 # ---------- Plots accumulating data from multiple experiments ----------
 
 def create_plot_for_multiple_experiments(plot_dimensions=None, plot_title=None):
@@ -355,14 +377,48 @@ def add_time_data_from_one_experiment_to_plot(*dataframes, experiment_name, sing
     add_interval_to_plot(aggregated_df, lineplot)
     
     
+def add_aggregated_population_data_from_one_experiment_to_plot(*aggregated_dataframes, experiment_name, value_name, central_measure="mean", interval_measure="standard"):
+    # Counterpart of add_fitness_data_from_one_experiment_to_plot and add_runtime_data_from_one_experiment_to_plot for the per-run aggregates
+    # of the population logs (see dataloading.load_aggregated_population_data), the whole population data of all the runs never being held at once.
+    # The mean is exact (the per-run means are weighted by the numbers of values), the median and the interval are approximated by the mean of the per-run ones.
+    if interval_measure.lower() == "standard":
+        percentile_interval=(0.025, 0.975)
+    elif interval_measure.lower() == "quartiles":
+        percentile_interval=(0.25, 0.75)
+    else:
+        raise ValueError("Invalid interval measure. Use 'standard' or 'quartiles'.")
+    
+    combined_df = pd.concat(aggregated_dataframes, keys=range(len(aggregated_dataframes)), names=["Run", "Iteration"]).reset_index()
+    combined_df["Weighted mean"] = combined_df["Mean"] * combined_df["Count"]
+    
+    grouped_df = combined_df.groupby("Iteration")
+    aggregated_df = pd.DataFrame({
+        "Lower_value": grouped_df[f"Q{percentile_interval[0]}"].mean(),
+        "Upper_value": grouped_df[f"Q{percentile_interval[1]}"].mean()
+    })
+    if central_measure == "mean":
+        aggregated_df[value_name] = grouped_df["Weighted mean"].sum() / grouped_df["Count"].sum()
+    elif central_measure == "median":
+        aggregated_df[value_name] = grouped_df["Q0.5"].mean()
+    else:
+        raise ValueError("Invalid central measure. Use 'mean' or 'median'.")
+    aggregated_df = aggregated_df.reset_index()
+    
+    lineplot = sns.lineplot(x="Iteration", y=value_name, label=experiment_name, data=aggregated_df)
+    add_interval_to_plot(aggregated_df, lineplot)
+    
+    
 def add_horizontal_dashed_line_to_plot(line_name, y_value):
     plt.axhline(y=y_value, linestyle='--', color='gray', label=line_name)
     
     
-def show_plot_for_multiple_experiments(num_of_iterations_to_plot=200, values_range=(0,None), disable_legend=False, legend_location="upper left", legend_shadow=True):
+def show_plot_for_multiple_experiments(num_of_iterations_to_plot=200, values_range=(0,None), disable_legend=False, legend_location="upper left", legend_shadow=True, title=None):
     plt.ylim(values_range)
     plt.xlim(1, num_of_iterations_to_plot)
     
+    if title is not None:
+        plt.title(title, fontsize="small")
+    
     if disable_legend:
         plt.legend().remove()
     else:
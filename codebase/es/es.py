@@ -1,8 +1,10 @@
 # Main logic of the distributed es utilizing MPI.
 
+import multiprocessing
 import mpi4py
 
 mpi4py.rc.thread_level = "serialized"
+mpi4py.rc.initialize = multiprocessing.current_process().name == "MainProcess" # (not in the spawned subprocesses of the pipelined evaluation, which import the main script too)
 
 from mpi4py import MPI
 from mpi4py.futures import MPICommExecutor
@@ -11,6 +13,8 @@ import random
 import time
 import os
 import sys
+import copy
+from itertools import chain
 
 # Forbid multithreading for Numpy.
 N_THREADS = "1"
@@ -27,8 +31,11 @@ import torch
 torch.set_num_threads(1)
 
 from . import funcs
+from . import scheduling
+from . import profiling
 from . import process_memory as pm
 from es_utilities import utils
+from es_utilities.environment_batches import SubprocessEnvironmentBatch
 
 from tqdm import tqdm
 
@@ -41,10 +48,24 @@ def es(
     main_seed,
     noise_deviation,
     weight_decay_factor,
-    batch_size,
+    batch_size, # Deprecated and ignored (a warning is issued, unless it is None) - the weighted noises are accumulated one at a time during the model update
     update_vbn_stats_probability,
     path_for_checkpoints,
-    logging_path
+    logging_path,
+    evaluation_batch_size=1,
+    noise_table_mode="broadcast",
+    noise_table_path=None,
+    noise_table_cache_directory=None,
+    flat_parameters=False,
+    sharded_update=False,
+    task_scheduling="executor",
+    dedicated_evaluation_rank=False,
+    resume=False,
+    run_state_checkpoint_interval=None, # (None for not saving the run state at all)
+    straggler_cutoff_fraction=None,
+    log_phase_timings=False,
+    population_log_format="csv",
+    pipelined_evaluation=False
 ):
     # Initialize MPI
     comm = MPI.COMM_WORLD
@@ -65,6 +86,28 @@ def es(
     if size == 1:
         raise AssertionError("Only master is running! We need a master process and at least one worker process.")
     
+    if dedicated_evaluation_rank and size == 2:
+        raise AssertionError("Only master and the evaluation process are running! We need a master process, an evaluation process and at least one worker process.")
+    
+    if noise_table_mode not in ["broadcast", "file", "shared_memory"]:
+        raise ValueError(noise_table_mode + " is not a valid noise table mode. (Only broadcast, file and shared_memory are allowed.)")
+    
+    if task_scheduling not in ["executor", "static", "dynamic"]:
+        raise ValueError(task_scheduling + " is not a valid task scheduling. (Only executor, static and dynamic are allowed.)")
+    
+    if straggler_cutoff_fraction is not None and (task_scheduling != "dynamic" or not 0 < straggler_cutoff_fraction <= 1):
+        raise ValueError("Straggler cutoff fraction has to be from the interval (0,1] and it can be used only with the dynamic task scheduling.")
+    
+    if population_log_format not in ["csv", "npy"]:
+        raise ValueError(population_log_format + " is not a valid population log format. (Only csv and npy are allowed.)")
+    
+    if pipelined_evaluation and evaluation_batch_size < 2:
+        raise ValueError("Pipelined evaluation can be used only with the batched evaluation (evaluation batch size greater than 1).")
+    
+    if batch_size is not None and rank == 0:
+        import warnings
+        warnings.warn("The batch size is deprecated and ignored - the weighted noises are accumulated one at a time during the model update.", FutureWarning)
+    
     
     if rank == 0:
         print("Comm_world size:", size, flush=True)
@@ -80,10 +123,40 @@ def es(
     pm.model = comm.bcast(model)
     pm.test_environment = comm.bcast(test_environment)
     
+    # Resuming from the last saved run state, if there is any (the model, its optimizer and VBN stats are restored in all the processes, the rest is taken care of later)
+    run_state_path = os.path.normpath(path_for_checkpoints) + "_run_state.state"
+    run_state = None
+    if resume:
+        if rank == 0 and os.path.isfile(run_state_path):
+            run_state = funcs.load_run_state(run_state_path)
+            
+        run_state = comm.bcast(run_state)
+        
+    if run_state is not None:
+        main_seed = run_state["main_seed"]
+        pm.model.load_state_dict(run_state["model"])
+        pm.model.vbn_stats = run_state["vbn_stats"]
+        if pm.model.optimizer is not None:
+            pm.model.optimizer.load_state_dict(run_state["optimizer"])
+            
+        if rank == 0:
+            pm.test_environment = run_state["test_environment"]
+            print("Resuming from iteration", run_state["iteration"], flush=True)
+    
+    # Flat parameter mode - the parameters (and the noises) are handled as single flat vectors (done after the broadcast, as pickling does not keep the parameters being views into one buffer)
+    if flat_parameters:
+        pm.model.flatten_parameters()
+    
     
     # Set the seed
     utils.set_seed(main_seed)
     
+    if run_state is not None and rank == 0:
+        random_state, numpy_random_state, torch_random_state = run_state["random_state"]
+        random.setstate(random_state)
+        np.random.set_state(numpy_random_state)
+        torch.set_rng_state(torch_random_state)
+    
     
     if rank > 0:
         # Those are not needed, nor wanted from the workers (and e.g. gym does sometimes output them)
@@ -94,16 +167,83 @@ def es(
     # Control variables initialization
     
     ## Shared noise table
-    if rank == 0:
-        pm.shared_noise_table = utils.SharedNoiseTable(noise_deviation, main_seed)
+    if noise_table_cache_directory is not None:
+        # Generated (in parallel) by the master only if not already cached by some previous run with the same seed and deviation
+        noise_table_cache_path = None
+        if rank == 0:
+            noise_table_cache_path = utils.SharedNoiseTable.generate_into_cache(noise_table_cache_directory, noise_deviation, main_seed)
+            
+        noise_table_cache_path = comm.bcast(noise_table_cache_path)
         
-    pm.shared_noise_table = comm.bcast(pm.shared_noise_table)
+    else:
+        noise_table_cache_path = None
+    
+    if noise_table_mode == "broadcast":
+        # Created in the master and sent to every process, each of them holding its own copy
+        if rank == 0:
+            if noise_table_cache_path is not None:
+                pm.shared_noise_table = utils.SharedNoiseTable.from_file(noise_table_cache_path, in_memory=True)
+            else:
+                pm.shared_noise_table = utils.SharedNoiseTable(noise_deviation, main_seed)
+            
+        pm.shared_noise_table = comm.bcast(pm.shared_noise_table)
+        
+    else:
+        # One copy per node, mapped read-only by all the processes on the node (so we silence torch complaining about read-only arrays when getting the noises)
+        import warnings
+        warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+        
+        if noise_table_mode == "file" and noise_table_cache_path is not None:
+            # The cached table itself is mapped (the cache has to be accessible by all the processes)
+            pm.shared_noise_table = utils.SharedNoiseTable.from_file(noise_table_cache_path)
+            
+        elif noise_table_mode == "file":
+            # Generated into a file by the master (the file has to be accessible by all the processes)
+            if noise_table_path is None:
+                noise_table_path = logging_path + ".noise_table"
+                
+            if rank == 0:
+                os.makedirs(os.path.dirname(os.path.abspath(noise_table_path)), exist_ok=True)
+                utils.SharedNoiseTable.generate_into_file(noise_table_path, noise_deviation, main_seed)
+                
+            comm.Barrier()
+            pm.shared_noise_table = utils.SharedNoiseTable.from_file(noise_table_path)
+            
+        else:
+            # Generated (or copied from the cache) into an MPI shared-memory window on each node
+            pm.shared_noise_table = utils.SharedNoiseTable.in_node_shared_memory(comm, noise_deviation, main_seed, noise_table_cache_path)
+    
+    ## Dedicated evaluation process
+    if dedicated_evaluation_rank:
+        # The last process does not take part in the training, it just evaluates (and saves, if they are the best yet) the models sent to it by the master, while the training goes on.
+        # The training itself then runs in a communicator without it.
+        evaluation_comm, evaluation_rank = comm, size - 1
+        comm = evaluation_comm.Split(1 if rank == evaluation_rank else 0, rank)
+        
+        if rank == evaluation_rank:
+            path_for_checkpoints = os.path.normpath(path_for_checkpoints)
+            os.makedirs(os.path.dirname(path_for_checkpoints), exist_ok=True)
+            
+            funcs.run_evaluations_of_received_models(evaluation_comm, pm.model, pm.test_environment, 10, path_for_checkpoints, run_state["best_return_yet"] if run_state is not None else -float("inf"))
+            return
+        
+        size = comm.Get_size()
+        # (the snapshots of the models sent for evaluation, the results of which have not been received yet, are kept by their iterations,
+        # so that they can be saved in the run state and sent again after resuming, without waiting for their results before saving it)
+        pending_evaluation_requests, unevaluated_models = list(), dict()
+        
+        if rank == 0 and run_state is not None:
+            for evaluated_iteration, snapshot in run_state.get("unevaluated_models", dict()).items():
+                pending_evaluation_requests.append(funcs.send_model_for_evaluation(evaluation_comm, evaluation_rank, evaluated_iteration, snapshot))
+                unevaluated_models[evaluated_iteration] = snapshot
     
     ## Array of seeds of the individual tasks
     pm.seed_array = np.empty(size_of_population, dtype="i")
     
     ## Initial upper bound on the length of runtime for the evaluations
     pm.max_runtime = pm.test_environment.timestep_limit if pm.test_environment.timestep_limit is not None else 2147483647
+    if run_state is not None:
+        pm.max_runtime = run_state["max_runtime"]
     
     ## Array of ranks / weights for model update in each iteration (results from achieved fitnesses of individual noises)
     pm.rank_weights = np.empty(size_of_population, dtype="f")
@@ -113,6 +253,10 @@ def es(
     pm.sum_of_encountered_states = np.empty(pm.test_environment.state_shape, dtype="f")
     pm.sum_of_squares_of_encountered_states = np.empty(pm.test_environment.state_shape, dtype="f")
     pm.count_of_encountered_states = 0
+    
+    ## Timer of the individual phases of the iterations (does nothing, unless the phase timings are logged)
+    phase_timer = profiling.PhaseTimer(log_phase_timings)
+    pm.collect_evaluation_statistics = log_phase_timings
                 
                 
     # Local variables
@@ -126,6 +270,16 @@ def es(
     else:
         # Model to be used for the individual noise evaluations in the workers
         pm.test_model = pm.model.clone()
+        
+        # Copies of the test environment for the batched evaluations (each task in the batch needs two of them, for +noise and -noise)
+        if evaluation_batch_size > 1:
+            pm.test_environments = [copy.deepcopy(pm.test_environment) for _ in range(2 * evaluation_batch_size)]
+            
+            if pipelined_evaluation:
+                # The copies run in subprocesses (the states and actions being passed through shared memory) and the batch is evaluated in two groups,
+                # so that the forward pass for one of them overlaps the stepping of the environments of the other (the subprocesses are spawned, as forking after the initialization of MPI is unsafe)
+                pm.test_environment_batch = SubprocessEnvironmentBatch(pm.test_environments, start_method="spawn", shared_memory=True)
+                pm.test_models = [pm.model, pm.model.clone()]
     
     
     # Prepare for logging in the master
@@ -141,28 +295,72 @@ def es(
         last_evaluation_result, last_evaluation_runtime, best_yet_iteration, best_return_yet, corresponding_runtime = float("nan"), float("nan"), None, -float("inf"), float("nan")
         evaluation_path = logging_path + ".evaluations"
         evaluation_csv_path = logging_path + ".evaluations.csv"
-        fitness_path = logging_path + ".fitness.csv"
-        runtime_path = logging_path + ".runtime.csv"
+        fitness_path = logging_path + ".fitness." + population_log_format
+        runtime_path = logging_path + ".runtime." + population_log_format
         time_path = logging_path + ".time.csv"
+        cutoff_path = logging_path + ".cutoff.csv"
+        phase_timings_path = logging_path + ".phases.jsonl"
         
-        # Clearing and preparing logfiles
-        if os.path.exists(fitness_path):
-            os.remove(fitness_path)
+        if run_state is not None:
+            # Restoring the logging-related local variables and cutting off whatever has been logged after the run state was saved
+            best_yet_iteration, best_return_yet, corresponding_runtime = run_state["best_yet_iteration"], run_state["best_return_yet"], run_state["corresponding_runtime"]
+            for path, size_of_log in run_state["sizes_of_logs"].items():
+                with open(path, "a") as log:
+                    log.truncate(size_of_log)
+            
+            progress_bar.update(run_state["iteration"])
+            
+        else:
+            # Clearing and preparing logfiles (the population logs in both of the formats, so that no stale log of the other format is picked up when loading)
+            for log_format in ["csv", "npy"]:
+                if os.path.exists(logging_path + ".fitness." + log_format):
+                    os.remove(logging_path + ".fitness." + log_format)
+
+                if os.path.exists(logging_path + ".runtime." + log_format):
+                    os.remove(logging_path + ".runtime." + log_format)
+
+            if os.path.exists(time_path):
+                os.remove(time_path)
 
-        if os.path.exists(runtime_path):
-            os.remove(runtime_path)
+            if os.path.exists(evaluation_path):
+                os.remove(evaluation_path)
 
-        if os.path.exists(time_path):
-            os.remove(time_path)
+            if os.path.exists(evaluation_csv_path):
+                os.remove(evaluation_csv_path)
 
-        if os.path.exists(evaluation_path):
-            os.remove(evaluation_path)
+            if os.path.exists(cutoff_path):
+                os.remove(cutoff_path)
 
-        if os.path.exists(evaluation_csv_path):
-            os.remove(evaluation_csv_path)
+            if os.path.exists(phase_timings_path):
+                os.remove(phase_timings_path)
 
-        with open(evaluation_csv_path, "a") as log:
-                log.write(f"Evaluation result\tBest yet result\n")
+            with open(evaluation_csv_path, "a") as log:
+                    log.write(f"Evaluation result\tBest yet result\n")
+                    
+            if straggler_cutoff_fraction is not None:
+                with open(cutoff_path, "a") as log:
+                    log.write(f"Evaluated tasks\tCancelled tasks\n")
+                
+        ## (current_phase is the description of what is being run, shown in the progress bar - e.g. no iteration is run at all after resuming a finished run)
+        def log_evaluation_result(evaluated_iteration, evaluation_result, evaluation_runtime, current_phase):
+            nonlocal best_yet_iteration, best_return_yet, corresponding_runtime
+            
+            if evaluation_result >= best_return_yet:
+                best_return_yet = evaluation_result
+                corresponding_runtime = evaluation_runtime
+                best_yet_iteration = evaluated_iteration
+                
+                if evaluated_iteration < num_of_iterations:
+                    progress_bar.set_description(f"{current_phase} | Best yet evaluation result (mean runtime) " + \
+                        f"being obtained after iteration {best_yet_iteration} - {best_return_yet:.4f} ({corresponding_runtime})")
+            
+            # Log the evaluation results (except for the final evaluation)
+            if evaluated_iteration < num_of_iterations:
+                with open(evaluation_path, "a") as log:
+                    log.write(f"Iteration {evaluated_iteration} - Evaluation result (mean runtime): {evaluation_result} ({evaluation_runtime}) | Best yet: {best_return_yet} ({corresponding_runtime})\n")
+                
+                with open(evaluation_csv_path, "a") as log:
+                    log.write(f"{evaluation_result}\t{best_return_yet}\n")
     
     
     # Synchronization barrier after the setup phase and before the individual iterations
@@ -170,10 +368,13 @@ def es(
     
 
     # Iterations / Run of the program
-    for iteration in range(num_of_iterations):
+    for iteration in range(run_state["iteration"] if run_state is not None else 0, num_of_iterations):
         
         # --- Iteration setup phase ---
         
+        phase_timer.restart()
+        profiling.reset_evaluation_statistics()
+        
         if rank == 0:
             # Report progress in the master
             progress_bar.set_description(f"Running iteration {iteration+1} | Best yet evaluation result (mean runtime) " + \
@@ -193,110 +394,193 @@ def es(
                 pm.seed_array[i] = random.randint(0, 2147483647)
                 
         comm.Bcast(pm.seed_array)
+        phase_timer.lap("seed_broadcast")
     
         if rank == 0:
             # Reseting VBN-stats-related memory
             pm.sum_of_encountered_states = np.zeros(pm.test_environment.state_shape, dtype="f")
             pm.sum_of_squares_of_encountered_states = np.zeros(pm.test_environment.state_shape, dtype="f")
             pm.count_of_encountered_states = 0
+            
+        if rank == 0 and dedicated_evaluation_rank:
+            # Send the model resulting from the previous iteration to be evaluated (and possibly saved) in the background
+            unevaluated_models[iteration] = funcs.get_model_snapshot(pm.model)
+            pending_evaluation_requests.append(funcs.send_model_for_evaluation(evaluation_comm, evaluation_rank, iteration, unevaluated_models[iteration]))
         
         
         # --- Noises evaluation phase ---
         
         # Distribute the tasks and while they are being computed on the workers, perform evaluation of the model from the previous iteration.
-        with MPICommExecutor(comm) as executor:
+        if task_scheduling == "executor":
+            # Tasks (or batches of them) are mapped to the workers one by one
+            executor_context = MPICommExecutor(comm)
+        else:
+            # Tasks are handed to the workers in chunks (either all at once, or on request) and the results are gathered at once
+            executor_context = scheduling.ChunkedTaskScheduler(comm, size_of_population, main_seed + iteration, evaluation_batch_size, task_scheduling == "dynamic", straggler_cutoff_fraction)
+        
+        with executor_context as executor:
             if executor is not None: # In other words "execute just in root"
-                noise_evaluation_results = executor.map(
-                    funcs.noise_evaluations,
-                    range(size_of_population),
-                    (main_seed + iteration for _ in range(size_of_population))
-                )
-                
+                if task_scheduling == "executor": # (the chunked scheduler is already processing the tasks)
+                    if evaluation_batch_size > 1:
+                        # Tasks are sent to the workers in batches, which are evaluated at once
+                        batches_of_task_indices = [range(i, min(i + evaluation_batch_size, size_of_population)) for i in range(0, size_of_population, evaluation_batch_size)]
+                        noise_evaluation_results = chain.from_iterable(executor.map(
+                            funcs.batched_noise_evaluations,
+                            batches_of_task_indices,
+                            (main_seed + iteration for _ in range(len(batches_of_task_indices)))
+                        ))
+                        
+                    else:
+                        noise_evaluation_results = executor.map(
+                            funcs.noise_evaluations,
+                            range(size_of_population),
+                            (main_seed + iteration for _ in range(size_of_population))
+                        )
+                phase_timer.lap("dispatch")
                 
-                # Evaluate the model resulting from the previous iteration and save it, if it is better than the best yet encountered
-                last_evaluation_result, last_evaluation_runtime = funcs.evaluate_and_possibly_save(
-                    pm.model,
-                    pm.test_environment,
-                    best_return_yet,
-                    10,
-                    path_for_checkpoints
-                )
                 
-                if last_evaluation_result >= best_return_yet:
-                    best_return_yet = last_evaluation_result
-                    corresponding_runtime = last_evaluation_runtime
-                    best_yet_iteration = iteration
-
-                    progress_bar.set_description(f"Running iteration {iteration+1} | Best yet evaluation result (mean runtime) " + \
-                        f"being obtained after iteration {best_yet_iteration} - {best_return_yet:.4f} ({corresponding_runtime})")
-                
-                # Log the evaluation results
-                with open(evaluation_path, "a") as log:
-                    log.write(f"Iteration {iteration} - Evaluation result (mean runtime): {last_evaluation_result} ({last_evaluation_runtime}) | Best yet: {best_return_yet} ({corresponding_runtime})\n")
-                
-                with open(evaluation_csv_path, "a") as log:
-                    log.write(f"{last_evaluation_result}\t{best_return_yet}\n")
+                # Evaluate the model resulting from the previous iteration and save it, if it is better than the best yet encountered (unless it is done by the evaluation process)
+                if not dedicated_evaluation_rank:
+                    last_evaluation_result, last_evaluation_runtime = funcs.evaluate_and_possibly_save(
+                        pm.model,
+                        pm.test_environment,
+                        best_return_yet,
+                        10,
+                        path_for_checkpoints
+                    )
+                    
+                    log_evaluation_result(iteration, last_evaluation_result, last_evaluation_runtime, f"Running iteration {iteration+1}")
+                phase_timer.lap("model_evaluation")
                 
                 
                 # Process results of the individual noise evaluations
-                for noise_evaluation_result in noise_evaluation_results:
-                    if noise_evaluation_result.sum_ is not None:
-                        pm.sum_of_encountered_states += np.reshape(noise_evaluation_result.sum_, pm.test_environment.state_shape)
-                        pm.sum_of_squares_of_encountered_states += np.reshape(noise_evaluation_result.sum_of_squares, pm.test_environment.state_shape)
-                        pm.count_of_encountered_states += noise_evaluation_result.count
+                if task_scheduling != "executor":
+                    packed_results, sum_, sum_of_squares, count = executor.gather_results()
+                    
+                    # (with the straggler cutoff, some of the tasks might have been cancelled, those are marked as not evaluated)
+                    task_indices = packed_results[:, 0].astype(int)
+                    evaluated_tasks = np.zeros(size_of_population, dtype=bool)
+                    evaluated_tasks[task_indices] = True
+                    fitness_of_plus_noises[~evaluated_tasks] = np.nan
+                    fitness_of_minus_noises[~evaluated_tasks] = np.nan
+                    runtime_last_iteration_of_plus_noises[~evaluated_tasks] = 0
+                    runtime_last_iteration_of_minus_noises[~evaluated_tasks] = 0
+                    fitness_of_plus_noises[task_indices] = packed_results[:, 1]
+                    runtime_last_iteration_of_plus_noises[task_indices] = packed_results[:, 2]
+                    fitness_of_minus_noises[task_indices] = packed_results[:, 3]
+                    runtime_last_iteration_of_minus_noises[task_indices] = packed_results[:, 4]
+                    
+                    pm.sum_of_encountered_states += np.reshape(sum_, pm.test_environment.state_shape).astype("f")
+                    pm.sum_of_squares_of_encountered_states += np.reshape(sum_of_squares, pm.test_environment.state_shape).astype("f")
+                    pm.count_of_encountered_states += count
+                    
+                else:
+                    for noise_evaluation_result in noise_evaluation_results:
+                        if noise_evaluation_result.sum_ is not None:
+                            pm.sum_of_encountered_states += np.reshape(noise_evaluation_result.sum_, pm.test_environment.state_shape)
+                            pm.sum_of_squares_of_encountered_states += np.reshape(noise_evaluation_result.sum_of_squares, pm.test_environment.state_shape)
+                            pm.count_of_encountered_states += noise_evaluation_result.count
+                        
+                        fitness_of_plus_noises[noise_evaluation_result.task_index] = noise_evaluation_result.fitness_of_plus_noise
+                        fitness_of_minus_noises[noise_evaluation_result.task_index] = noise_evaluation_result.fitness_of_minus_noise
+                        runtime_last_iteration_of_plus_noises[noise_evaluation_result.task_index] = noise_evaluation_result.runtime_of_plus_noise
+                        runtime_last_iteration_of_minus_noises[noise_evaluation_result.task_index] = noise_evaluation_result.runtime_of_minus_noise
                         
-                    fitness_of_plus_noises[noise_evaluation_result.task_index] = noise_evaluation_result.fitness_of_plus_noise
-                    fitness_of_minus_noises[noise_evaluation_result.task_index] = noise_evaluation_result.fitness_of_minus_noise
-                    runtime_last_iteration_of_plus_noises[noise_evaluation_result.task_index] = noise_evaluation_result.runtime_of_plus_noise
-                    runtime_last_iteration_of_minus_noises[noise_evaluation_result.task_index] = noise_evaluation_result.runtime_of_minus_noise
+        phase_timer.lap("result_gathering" if rank == 0 else "noise_evaluations") # (in the workers, the whole time in the executor context is spent on the tasks)
             
             
+        if rank == 0 and dedicated_evaluation_rank:
+            # Log the results of the evaluations finished in the meantime
+            while evaluation_comm.iprobe(source=evaluation_rank, tag=funcs.EVALUATION_RESULT_TAG):
+                evaluated_iteration, evaluation_result, evaluation_runtime = evaluation_comm.recv(source=evaluation_rank, tag=funcs.EVALUATION_RESULT_TAG)
+                del unevaluated_models[evaluated_iteration]
+                log_evaluation_result(evaluated_iteration, evaluation_result, evaluation_runtime, f"Running iteration {iteration+1}")
+            
         if rank == 0:
-            # Logging - fitness + runtime
+            # Logging - fitness + runtime (either as text rows, or as binary ones)
+            log_iteration_population_data = funcs.log_iteration_population_data if population_log_format == "csv" else funcs.log_iteration_population_data_binary
+            
             ## Fitness
-            funcs.log_iteration_population_data(fitness_path, fitness_of_plus_noises, fitness_of_minus_noises)
+            log_iteration_population_data(fitness_path, fitness_of_plus_noises, fitness_of_minus_noises)
 
             ## Runtime
-            funcs.log_iteration_population_data(runtime_path, runtime_last_iteration_of_plus_noises, runtime_last_iteration_of_minus_noises)
+            log_iteration_population_data(runtime_path, runtime_last_iteration_of_plus_noises, runtime_last_iteration_of_minus_noises, evaluated_tasks if straggler_cutoff_fraction is not None else None)
 
             # Change fitness to the score / weight for update.
-            modified_fitnesses = fitness_of_plus_noises - fitness_of_minus_noises
-            modified_fitnesses[modified_fitnesses.argsort()] = np.arange(size_of_population) # From interval [0, size_of_population-1]
-            modified_fitnesses /= (size_of_population - 1) # From interval [0,1]
-            modified_fitnesses *= 2 # From interval [0,2]
-            modified_fitnesses -= 1 # From interval [-1,1]
-            pm.rank_weights[:] = modified_fitnesses
+            if straggler_cutoff_fraction is not None:
+                # Only the evaluated tasks are ranked, the cancelled ones get zero weight
+                ## The weights are scaled up, so that the update is normalized by the number of the evaluated tasks instead of the whole population
+                num_of_evaluated_tasks = np.count_nonzero(evaluated_tasks)
+                modified_fitnesses = (fitness_of_plus_noises - fitness_of_minus_noises)[evaluated_tasks]
+                modified_fitnesses[modified_fitnesses.argsort()] = np.arange(num_of_evaluated_tasks) # From interval [0, num_of_evaluated_tasks-1]
+                modified_fitnesses /= max(num_of_evaluated_tasks - 1, 1) # From interval [0,1]
+                modified_fitnesses *= 2 # From interval [0,2]
+                modified_fitnesses -= 1 # From interval [-1,1]
+                pm.rank_weights[:] = 0
+                pm.rank_weights[evaluated_tasks] = modified_fitnesses * (size_of_population / num_of_evaluated_tasks)
+                
+                # Logging - cutoff
+                with open(cutoff_path, "a") as log:
+                    log.write(f"{num_of_evaluated_tasks}\t{size_of_population - num_of_evaluated_tasks}\n")
+                
+            else:
+                num_of_evaluated_tasks = size_of_population
+                modified_fitnesses = fitness_of_plus_noises - fitness_of_minus_noises
+                modified_fitnesses[modified_fitnesses.argsort()] = np.arange(size_of_population) # From interval [0, size_of_population-1]
+                modified_fitnesses /= (size_of_population - 1) # From interval [0,1]
+                modified_fitnesses *= 2 # From interval [0,2]
+                modified_fitnesses -= 1 # From interval [-1,1]
+                pm.rank_weights[:] = modified_fitnesses
+                
+            phase_timer.lap("ranking_and_logging")
             
         # Share scores / weights for the individual noises and the VBN-stats update values
         comm.Bcast(pm.rank_weights)
         comm.Bcast(pm.sum_of_encountered_states)
         comm.Bcast(pm.sum_of_squares_of_encountered_states)
         pm.count_of_encountered_states = comm.bcast(pm.count_of_encountered_states)
+        phase_timer.lap("weights_and_vbn_broadcast")
     
     
         # Synchronization barrier after the evaluation phase and before the model update phase
         comm.Barrier()
+        phase_timer.lap("barrier")
         
         
         # --- Model update phase ---
         
-        # Update the model
+        # Update the model (either each process goes through the whole population, or just through its own slice of it, the results being then summed up across the processes)
         funcs.update(
             weight_decay_factor,
             noise_deviation,
-            batch_size,
+            comm if sharded_update else None
         )
+        phase_timer.lap("update")
             
         # Update max_runtime and share it
         if rank == 0:
             total_runtime_last_iteration = np.sum(runtime_last_iteration_of_plus_noises) + np.sum(runtime_last_iteration_of_minus_noises)
-            pm.max_runtime = total_runtime_last_iteration // size_of_population # = twice the mean number of steps taken per episode
+            if num_of_evaluated_tasks < size_of_population:
+                # (the tasks evaluated before the straggler cutoff are the ones with the shortest episodes, so their mean is biased low - it is never used
+                # to shrink max_runtime, as it would otherwise ratchet down and cut off exactly the long episodes)
+                pm.max_runtime = max(pm.max_runtime, total_runtime_last_iteration // num_of_evaluated_tasks)
+            else:
+                pm.max_runtime = total_runtime_last_iteration // num_of_evaluated_tasks # = twice the mean number of steps taken per episode
             
         pm.max_runtime = comm.bcast(pm.max_runtime)
+        phase_timer.lap("max_runtime_broadcast")
 
 
         # Synchronization barrier after the model update phase marking the end of an iteration
         comm.Barrier()
+        phase_timer.lap("barrier")
+        
+        if log_phase_timings:
+            # Gather the statistics of the noise evaluations from the workers (their environment steps, time spent in the environments and in the model, throughput)
+            worker_statistics = comm.gather(profiling.get_evaluation_statistics(phase_timer.durations.get("noise_evaluations", 0.)) if rank > 0 else None, root=0)
+            
+            if rank == 0:
+                profiling.log_phase_timings(phase_timings_path, iteration, phase_timer.durations, worker_statistics[1:])
             
             
         if rank == 0:
@@ -306,26 +590,58 @@ def es(
                 log.write(str(iteration_duration) + "\n")
             
             
+            # Save the whole run state, so that the training can be resumed after this iteration
+            ## (with the dedicated evaluation process, the evaluations still running are not waited for - their models are saved instead and evaluated again after resuming)
+            if run_state_checkpoint_interval is not None and (iteration + 1) % run_state_checkpoint_interval == 0:
+                funcs.save_run_state(run_state_path, {
+                    "iteration": iteration + 1,
+                    "main_seed": main_seed,
+                    "model": pm.model.state_dict(),
+                    "vbn_stats": pm.model.vbn_stats,
+                    "optimizer": pm.model.optimizer.state_dict() if pm.model.optimizer is not None else None,
+                    "max_runtime": pm.max_runtime,
+                    "best_yet_iteration": best_yet_iteration,
+                    "best_return_yet": best_return_yet,
+                    "corresponding_runtime": corresponding_runtime,
+                    "random_state": (random.getstate(), np.random.get_state(), torch.get_rng_state()),
+                    "test_environment": pm.test_environment,
+                    "unevaluated_models": dict(unevaluated_models) if dedicated_evaluation_rank else dict(),
+                    "sizes_of_logs": dict(((path, os.path.getsize(path)) for path in [evaluation_path, evaluation_csv_path, fitness_path, runtime_path, time_path, cutoff_path, phase_timings_path] if os.path.exists(path)))
+                })
+            
+            
             progress_bar.update(1)
                 
         
+    if pm.test_environment_batch is not None:
+        pm.test_environment_batch.close()
+    
     if rank == 0:
         progress_bar.set_description(f"Running the last evaluation | Best yet evaluation result (mean runtime)" + \
             f"being obtained after iteration {best_yet_iteration} - {best_return_yet:.4f} ({corresponding_runtime})")
         
         # Final evaluation and saving of the resulting model
-        last_evaluation_result, last_evaluation_runtime = funcs.evaluate_and_possibly_save(
-            pm.model,
-            pm.test_environment,
-            best_return_yet,
-            10,
-            path_for_checkpoints
-        )
-
-        if last_evaluation_result >= best_return_yet:
-            best_return_yet = last_evaluation_result
-            corresponding_runtime = last_evaluation_runtime
-            best_yet_iteration = num_of_iterations
+        if dedicated_evaluation_rank:
+            # Send the final model to the evaluation process, stop it and wait for the results of all the remaining evaluations
+            unevaluated_models[num_of_iterations] = funcs.get_model_snapshot(pm.model)
+            pending_evaluation_requests.append(funcs.send_model_for_evaluation(evaluation_comm, evaluation_rank, num_of_iterations, unevaluated_models[num_of_iterations]))
+            pending_evaluation_requests.append(evaluation_comm.isend(None, dest=evaluation_rank, tag=funcs.EVALUATION_REQUEST_TAG))
+            
+            for _ in range(len(unevaluated_models)):
+                log_evaluation_result(*evaluation_comm.recv(source=evaluation_rank, tag=funcs.EVALUATION_RESULT_TAG), "Running the last evaluation")
+                
+            MPI.Request.waitall(pending_evaluation_requests)
+            
+        else:
+            last_evaluation_result, last_evaluation_runtime = funcs.evaluate_and_possibly_save(
+                pm.model,
+                pm.test_environment,
+                best_return_yet,
+                10,
+                path_for_checkpoints
+            )
+            
+            log_evaluation_result(num_of_iterations, last_evaluation_result, last_evaluation_runtime, "Running the last evaluation")
 
         pm.model.save_parameters(path_for_checkpoints, "final_model")
 
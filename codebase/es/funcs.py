@@ -4,9 +4,16 @@ from . import process_memory as pm
 from es_utilities import utils
 
 import random
+import os
+import time
 from collections import namedtuple
 
 import numpy as np
+import torch
+
+
+EVALUATION_REQUEST_TAG = 21
+EVALUATION_RESULT_TAG = 22
 
 
 NoiseEvaluationResult = namedtuple(
@@ -66,18 +73,61 @@ def noise_evaluations(
     
     return NoiseEvaluationResult(task_index, fitness1, runtime1, fitness2, runtime2, sum_, sum_of_squares, count)
 
+
+def batched_noise_evaluations(
+    task_indices,
+    seed
+):
+    utils.set_seed(seed)
     
-def evaluation(
-    num_of_episodes,
-    test_model,
+    # Get noises according to the task indices and the corresponding perturbed parameters (+noise and -noise for each task)
+    noises = [utils.get_noise(pm.model, pm.shared_noise_table, pm.seed_array[task_index]) for task_index in task_indices]
+    perturbed_parameters = utils.get_batch_of_perturbed_parameters(pm.model, noises)
+    
+    # Run all of them at once, each in its own copy of the test environment
+    update_vbn_stats = [(random.random() < pm.update_vbn_stats_probability) for _ in range(2 * len(task_indices))]
+    if pm.test_environment_batch is not None:
+        # The copies run in subprocesses and the evaluation is pipelined (the other test models are there just to keep the inner batched states of their groups)
+        pm.test_environment_batch.set_seed(range(2 * len(task_indices)), seed)
+        for test_model in pm.test_models[1:]:
+            test_model.vbn_stats = pm.model.vbn_stats
+        fitnesses, runtimes, sums, sums_of_squares, counts = pipelined_batched_evaluation(pm.test_models, perturbed_parameters, pm.test_environment_batch, pm.max_runtime, update_vbn_stats)
+        
+    else:
+        test_environments = pm.test_environments[:2 * len(task_indices)]
+        for test_environment in test_environments:
+            test_environment.set_seed(seed)
+        fitnesses, runtimes, sums, sums_of_squares, counts = batched_evaluation(pm.model, perturbed_parameters, test_environments, pm.max_runtime, update_vbn_stats)
+    
+    results = list()
+    for i, task_index in enumerate(task_indices):
+        sum1, sum_of_squares1, count1 = sums[2*i], sums_of_squares[2*i], counts[2*i]
+        sum2, sum_of_squares2, count2 = sums[2*i + 1], sums_of_squares[2*i + 1], counts[2*i + 1]
+        
+        if sum1 is None:
+            sum_ = sum2
+            sum_of_squares = sum_of_squares2
+            count = count2
+            
+        elif sum2 is None:
+            sum_ = sum1
+            sum_of_squares = sum_of_squares1
+            count = count1
+            
+        else:
+            sum_ = sum1 + sum2
+            sum_of_squares = sum_of_squares1 + sum_of_squares2
+            count = count1 + count2
+            
+        results.append(NoiseEvaluationResult(task_index, fitnesses[2*i], runtimes[2*i], fitnesses[2*i + 1], runtimes[2*i + 1], sum_, sum_of_squares, count))
+    
+    return results
+
+
+def get_max_timestep(
     test_environment,
-    max_runtime,
-    store_vbn_stats
+    max_runtime
 ):
-    episode_returns, episode_lengths = list(), list()
-    if store_vbn_stats:
-        observed_states = list()
-    
     if test_environment.timestep_limit is not None:
         if max_runtime is not None:
             max_timestep = min(test_environment.timestep_limit, max_runtime)
@@ -88,6 +138,23 @@ def evaluation(
             max_timestep = max_runtime
         else:
             max_timestep = int(1e18) # It's just, who would need or even want more timesteps then this...?
+            
+    return max_timestep
+
+    
+def evaluation(
+    num_of_episodes,
+    test_model,
+    test_environment,
+    max_runtime,
+    store_vbn_stats
+):
+    episode_returns, episode_lengths = list(), list()
+    if store_vbn_stats:
+        observed_states = list()
+    
+    max_timestep = get_max_timestep(test_environment, max_runtime)
+    collect_statistics = pm.collect_evaluation_statistics # (the per-step timing is done only if it is logged)
     
     for episode in range(num_of_episodes):
         episode_return, episode_length = 0, 0
@@ -95,16 +162,26 @@ def evaluation(
         state = test_environment.reset()
         
         for timestep in range(max_timestep):
+            if collect_statistics:
+                start_time = time.perf_counter()
             action = test_model.choose_action(state)
+            if collect_statistics:
+                model_forward_end_time = time.perf_counter()
+            
+            # (copied before the step, as the environment may return its states as views into its own buffers, which the step overwrites)
+            if store_vbn_stats:
+                observed_states.append(np.array(state))
 
             next_state, reward, terminated, truncated = test_environment.step(action)
             done = terminated or truncated
+            
+            if collect_statistics:
+                pm.model_forward_time += model_forward_end_time - start_time
+                pm.environment_step_time += time.perf_counter() - model_forward_end_time
+                pm.num_of_environment_steps += 1
 
             test_model.update_after_step(state, next_state, action, reward, terminated, truncated)
             
-            if store_vbn_stats:
-                observed_states.append(state)
-            
             state = next_state
 
             episode_return += reward
@@ -132,28 +209,203 @@ def evaluation(
     return mean_return, mean_length, sum_, sum_of_squares, count
 
 
+def batched_evaluation(
+    test_model,
+    parameters,
+    test_environments,
+    max_runtime,
+    store_vbn_stats
+):
+    # One episode for each set of parameters (stacked along the first dimension), all of the episodes being run in lockstep
+    batch_size = len(test_environments)
+    episode_returns, episode_lengths = [0] * batch_size, [0] * batch_size
+    observed_states = [list() for _ in range(batch_size)]
+    
+    max_timestep = get_max_timestep(test_environments[0], max_runtime)
+    collect_statistics = pm.collect_evaluation_statistics # (the per-step timing is done only if it is logged)
+    
+    test_model.reset_batched_inner_state(batch_size)
+    states = [test_environment.reset() for test_environment in test_environments]
+    running_episodes = list(range(batch_size))
+    running_parameters = parameters
+    
+    for timestep in range(max_timestep):
+        if collect_statistics:
+            start_time = time.perf_counter()
+        actions = test_model.choose_batched_actions([states[i] for i in running_episodes], running_parameters, running_episodes)
+        if collect_statistics:
+            model_forward_end_time = time.perf_counter()
+            pm.model_forward_time += model_forward_end_time - start_time
+        
+        current_states, next_states, rewards, terminated, truncated = list(), list(), list(), list(), list()
+        for i, action in zip(running_episodes, actions):
+            # (copied before the step, as the environment may return its states as views into its own buffers, which the step overwrites)
+            if store_vbn_stats[i]:
+                observed_states[i].append(np.array(states[i]))
+            current_states.append(states[i])
+            
+            next_state, reward, current_terminated, current_truncated = test_environments[i].step(action)
+            
+            next_states.append(next_state)
+            rewards.append(reward)
+            terminated.append(current_terminated)
+            truncated.append(current_truncated)
+            
+            states[i] = next_state
+            
+            episode_returns[i] += reward
+            episode_lengths[i] += 1
+            
+        if collect_statistics:
+            pm.environment_step_time += time.perf_counter() - model_forward_end_time
+            pm.num_of_environment_steps += len(running_episodes)
+        
+        test_model.update_after_batched_step(current_states, next_states, actions, rewards, terminated, truncated, running_episodes)
+        
+        # Drop the finished episodes (together with their parameters) from the batch
+        still_running = [j for j in range(len(running_episodes)) if not (terminated[j] or truncated[j])]
+        if len(still_running) < len(running_episodes):
+            running_episodes = [running_episodes[j] for j in still_running]
+            running_parameters = dict(((name, param[still_running]) for (name, param) in running_parameters.items()))
+        
+        if len(running_episodes) == 0:
+            break
+    
+    sums, sums_of_squares, counts = get_vbn_stats_of_batch(observed_states, store_vbn_stats)
+    
+    return episode_returns, episode_lengths, sums, sums_of_squares, counts
+
+
+def pipelined_batched_evaluation(
+    test_models,
+    parameters,
+    test_environment_batch,
+    max_runtime,
+    store_vbn_stats
+):
+    # Variant of batched_evaluation for the environments running in subprocesses (see SubprocessEnvironmentBatch) - the batch is split into as many groups
+    # as there are test models (each of them keeping the inner batched state of its group), so that the forward pass for one of the groups overlaps
+    # the stepping of the environments of the others
+    batch_size = len(store_vbn_stats)
+    episode_returns, episode_lengths = [0] * batch_size, [0] * batch_size
+    observed_states = [list() for _ in range(batch_size)]
+    
+    max_timestep = get_max_timestep(test_environment_batch, max_runtime)
+    collect_statistics = pm.collect_evaluation_statistics # (the per-step timing is done only if it is logged)
+    
+    groups = [list(group) for group in np.array_split(np.arange(batch_size), len(test_models))]
+    states = test_environment_batch.reset(range(batch_size))
+    
+    ## For each group the running episodes (indices into the whole batch and into the group), their parameters, the number of steps taken
+    ## and the states and actions of the step being taken (if any)
+    running_episodes, running_episodes_in_group, running_parameters, timesteps, steps_being_taken = list(), list(), list(), list(), list()
+    for test_model, group in zip(test_models, groups):
+        test_model.reset_batched_inner_state(len(group))
+        running_episodes.append(group)
+        running_episodes_in_group.append(list(range(len(group))))
+        running_parameters.append(dict(((name, param[group]) for (name, param) in parameters.items())))
+        timesteps.append(0)
+        steps_being_taken.append(None)
+    
+    while True:
+        for g, test_model in enumerate(test_models):
+            if steps_being_taken[g] is not None:
+                # Finish the step of the group
+                current_states, actions = steps_being_taken[g]
+                if collect_statistics:
+                    start_time = time.perf_counter()
+                next_states, rewards, terminated, truncated = test_environment_batch.step_wait(running_episodes[g])
+                if collect_statistics:
+                    pm.environment_step_time += time.perf_counter() - start_time
+                    pm.num_of_environment_steps += len(running_episodes[g])
+                
+                for i, next_state, reward in zip(running_episodes[g], next_states, rewards):
+                    if store_vbn_stats[i]:
+                        observed_states[i].append(states[i])
+                    
+                    states[i] = next_state
+                    
+                    episode_returns[i] += reward
+                    episode_lengths[i] += 1
+                    
+                test_model.update_after_batched_step(current_states, next_states, actions, rewards, terminated, truncated, running_episodes_in_group[g])
+                steps_being_taken[g] = None
+                timesteps[g] += 1
+                
+                # Drop the finished episodes (together with their parameters) from the group
+                still_running = [j for j in range(len(running_episodes[g])) if not (terminated[j] or truncated[j])]
+                if len(still_running) < len(running_episodes[g]):
+                    running_episodes[g] = [running_episodes[g][j] for j in still_running]
+                    running_episodes_in_group[g] = [running_episodes_in_group[g][j] for j in still_running]
+                    running_parameters[g] = dict(((name, param[still_running]) for (name, param) in running_parameters[g].items()))
+            
+            if len(running_episodes[g]) > 0 and timesteps[g] < max_timestep:
+                # Start the next step of the group (its environments are then stepped while the other groups are being processed)
+                if collect_statistics:
+                    start_time = time.perf_counter()
+                current_states = [states[i] for i in running_episodes[g]]
+                actions = test_model.choose_batched_actions(current_states, running_parameters[g], running_episodes_in_group[g])
+                if collect_statistics:
+                    pm.model_forward_time += time.perf_counter() - start_time
+                
+                test_environment_batch.step_async(running_episodes[g], actions)
+                steps_being_taken[g] = (current_states, actions)
+        
+        if all(step_being_taken is None for step_being_taken in steps_being_taken):
+            break
+    
+    sums, sums_of_squares, counts = get_vbn_stats_of_batch(observed_states, store_vbn_stats)
+    
+    return episode_returns, episode_lengths, sums, sums_of_squares, counts
+
+
+def get_vbn_stats_of_batch(
+    observed_states,
+    store_vbn_stats
+):
+    sums, sums_of_squares, counts = list(), list(), list()
+    for i in range(len(observed_states)):
+        if store_vbn_stats[i]:
+            current_observed_states = np.array([np.array(o) for o in observed_states[i]])
+            sums.append(current_observed_states.sum(axis=0))
+            sums_of_squares.append(np.square(current_observed_states).sum(axis=0))
+            counts.append(len(current_observed_states))
+        else:
+            sums.append(None)
+            sums_of_squares.append(None)
+            counts.append(None)
+            
+    return sums, sums_of_squares, counts
+
+
 def update(
     weight_decay_factor,
     noise_deviation,
-    batch_size
+    comm=None
 ):
-    # Get and weight noises
-    noises = list()
-    for task_index in range(len(pm.seed_array)):
+    # If comm is given, each process handles just its own slice of the population and the partial sums are then summed up across all the processes
+    if comm is not None:
+        task_indices = np.array_split(np.arange(len(pm.seed_array)), comm.Get_size())[comm.Get_rank()]
+    else:
+        task_indices = range(len(pm.seed_array))
+    
+    # Get and weight noises, accumulating them in a single pass (the noises are just views into the shared noise table, so no other tensors are allocated)
+    combined_noise = utils.get_zero_noise(pm.model)
+    for task_index in task_indices:
+        if pm.rank_weights[task_index] == 0: # (e.g. the tasks cancelled by the straggler cutoff)
+            continue
         current_noise = utils.get_noise(pm.model, pm.shared_noise_table, pm.seed_array[task_index])
-        rank_weight = pm.rank_weights[task_index]
-        noises.append(utils.get_weighted_noise(rank_weight, current_noise))
-        if len(noises) >= batch_size:
-            combined_noise = utils.get_combined_noises(noises)
-            noises = [combined_noise]
-    combined_noise = utils.get_combined_noises(noises)
+        utils.accumulate_weighted_noise(combined_noise, float(pm.rank_weights[task_index]), current_noise)
+        
+    if comm is not None:
+        combined_noise = sum_noise_across_processes(comm, combined_noise)
     
     # Update the model by combined noises
     ## The combined noise is to be divided by the number of individuals evaluated and the noise deviation squared.
     ## That is because in the original paper they divide by the number of individuals evaluated and the noise deviation, but use noise drawn from distribution with sd=1 (and only scale it during evaluation).
     ## We, on the other hand, use noise drawn from distribution with other sd, which is basically noise drawn with sd=1 multiplied by our sd. Hence we have to divide this excess sd.
     combined_noise = utils.get_weighted_noise(1 / (2 * len(pm.seed_array) * (noise_deviation ** 2)), combined_noise)
-    pm.model.optimizer.update(combined_noise)
+    pm.model.optimizer.update(combined_noise, pm.model.flat_parameters)
         
     # Weight decay
     utils.decay_weights(weight_decay_factor, pm.model)
@@ -166,6 +418,29 @@ def update(
     )
 
 
+def sum_noise_across_processes(
+    comm,
+    noise
+):
+    from mpi4py import MPI
+    
+    # The noise is summed up as one flat buffer in a single allreduce
+    if isinstance(noise, torch.Tensor):
+        comm.Allreduce(MPI.IN_PLACE, noise.numpy(), op=MPI.SUM)
+        return noise
+    
+    flat_noise = torch.cat([noise[key].reshape(-1) for key in noise])
+    comm.Allreduce(MPI.IN_PLACE, flat_noise.numpy(), op=MPI.SUM)
+    
+    summed_noise = dict()
+    offset = 0
+    for key in noise:
+        summed_noise[key] = flat_noise[offset:offset + noise[key].numel()].view_as(noise[key])
+        offset += noise[key].numel()
+        
+    return summed_noise
+
+
 def evaluate_and_possibly_save(
     model,
     test_environment,
@@ -181,13 +456,114 @@ def evaluate_and_possibly_save(
     return last_evaluation_result, last_evaluation_runtime
 
 
+def get_model_snapshot(
+    model
+):
+    # Copy of the parameters and the VBN stats, which is not changed along with the model
+    return ({name: tensor.clone() for name, tensor in model.state_dict().items()}, (model.vbn_stats.mean, model.vbn_stats.std, model.vbn_stats.count))
+
+
+def send_model_for_evaluation(
+    comm,
+    evaluation_rank,
+    iteration,
+    snapshot
+):
+    # Non-blocking - the message (a snapshot of the model, see get_model_snapshot) is pickled right away
+    return comm.isend((iteration, snapshot), dest=evaluation_rank, tag=EVALUATION_REQUEST_TAG)
+
+
+def run_evaluations_of_received_models(
+    comm,
+    model,
+    test_environment,
+    num_of_episodes,
+    path_for_checkpoints,
+    best_return_yet=-float("inf")
+):
+    # Loop of the dedicated evaluation process - evaluates the received models one by one (in the order of their sending), until None is received
+    while True:
+        message = comm.recv(source=0, tag=EVALUATION_REQUEST_TAG)
+        if message is None:
+            break
+            
+        iteration, (state_dict, (mean, std, count)) = message
+        model.load_state_dict(state_dict)
+        model.vbn_stats.set(mean, std, count)
+        
+        evaluation_result, evaluation_runtime = evaluate_and_possibly_save(model, test_environment, best_return_yet, num_of_episodes, path_for_checkpoints)
+        best_return_yet = max(best_return_yet, evaluation_result)
+        
+        comm.send((iteration, evaluation_result, evaluation_runtime), dest=0, tag=EVALUATION_RESULT_TAG)
+
+
+def save_run_state(
+    path,
+    run_state
+):
+    # Saved into a temporary file first and then moved in place, so that there is always a complete run state to resume from
+    temporary_path = path + ".tmp"
+    torch.save(run_state, temporary_path)
+    os.replace(temporary_path, path)
+
+
+def load_run_state(
+    path
+):
+    return torch.load(path, map_location=torch.device('cpu'), weights_only=False)
+
+
 def log_iteration_population_data(
     path,
     data_to_log1,
-    data_to_log2
+    data_to_log2,
+    evaluated_tasks=None
 ):
+    # If evaluated_tasks (a mask) is given, nan is logged for the tasks which were not evaluated
+    if evaluated_tasks is not None:
+        data_to_log1 = [data if evaluated else float("nan") for data, evaluated in zip(data_to_log1, evaluated_tasks)]
+        data_to_log2 = [data if evaluated else float("nan") for data, evaluated in zip(data_to_log2, evaluated_tasks)]
+        
     with open(path, "a") as log:
         log.write(str(data_to_log1[0]) + ";" + str(data_to_log2[0]))
         for i in range(1, len(data_to_log1)):
             log.write(";" + str(data_to_log1[i]) + ";" + str(data_to_log2[i]))
         log.write("\n")
+
+
+def log_iteration_population_data_binary(
+    path,
+    data_to_log1,
+    data_to_log2,
+    evaluated_tasks=None
+):
+    # Binary alternative to log_iteration_population_data - the iteration is appended as one row of 32-bit floats (ordered the same way as in the csv: 0+, 0-, 1+, 1-, ...)
+    # into an .npy file in a single write, the number of rows in the header of the file being updated after each append (so the log can be memory-mapped by np.load)
+    row = np.empty(2 * len(data_to_log1), dtype="<f4")
+    row[0::2] = data_to_log1
+    row[1::2] = data_to_log2
+    
+    # If evaluated_tasks (a mask) is given, nan is logged for the tasks which were not evaluated
+    if evaluated_tasks is not None:
+        row[0::2][~evaluated_tasks] = np.nan
+        row[1::2][~evaluated_tasks] = np.nan
+    
+    if not os.path.exists(path):
+        with open(path, "wb") as log:
+            np.lib.format.write_array_header_1_0(log, {"descr": row.dtype.str, "fortran_order": False, "shape": (0, len(row))})
+    
+    with open(path, "r+b") as log:
+        np.lib.format.read_magic(log)
+        np.lib.format.read_array_header_1_0(log)
+        data_offset = log.tell()
+        
+        # The number of rows is given by the size of the file (so it is right also when the log was cut off when resuming)
+        num_of_rows = (os.path.getsize(path) - data_offset) // row.nbytes
+        log.seek(data_offset + num_of_rows * row.nbytes)
+        log.write(row.tobytes())
+        log.truncate()
+        
+        # (the header is padded, so that the number of rows can grow without changing its length)
+        log.seek(0)
+        np.lib.format.write_array_header_1_0(log, {"descr": row.dtype.str, "fortran_order": False, "shape": (num_of_rows + 1, len(row))})
+        assert log.tell() == data_offset
@@ -5,6 +5,13 @@ model = None
 test_model = None
 test_environment = None
 
+# Copies of the test environment for the batched evaluation of several noises at once (in lockstep)
+test_environments = None
+
+# The copies running in subprocesses for the pipelined batched evaluation (see funcs.pipelined_batched_evaluation) and the models keeping the inner batched states of its groups
+test_environment_batch = None
+test_models = None
+
 # Shared noise table
 shared_noise_table = None
 
@@ -21,4 +28,10 @@ rank_weights = None
 update_vbn_stats_probability = None
 sum_of_encountered_states = None
 sum_of_squares_of_encountered_states = None
-count_of_encountered_states = None
\ No newline at end of file
+count_of_encountered_states = None
+
+# Statistics of the evaluations (for the per-phase timing, collected only if it is logged)
+collect_evaluation_statistics = False
+num_of_environment_steps = 0
+environment_step_time = 0.
+model_forward_time = 0.
@@ -0,0 +1,47 @@
+# Lightweight per-phase timing of the iterations of the es (logged as one JSON object per iteration).
+
+import json
+import time
+
+from . import process_memory as pm
+
+
+class PhaseTimer:
+    # Measures wall-clock durations of consecutive phases of an iteration - each call of lap ends the current phase (recorded under the given name) and starts the next one
+    # (when the same name is used more than once in an iteration, the durations are summed up)
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.restart()
+
+    def restart(self):
+        self.durations = dict()
+        self.last_time = time.perf_counter()
+
+    def lap(self, phase_name):
+        if not self.enabled:
+            return
+
+        current_time = time.perf_counter()
+        self.durations[phase_name] = self.durations.get(phase_name, 0.) + current_time - self.last_time
+        self.last_time = current_time
+
+
+def reset_evaluation_statistics():
+    pm.num_of_environment_steps = 0
+    pm.environment_step_time = 0.
+    pm.model_forward_time = 0.
+
+
+def get_evaluation_statistics(compute_time): # Statistics of the evaluations done by this process since the last reset (compute_time being the wall-clock time spent on them)
+    return {
+        "compute_time": compute_time,
+        "environment_steps": pm.num_of_environment_steps,
+        "environment_step_time": pm.environment_step_time,
+        "model_forward_time": pm.model_forward_time,
+        "environment_steps_per_second": pm.num_of_environment_steps / compute_time if compute_time > 0 else float("nan")
+    }
+
+
+def log_phase_timings(path, iteration, phase_durations, worker_statistics):
+    with open(path, "a") as log:
+        log.write(json.dumps({"iteration": iteration, "phases": phase_durations, "workers": worker_statistics}) + "\n")
@@ -0,0 +1,209 @@
+# Chunked scheduling of the noise evaluation tasks among the workers (an alternative to mapping the tasks one by one through the MPICommExecutor).
+
+from mpi4py import MPI
+
+import threading
+
+import numpy as np
+
+from . import funcs
+from . import process_memory as pm
+
+
+TASK_REQUEST_TAG = 11
+TASK_CHUNK_TAG = 12
+TASK_CANCEL_TAG = 13
+
+TARGET_STEPS_PER_CHUNK = 20000 # Roughly how many environment steps should a chunk of tasks take in the dynamic scheduling
+NUM_OF_RESULT_COLUMNS = 5 # Task index, fitness of +noise, runtime of +noise, fitness of -noise, runtime of -noise
+
+
+class ChunkedTaskScheduler:
+    # Used the same way as the MPICommExecutor - the context is entered by all the processes, but only in the master it returns the scheduler,
+    # the workers just process their tasks (before returning None) and the master then gets all of their results at once by gather_results.
+    # In the static scheduling each worker gets one contiguous chunk of the tasks right away, in the dynamic one the workers keep asking the master for chunks of tasks,
+    # the size of which adapts to the episode lengths observed so far (and gets smaller as the remaining tasks run out).
+    # The results are not sent per task, but packed into a single numpy array per worker, and the VBN stats are summed up already in the workers.
+    # With the dynamic scheduling, a straggler cutoff can be set - once the given fraction of the tasks is finished, the rest of the tasks not yet handed out is cancelled
+    # and so are the remaining tasks of the chunks still being evaluated - the workers check for the cancellation after each task (or batch of tasks), so the iteration
+    # waits at most for the tasks in progress, not for whole straggling chunks (the results of all the cancelled tasks are missing in the gathered ones).
+    # (The cancellation message carries the seed of the iteration, so that a worker which has already finished its tasks in the iteration just discards it in the next one.)
+    def __init__(self, comm, num_of_tasks, seed, evaluation_batch_size=1, dynamic=True, cutoff_fraction=None):
+        self.comm = comm
+        self.num_of_tasks = num_of_tasks
+        self.seed = seed
+        self.evaluation_batch_size = evaluation_batch_size
+        self.dynamic = dynamic
+        self.cutoff_fraction = cutoff_fraction
+        self.dispatcher = None
+        self.dispatcher_exception = None
+        self.results_gathered = False
+        self.cancel_request = None
+        self.cancelled = False
+
+    def __enter__(self):
+        if self.comm.Get_rank() == 0:
+            if self.dynamic:
+                # The chunks are handed out from a separate thread, so that the master can do something else in the meantime
+                self.dispatcher = threading.Thread(target=self._run_dispatcher)
+                self.dispatcher.start()
+
+            return self
+
+        self._work()
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.comm.Get_rank() == 0 and exc_type is None and not self.results_gathered:
+            self.gather_results()
+
+        return False
+
+    def gather_results(self): # Master only - waits for all the tasks and returns their packed results (a row per task, see NUM_OF_RESULT_COLUMNS) and the summed VBN stats
+        if self.dispatcher is not None:
+            self.dispatcher.join()
+
+            # (re-raised here, as an exception in the thread would not reach the excepthook aborting all the processes and the workers would wait for their chunks forever)
+            if self.dispatcher_exception is not None:
+                raise self.dispatcher_exception
+
+        results, sum_, sum_of_squares, count = self._gather(np.empty((0, NUM_OF_RESULT_COLUMNS)), np.zeros(pm.test_environment.state_shape), np.zeros(pm.test_environment.state_shape), 0)
+        self.results_gathered = True
+
+        return results, sum_, sum_of_squares, count
+
+    def _run_dispatcher(self):
+        try:
+            self._dispatch_chunks()
+        except Exception as exception:
+            self.dispatcher_exception = exception
+
+    def _dispatch_chunks(self):
+        num_of_workers = self.comm.Get_size() - 1
+        next_task_index, num_of_finished_workers = 0, 0
+        num_of_tasks_for_cutoff = int(np.ceil(self.cutoff_fraction * self.num_of_tasks)) if self.cutoff_fraction is not None else self.num_of_tasks
+
+        # Environment steps taken per task (it is two episodes per task), the initial estimate is taken from the last iteration
+        observed_steps, observed_tasks = 0, 0
+        steps_per_task = pm.max_runtime
+
+        status = MPI.Status()
+        cancel_requests = list()
+        while num_of_finished_workers < num_of_workers:
+            steps, tasks = self.comm.recv(source=MPI.ANY_SOURCE, tag=TASK_REQUEST_TAG, status=status)
+            observed_steps += steps
+            observed_tasks += tasks
+            if observed_tasks > 0:
+                steps_per_task = observed_steps / observed_tasks
+
+            if observed_tasks >= num_of_tasks_for_cutoff and next_task_index < self.num_of_tasks:
+                # Straggler cutoff - enough of the tasks is finished, the rest is cancelled (including the rest of the chunks being evaluated right now)
+                next_task_index = self.num_of_tasks
+                cancel_requests = [self.comm.isend(self.seed, dest=worker, tag=TASK_CANCEL_TAG) for worker in range(1, num_of_workers + 1)]
+
+            num_of_remaining_tasks = self.num_of_tasks - next_task_index
+            if num_of_remaining_tasks == 0:
+                self.comm.send(None, dest=status.Get_source(), tag=TASK_CHUNK_TAG)
+                num_of_finished_workers += 1
+                continue
+
+            chunk_size = max(1, min(int(TARGET_STEPS_PER_CHUNK // max(steps_per_task, 1)), num_of_remaining_tasks // (2 * num_of_workers)))
+            chunk_size = -(-chunk_size // self.evaluation_batch_size) * self.evaluation_batch_size # Whole batches for the batched evaluation
+            chunk_size = min(chunk_size, num_of_remaining_tasks)
+
+            self.comm.send((next_task_index, next_task_index + chunk_size), dest=status.Get_source(), tag=TASK_CHUNK_TAG)
+            next_task_index += chunk_size
+
+        MPI.Request.waitall(cancel_requests)
+
+    def _is_cancelled(self): # Whether the tasks of this iteration were cancelled by the straggler cutoff (the cancellations from the previous iterations are discarded)
+        # (a receive is kept posted for the cancellation, as the probing for a message may miss it even long after it has arrived)
+        while not self.cancelled:
+            if self.cancel_request is None:
+                self.cancel_request = self.comm.irecv(source=0, tag=TASK_CANCEL_TAG)
+
+            received, seed = self.cancel_request.test()
+            if not received:
+                break
+
+            self.cancel_request = None
+            self.cancelled = (seed == self.seed)
+
+        return self.cancelled
+
+    def _stop_waiting_for_cancellation(self):
+        if self.cancel_request is not None:
+            self.cancel_request.Cancel()
+            self.cancel_request.wait() # (if the cancellation arrived in the meantime, it is just discarded)
+            self.cancel_request = None
+
+    def _work(self):
+        results = list()
+
+        if self.dynamic:
+            steps, tasks = 0, 0
+            while True:
+                self.comm.send((steps, tasks), dest=0, tag=TASK_REQUEST_TAG)
+                chunk = self.comm.recv(source=0, tag=TASK_CHUNK_TAG)
+                if chunk is None:
+                    break
+
+                chunk_results = self._evaluate_tasks(range(*chunk))
+                steps, tasks = sum(result.runtime_of_plus_noise + result.runtime_of_minus_noise for result in chunk_results), len(chunk_results)
+                results.extend(chunk_results)
+
+        else:
+            worker_index, num_of_workers = self.comm.Get_rank() - 1, self.comm.Get_size() - 1
+            results = self._evaluate_tasks(np.array_split(np.arange(self.num_of_tasks), num_of_workers)[worker_index])
+
+        self._stop_waiting_for_cancellation()
+
+        # Pack the results
+        packed_results = np.array([
+            (result.task_index, result.fitness_of_plus_noise, result.runtime_of_plus_noise, result.fitness_of_minus_noise, result.runtime_of_minus_noise)
+            for result in results
+        ], dtype=np.float64).reshape(-1, NUM_OF_RESULT_COLUMNS)
+
+        sum_, sum_of_squares, count = np.zeros(pm.test_environment.state_shape), np.zeros(pm.test_environment.state_shape), 0
+        for result in results:
+            if result.sum_ is not None:
+                sum_ += np.reshape(result.sum_, pm.test_environment.state_shape)
+                sum_of_squares += np.reshape(result.sum_of_squares, pm.test_environment.state_shape)
+                count += result.count
+
+        self._gather(packed_results, sum_, sum_of_squares, count)
+
+    def _evaluate_tasks(self, task_indices):
+        task_indices = [int(task_index) for task_index in task_indices]
+
+        results = list()
+        for start in range(0, len(task_indices), self.evaluation_batch_size):
+            if self.cutoff_fraction is not None and self._is_cancelled():
+                break
+
+            if self.evaluation_batch_size > 1:
+                results.extend(funcs.batched_noise_evaluations(task_indices[start:start + self.evaluation_batch_size], self.seed))
+            else:
+                results.append(funcs.noise_evaluations(task_indices[start], self.seed))
+
+        return results
+
+    def _gather(self, packed_results, sum_, sum_of_squares, count): # Collective
+        is_master = (self.comm.Get_rank() == 0)
+
+        sizes = self.comm.gather(packed_results.size, root=0)
+        if is_master:
+            gathered_results = np.empty(sum(sizes), dtype=np.float64)
+            self.comm.Gatherv(packed_results.ravel(), [gathered_results, sizes], root=0)
+            gathered_results = gathered_results.reshape(-1, NUM_OF_RESULT_COLUMNS)
+        else:
+            self.comm.Gatherv(packed_results.ravel(), None, root=0)
+            gathered_results = None
+
+        summed_sum = np.zeros_like(sum_) if is_master else None
+        summed_sum_of_squares = np.zeros_like(sum_of_squares) if is_master else None
+        self.comm.Reduce(sum_, summed_sum, op=MPI.SUM, root=0)
+        self.comm.Reduce(sum_of_squares, summed_sum_of_squares, op=MPI.SUM, root=0)
+        summed_count = self.comm.reduce(count, op=MPI.SUM, root=0)
+
+        return gathered_results, summed_sum, summed_sum_of_squares, summed_count
@@ -0,0 +1,216 @@
+# Batches of environments (wrapped by the EsEnvironmentWrapper) stepped together, either one after another in the main process, or in parallel in its threads or in subprocesses
+
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class EnvironmentBatch:
+    # The environments are stepped one after another in the main process (indices select the environments of the batch to be reset or stepped)
+    def __init__(self, wrapped_environments):
+        self.wrapped_environments = list(wrapped_environments)
+
+    def __len__(self):
+        return len(self.wrapped_environments)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def reset(self, indices): # Returns just the new states
+        return [self.wrapped_environments[i].reset() for i in indices]
+
+    def set_seed(self, indices, seed):
+        for i in indices:
+            self.wrapped_environments[i].set_seed(seed)
+
+    def step(self, indices, actions): # Returns lists of next_states, rewards, terminated and truncated
+        return self._transpose([self.wrapped_environments[i].step(action) for i, action in zip(indices, actions)])
+
+    def close(self):
+        pass
+
+    @property
+    def state_shape(self):
+        return self.wrapped_environments[0].state_shape
+
+    @property
+    def timestep_limit(self):
+        return self.wrapped_environments[0].timestep_limit
+
+    @staticmethod
+    def _transpose(step_results):
+        next_states, rewards, terminated, truncated = list(), list(), list(), list()
+        for next_state, reward, current_terminated, current_truncated in step_results:
+            next_states.append(next_state)
+            rewards.append(reward)
+            terminated.append(current_terminated)
+            truncated.append(current_truncated)
+
+        return next_states, rewards, terminated, truncated
+
+
+class ThreadEnvironmentBatch(EnvironmentBatch):
+    # The environments are stepped in parallel by a pool of threads of the main process - meant for the environments releasing the GIL while stepping
+    # (like the ALE ones), as then there is no copying of the environments into subprocesses and no pickling of the states and actions.
+    # Each environment is reset or stepped by one task of the pool, so the environments themselves do not need to be thread-safe.
+    def __init__(self, wrapped_environments, num_of_threads=None):
+        super().__init__(wrapped_environments)
+
+        self.executor = ThreadPoolExecutor(max_workers=num_of_threads if num_of_threads is not None else len(self))
+
+    def reset(self, indices):
+        return list(self.executor.map(lambda i: self.wrapped_environments[i].reset(), indices))
+
+    def set_seed(self, indices, seed):
+        list(self.executor.map(lambda i: self.wrapped_environments[i].set_seed(seed), indices))
+
+    def step(self, indices, actions):
+        return self._transpose(self.executor.map(lambda i, action: self.wrapped_environments[i].step(action), indices, actions))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def _run_environment(connection, wrapped_environment, shared_buffers=None):
+    # Loop of the subprocess holding one of the environments (if the shared state and action buffers are given, the states and actions are passed through them,
+    # just the rest of the step results going through the pipe)
+    state, action = None, None
+    if shared_buffers is not None:
+        state, action = _get_views_into_shared_buffers(*shared_buffers)
+    
+    try:
+        while True:
+            command, argument = connection.recv()
+            if command == "reset":
+                if state is not None:
+                    state[...] = wrapped_environment.reset()
+                    connection.send(None)
+                else:
+                    connection.send(wrapped_environment.reset())
+            elif command == "step":
+                if state is not None:
+                    next_state, reward, terminated, truncated = wrapped_environment.step(action.copy())
+                    state[...] = next_state
+                    connection.send((None, reward, terminated, truncated))
+                else:
+                    connection.send(wrapped_environment.step(argument))
+            elif command == "set_seed":
+                wrapped_environment.set_seed(argument)
+            elif command == "close":
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connection.close()
+
+
+def _get_views_into_shared_buffers(state_buffer, state_dtype, state_shape, action_buffer, action_dtype, action_shape, index=None):
+    # (the raw buffers are what is passed to the subprocesses, as the numpy views would be pickled as copies with the spawn start method)
+    states = np.frombuffer(state_buffer, dtype=state_dtype).reshape((-1,) + tuple(state_shape))
+    actions = np.frombuffer(action_buffer, dtype=action_dtype).reshape((-1,) + tuple(action_shape))
+    
+    if index is not None:
+        return states[index], actions[index]
+    return states, actions
+
+
+class SubprocessEnvironmentBatch(EnvironmentBatch):
+    # Each of the environments runs in its own subprocess (it is sent there pickled, the local copies are kept just for the properties),
+    # so the environments of the batch are stepped in parallel - the commands are sent to all of them first and only then are the results collected.
+    # Stepping can also be split into step_async and step_wait (for any disjoint groups of the environments), so that the main process can do something else
+    # (e.g. a forward pass of the model for another group) in the meantime.
+    # With shared_memory, the states and actions are not pickled and sent through the pipes, but passed through buffers in shared memory
+    # (the shapes and dtypes of those are taken from the observation and action spaces of the environments, unless given).
+    def __init__(self, wrapped_environments, start_method=None, shared_memory=False, action_shape=None, action_dtype=None, state_dtype=None):
+        super().__init__(wrapped_environments)
+
+        context = multiprocessing.get_context(start_method)
+        
+        self.states, self.actions, shared_buffers = None, None, None
+        if shared_memory:
+            environment = self.wrapped_environments[0].env
+            state_dtype = np.dtype(state_dtype if state_dtype is not None else environment.observation_space.dtype)
+            action_shape = tuple(action_shape if action_shape is not None else environment.action_space.shape)
+            action_dtype = np.dtype(action_dtype if action_dtype is not None else environment.action_space.dtype)
+            
+            state_buffer = context.RawArray("b", len(self) * int(np.prod(self.state_shape)) * state_dtype.itemsize)
+            action_buffer = context.RawArray("b", len(self) * int(np.prod(action_shape)) * action_dtype.itemsize)
+            shared_buffers = (state_buffer, state_dtype, tuple(self.state_shape), action_buffer, action_dtype, action_shape)
+            self.states, self.actions = _get_views_into_shared_buffers(*shared_buffers)
+        
+        self.connections, self.processes = list(), list()
+        for i, wrapped_environment in enumerate(self.wrapped_environments):
+            connection, subprocess_connection = context.Pipe()
+            process = context.Process(target=_run_environment, args=(subprocess_connection, wrapped_environment, shared_buffers + (i,) if shared_memory else None), daemon=True)
+            process.start()
+            subprocess_connection.close()
+
+            self.connections.append(connection)
+            self.processes.append(process)
+
+        self.waiting_indices = list()
+
+    def reset(self, indices):
+        indices = list(indices)
+        for i in indices:
+            self.connections[i].send(("reset", None))
+
+        states = [self.connections[i].recv() for i in indices]
+        if self.states is not None:
+            states = [self.states[i].copy() for i in indices]
+            
+        return states
+
+    def set_seed(self, indices, seed):
+        for i in indices:
+            self.connections[i].send(("set_seed", seed))
+
+    def step_async(self, indices, actions):
+        indices = list(indices)
+        assert not any(i in self.waiting_indices for i in indices)
+
+        self.waiting_indices.extend(indices)
+        for i, action in zip(indices, actions):
+            if self.states is not None:
+                self.actions[i] = action
+                self.connections[i].send(("step", None))
+            else:
+                self.connections[i].send(("step", action))
+
+    def step_wait(self, indices=None): # Waits for the given environments (or all the stepped ones, in the order they were stepped in, if not given)
+        indices = list(self.waiting_indices) if indices is None else list(indices)
+        
+        step_results = [self.connections[i].recv() for i in indices]
+        self.waiting_indices = [i for i in self.waiting_indices if i not in indices]
+        
+        if self.states is not None:
+            step_results = [(self.states[i].copy(), reward, terminated, truncated) for i, (_, reward, terminated, truncated) in zip(indices, step_results)]
+
+        return self._transpose(step_results)
+
+    def step(self, indices, actions):
+        self.step_async(indices, actions)
+        return self.step_wait(indices)
+
+    def close(self):
+        if self.processes is None:
+            return
+
+        if len(self.waiting_indices) > 0:
+            self.step_wait()
+
+        for connection in self.connections:
+            connection.send(("close", None))
+            connection.close()
+
+        for process in self.processes:
+            process.join()
+
+        self.processes = None
@@ -1,5 +1,6 @@
 # Optimizers
 
+import copy
 import math
 import torch
 
@@ -7,23 +8,47 @@ from . import utils
 
 
 class Optimizer:
+    # Names of the attributes holding the memory of the optimizer (dictionaries of tensors, or flat vectors in the flat parameter mode)
+    memory_attributes = ()
+    
     def __init__(self, model, learning_rate):
         self.model = model
         self.learning_rate = learning_rate
 
-    def update(self, noise_to_add):
+    def update(self, noise_to_add, flat_parameters=None):
+        if flat_parameters is not None:
+            # Flat parameter mode (see EsModelWrapper.flatten_parameters) - the noise is a flat vector as well
+            flat_parameters.add_(self.compute_flat_step(noise_to_add))
+            return
+        
         noise_to_add_with_adjusted_keys = dict(((key[6:], value) for (key, value) in noise_to_add.items())) # Getting rid of the "model." part of the parameter name
         final_noise = self.compute_step(noise_to_add_with_adjusted_keys)
         utils.add_noise(self.model, final_noise)
 
     def compute_step(self, noise_to_add):
         raise NotImplementedError
+
+    def compute_flat_step(self, noise_to_add):
+        raise NotImplementedError
+
+    def flatten_memory(self, names): # The memories of the parameters with the given names are concatenated (in the given order) into flat vectors
+        for attribute in self.memory_attributes:
+            memory = getattr(self, attribute)
+            if isinstance(memory, dict):
+                setattr(self, attribute, torch.cat([memory[name].reshape(-1) for name in names]))
+    
+    def state_dict(self): # Everything except for the model (e.g. for resuming of the training)
+        return dict(((key, value) for (key, value) in self.__dict__.items() if key != "model"))
+    
+    def load_state_dict(self, state_dict):
+        for key, value in state_dict.items():
+            setattr(self, key, value)
     
     def copy_with_new_model(self, model):
         new_optimizer = object.__new__(type(self))
         for key, value in self.__dict__.items():
             if key != "model":
-                setattr(new_optimizer, key, value)
+                setattr(new_optimizer, key, copy.deepcopy(value)) # (the memory is updated in place in the flat mode, so it must not be shared)
             else:
                 setattr(new_optimizer, "model", model)
                 
@@ -38,8 +63,13 @@ class SGD(Optimizer):
         step = utils.get_weighted_noise(self.learning_rate, noise_to_add)
         return step
 
+    def compute_flat_step(self, noise_to_add):
+        return self.learning_rate * noise_to_add
+
 
 class SGDMomentum(Optimizer):
+    memory_attributes = ("memory",)
+
     def __init__(self, model, learning_rate, momentum=0.9):
         Optimizer.__init__(self, model, learning_rate)
         self.memory = {name: torch.zeros(param.size(), dtype=torch.float32) for name, param in model.named_parameters()}
@@ -52,8 +82,14 @@ class SGDMomentum(Optimizer):
         step = utils.get_weighted_noise(self.learning_rate, self.memory)
         return step
 
+    def compute_flat_step(self, noise_to_add):
+        self.memory.mul_(self.momentum).add_(noise_to_add, alpha=1 - self.momentum)
+        return self.learning_rate * self.memory
+
 
 class Adam(Optimizer):
+    memory_attributes = ("memory", "memory_squares")
+    
     def __init__(self, model, learning_rate, beta1=0.9, beta2=0.999, epsilon=1e-8):
         Optimizer.__init__(self, model, learning_rate)
         self.beta1 = beta1
@@ -74,6 +110,13 @@ class Adam(Optimizer):
             
         step = utils.get_weighted_noise(self.learning_rate, step)
         return step
+
+    def compute_flat_step(self, noise_to_add):
+        self.t += 1
+        bias_correction_constant = math.sqrt(1 - self.beta2 ** self.t) / (1 - self.beta1 ** self.t)
+        self.memory.mul_(self.beta1).add_(noise_to_add, alpha=1 - self.beta1)
+        self.memory_squares.mul_(self.beta2).addcmul_(noise_to_add, noise_to_add, value=1 - self.beta2)
+        return (self.learning_rate * bias_correction_constant) * self.memory / (torch.sqrt(self.memory_squares) + self.epsilon)
     
     
 def create_optimizer_to_model_from_string_name(model, optimizer_name, learning_rate, **kwargs):
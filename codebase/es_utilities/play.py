@@ -1,8 +1,27 @@
 # Functions for simulating and evaluating the model in the environment
 
-from tqdm import trange
+import copy
 
-def simulate(wrapped_model, wrapped_environment, num_of_episodes):
+import numpy as np
+from tqdm import tqdm, trange
+
+from .environment_batches import EnvironmentBatch, SubprocessEnvironmentBatch
+
+
+def simulate(wrapped_model, wrapped_environment, num_of_episodes, num_of_parallel_episodes=1, subprocess_environments=False, seed=None):
+    if num_of_parallel_episodes > 1:
+        # The episodes are run in copies of the environment at once (the i-th copy seeded by seed+i), possibly each of them in its own subprocess
+        wrapped_environments = [copy.deepcopy(wrapped_environment) for _ in range(min(num_of_parallel_episodes, num_of_episodes))]
+        if seed is not None:
+            seeds = [seed + i for i in range(len(wrapped_environments))]
+        else:
+            seeds = [int(s) for s in np.random.SeedSequence().generate_state(len(wrapped_environments))] # (otherwise the copies would share the state of the copied random generator)
+        for current_wrapped_environment, current_seed in zip(wrapped_environments, seeds):
+            current_wrapped_environment.set_seed(current_seed)
+            
+        with (SubprocessEnvironmentBatch if subprocess_environments else EnvironmentBatch)(wrapped_environments) as environments:
+            return simulate_batched(wrapped_model, environments, num_of_episodes)
+    
     episode_returns, episode_lengths = list(), list()
     
     progress_bar = trange(num_of_episodes)
@@ -43,3 +62,57 @@ def one_step(wrapped_model, wrapped_environment, state, episode_return, episode_
     episode_length += 1
     
     return next_state, done, episode_return, episode_length
+
+
+def simulate_batched(wrapped_model, environments, num_of_episodes, reset_arguments_of_episodes=None):
+    # The episodes are run in waves of (at most) as many episodes as there are environments, the episodes of a wave being stepped in lockstep,
+    # with a single batched forward pass of the model per step (see the batched methods of EsModelWrapper), the model's own parameters being used for all of them.
+    # The environments are either a list of wrapped environments, or an EnvironmentBatch (e.g. with each of them running in its own subprocess).
+    # If given, reset_arguments_of_episodes holds for each episode a dictionary of additional keyword arguments for reset_batched_inner_state
+    # (those of the episodes of a wave are passed in as lists, e.g. target_returns for the decision transformer).
+    if not isinstance(environments, EnvironmentBatch):
+        environments = EnvironmentBatch(environments)
+    
+    episode_returns, episode_lengths = list(), list()
+    
+    progress_bar = tqdm(total=num_of_episodes)
+    for wave_start in range(0, num_of_episodes, len(environments)):
+        batch_size = min(len(environments), num_of_episodes - wave_start)
+        wave_returns, wave_lengths = [0.] * batch_size, [0] * batch_size
+        
+        reset_arguments = dict()
+        if reset_arguments_of_episodes is not None:
+            for name in reset_arguments_of_episodes[wave_start]:
+                reset_arguments[name] = [reset_arguments_of_episodes[wave_start + i][name] for i in range(batch_size)]
+        
+        wrapped_model.reset_batched_inner_state(batch_size, **reset_arguments)
+        states = environments.reset(range(batch_size))
+        running_episodes = list(range(batch_size))
+        
+        timestep = 0
+        while len(running_episodes) > 0 and (environments.timestep_limit is None or timestep < environments.timestep_limit):
+            actions = wrapped_model.choose_batched_actions([states[i] for i in running_episodes], None, running_episodes)
+            
+            current_states = [states[i] for i in running_episodes]
+            next_states, rewards, terminated, truncated = environments.step(running_episodes, actions)
+            for i, next_state, reward in zip(running_episodes, next_states, rewards):
+                states[i] = next_state
+                wave_returns[i] += reward
+                wave_lengths[i] += 1
+                
+            wrapped_model.update_after_batched_step(current_states, next_states, actions, rewards, terminated, truncated, running_episodes)
+            
+            # Drop the finished episodes from the batch
+            running_episodes = [i for i, current_terminated, current_truncated in zip(running_episodes, terminated, truncated) if not (current_terminated or current_truncated)]
+            timestep += 1
+            
+        episode_returns.extend(wave_returns)
+        episode_lengths.extend(wave_lengths)
+        
+        progress_bar.update(batch_size)
+        progress_bar.set_description(f"Episodes {wave_start+1}-{wave_start+batch_size} || " + \
+            f"Mean return (mean runtime): {sum(episode_returns) / len(episode_returns)} ({sum(episode_lengths) // len(episode_lengths)})")
+        
+    progress_bar.close()
+        
+    return episode_returns, episode_lengths
@@ -1,6 +1,9 @@
 # Utilities, like shared noise table, functions for working with noise, etc.
 
 import random
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -8,11 +11,104 @@ import torch
 
 # --- Shared noise table ---
 
+NOISE_TABLE_LENGTH = int(25e7)  # 1 gigabyte of 32-bit numbers.
+
+
+def fill_with_noise(noise, deviation=1, seed=None, chunk_length=int(1e7)):
+    # Filled in chunks, so that there is no need for a temporary array of the size of the whole table (the resulting noise is the same as if generated at once)
+    rng = np.random.default_rng(seed)
+    for start in range(0, len(noise), chunk_length):
+        end = min(start + chunk_length, len(noise))
+        noise[start:end] = rng.normal(0, deviation, end - start)
+
+
+NOISE_GENERATION_CHUNK_LENGTH = int(1e7)
+
+
+def fill_with_noise_in_parallel(noise, deviation=1, seed=None, num_of_threads=None):
+    # Each chunk is filled from its own independent stream spawned from the seed, so the chunks can be generated in parallel
+    # and the resulting noise depends only on the seed (not on the number of threads). It is, however, a different noise than the one from fill_with_noise.
+    chunk_starts = range(0, len(noise), NOISE_GENERATION_CHUNK_LENGTH)
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(chunk_starts))
+    
+    def fill_chunk(start, seed_sequence):
+        chunk = noise[start:start + NOISE_GENERATION_CHUNK_LENGTH]
+        np.random.default_rng(seed_sequence).standard_normal(out=chunk, dtype=noise.dtype) # Generation into a given array releases the GIL
+        chunk *= deviation
+    
+    with ThreadPoolExecutor(num_of_threads) as executor:
+        list(executor.map(fill_chunk, chunk_starts, seed_sequences))
+
+
+def get_noise_table_cache_path(cache_directory, deviation, seed, length=NOISE_TABLE_LENGTH, dtype="f"):
+    # The name of the file is given by the hash of everything the content of the table depends on
+    key = repr((int(seed), float(deviation), int(length), np.dtype(dtype).str, NOISE_GENERATION_CHUNK_LENGTH))
+    return os.path.join(cache_directory, "noise_table_" + hashlib.sha256(key.encode()).hexdigest()[:32] + ".bin")
+
+
 class SharedNoiseTable:
-    def __init__(self, deviation=1, seed=None):
-        self._length = int(25e7)  # 1 gigabyte of 32-bit numbers.
-        self.noise = np.empty(self._length, dtype="f")
-        self.noise[:] = np.random.default_rng(seed).normal(0, deviation, self._length)
+    def __init__(self, deviation=1, seed=None, noise=None):
+        if noise is None:
+            noise = np.empty(NOISE_TABLE_LENGTH, dtype="f")
+            fill_with_noise(noise, deviation, seed)
+            
+        self._length = len(noise)
+        self.noise = noise
+        
+    # Alternatives to creating the table in one process and broadcasting it to the others (each of them then holding its own copy)
+        
+    @staticmethod
+    def generate_into_file(path, deviation=1, seed=None):
+        noise = np.memmap(path, dtype="f", mode="w+", shape=(NOISE_TABLE_LENGTH,))
+        fill_with_noise(noise, deviation, seed)
+        noise.flush()
+        
+    @staticmethod
+    def generate_into_cache(cache_directory, deviation, seed, num_of_threads=None): # Returns path to the table in the cache, generating it (in parallel) only if it is not there yet
+        if seed is None:
+            raise ValueError("Noise table can be cached only for a given seed.")
+        
+        path = get_noise_table_cache_path(cache_directory, deviation, seed, NOISE_TABLE_LENGTH, "f")
+        if not os.path.isfile(path):
+            os.makedirs(cache_directory, exist_ok=True)
+            
+            # Generated into a temporary file first, so that an unfinished table is never found in the cache
+            temporary_path = path + "." + str(os.getpid()) + ".tmp"
+            noise = np.memmap(temporary_path, dtype="f", mode="w+", shape=(NOISE_TABLE_LENGTH,))
+            fill_with_noise_in_parallel(noise, deviation, seed, num_of_threads)
+            noise.flush()
+            del noise
+            os.replace(temporary_path, path)
+            
+        return path
+        
+    @classmethod
+    def from_file(cls, path, in_memory=False): # The file is mapped read-only, so all the processes on a node share the same physical memory (the page cache), unless it is loaded into memory
+        if in_memory:
+            return cls(noise=np.fromfile(path, dtype="f"))
+        return cls(noise=np.memmap(path, dtype="f", mode="r"))
+    
+    @classmethod
+    def in_node_shared_memory(cls, comm, deviation=1, seed=None, source_path=None): # Collective - one table per node in an MPI shared-memory window, generated (or read from source_path, if given) by the first process on the node
+        from mpi4py import MPI
+        
+        node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        item_size = np.dtype("f").itemsize
+        window = MPI.Win.Allocate_shared(NOISE_TABLE_LENGTH * item_size if node_comm.Get_rank() == 0 else 0, item_size, comm=node_comm)
+        buffer, _ = window.Shared_query(0)
+        noise = np.ndarray(buffer=buffer, dtype="f", shape=(NOISE_TABLE_LENGTH,))
+        
+        if node_comm.Get_rank() == 0:
+            if source_path is not None:
+                noise[:] = np.memmap(source_path, dtype="f", mode="r")
+            else:
+                fill_with_noise(noise, deviation, seed)
+        node_comm.Barrier()
+        noise.flags.writeable = False
+        
+        noise_table = cls(noise=noise)
+        noise_table._window = window # Keeping the window alive as long as the table is
+        return noise_table
 
     def get(self, i, dim):
         if i + dim <= self._length:
@@ -24,10 +120,20 @@ class SharedNoiseTable:
         return self._length
     
     
+# In the flat parameter mode of the model wrapper (see EsModelWrapper.flatten_parameters) the noise is not a dictionary of tensors,
+# but a single flat vector (one contiguous slice of the noise table) matching the flat vector of the trainable parameters.
+
+def has_flat_parameters(model):
+    return getattr(model, "flat_parameters", None) is not None # (the optimizers work with the inner models, which are never in the flat mode)
+
+
 def get_noise(model, noise_table, seed=None):
     if seed is not None:
         random.seed(seed)
         
+    if has_flat_parameters(model):
+        return torch.from_numpy(noise_table.get(random.randint(0, len(noise_table) - 1), model.flat_parameters.numel()))
+        
     noise = dict()
     for name, param in model.named_parameters():
         number_of_elements, shape = param.numel(), param.size()
@@ -38,15 +144,26 @@ def get_noise(model, noise_table, seed=None):
 
 
 def add_noise(model, noise):
+    if has_flat_parameters(model):
+        model.flat_parameters.add_(noise)
+        return
+        
     for name, param in model.named_parameters():
         param.add_(noise[name])
     
 
 def subtract_noise(model, noise):
+    if has_flat_parameters(model):
+        model.flat_parameters.sub_(noise)
+        return
+        
     add_noise(model, get_minus_noise(noise))
     
     
 def get_minus_noise(noise):
+    if isinstance(noise, torch.Tensor):
+        return -noise
+        
     minus_noise = dict()
     for key in noise:
         minus_noise[key] = -noise[key]
@@ -55,6 +172,9 @@ def get_minus_noise(noise):
 
     
 def get_weighted_noise(weight, noise):
+    if isinstance(noise, torch.Tensor):
+        return weight * noise
+        
     weighted_noise = dict()
     for key in noise:
         weighted_noise[key] = weight * noise[key]
@@ -63,6 +183,9 @@ def get_weighted_noise(weight, noise):
 
 
 def get_combined_noises(noises):
+    if isinstance(noises[0], torch.Tensor):
+        return torch.sum(torch.stack(noises), axis=0)
+        
     combined_noise = dict()
     for key in noises[0]:
         combined_noise[key] = torch.sum(torch.stack([noises[i][key] for i in range(len(noises))]), axis=0)
@@ -70,6 +193,45 @@ def get_combined_noises(noises):
     return combined_noise
 
 
+def get_zero_noise(model):
+    if has_flat_parameters(model):
+        return torch.zeros(model.flat_parameters.numel(), dtype=torch.float32)
+        
+    return {name: torch.zeros(param.size(), dtype=torch.float32) for name, param in model.named_parameters()}
+
+
+def accumulate_weighted_noise(accumulated_noise, weight, noise): # In place, without any intermediate tensors
+    if isinstance(accumulated_noise, torch.Tensor):
+        accumulated_noise.add_(noise, alpha=weight)
+        return
+        
+    for key in accumulated_noise:
+        accumulated_noise[key].add_(noise[key], alpha=weight)
+
+
+def get_batch_of_perturbed_parameters(model, noises):
+    # Returns parameters of the model perturbed by each of the noises, first by +noise, then by -noise, stacked along a new first dimension
+    # (so the resulting order is +noise_0, -noise_0, +noise_1, -noise_1, ...)
+    perturbed_parameters = dict()
+    
+    if has_flat_parameters(model):
+        # All the perturbed flat vectors at once, the parameters are then just views into them
+        current_noises = torch.stack(noises).to(dtype=model.flat_parameters.dtype)
+        perturbed_flat_parameters = torch.stack((model.flat_parameters + current_noises, model.flat_parameters - current_noises), dim=1).reshape(2 * len(noises), -1)
+        offset = 0
+        for name, param in model.named_parameters():
+            perturbed_parameters[name[6:]] = perturbed_flat_parameters[:, offset:offset + param.numel()].reshape((2 * len(noises),) + tuple(param.size()))
+            offset += param.numel()
+            
+        return perturbed_parameters
+    
+    for name, param in model.named_parameters():
+        current_noises = torch.stack([noise[name] for noise in noises]).to(dtype=param.dtype)
+        perturbed_parameters[name[6:]] = torch.stack((param + current_noises, param - current_noises), dim=1).reshape((2 * len(noises),) + tuple(param.size())) # Getting rid of the "model." part of the parameter name
+
+    return perturbed_parameters
+
+
 # --- General utilities ---        
         
 def decay_weights(weight_decay_factor, model):
@@ -38,6 +38,52 @@ class VirtualBatchNormalizationStats:
         self.count = count
         
 
+# --- Ring buffer for histories kept by the model wrappers ---
+
+class RingBuffer:
+    # Preallocated buffer of a fixed capacity, which is written in place and keeps just the last "capacity" entries.
+    # Each entry is stored twice (once in each half of the underlying storage), so the last n entries always form a contiguous slice of the storage
+    # and can be returned as a view, without any copying. (The view is valid only until the next write into the buffer.)
+    # Optionally, the buffer can hold a batch of histories (the first dimension being the batch one), all of them being written at once.
+    def __init__(self, capacity, entry_shape=(), dtype=torch.float32, batch_size=None):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        storage_shape = (2 * capacity,) + tuple(entry_shape)
+        if batch_size is not None:
+            storage_shape = (batch_size,) + storage_shape
+        self.storage = torch.zeros(storage_shape, dtype=dtype)
+        self.clear()
+
+    def _index(self, position):
+        return (slice(None), position) if self.batch_size is not None else (position,)
+
+    def clear(self):
+        self.num_of_appended = 0
+        self.next_position = 0
+
+    def __len__(self):
+        return min(self.num_of_appended, self.capacity)
+
+    def append(self, entry):
+        self.storage[self._index(self.next_position)] = entry
+        self.storage[self._index(self.next_position + self.capacity)] = entry
+        self.next_position = (self.next_position + 1) % self.capacity
+        self.num_of_appended += 1
+
+    def set_last(self, entry, indices=None): # Overwrite the last entry (for a batched buffer possibly just in the histories with given indices)
+        last_position = (self.next_position - 1) % self.capacity
+        for position in (last_position, last_position + self.capacity):
+            if indices is None:
+                self.storage[self._index(position)] = entry
+            else:
+                self.storage[indices, position] = entry
+
+    def last(self, n=None): # View of the last n entries (or of all the kept entries, if n is None)
+        n = len(self) if n is None else min(n, len(self))
+        end = self.next_position + self.capacity
+        return self.storage[self._index(slice(end - n, end))]
+
+
 # --- "Abstract" model wrapper ---
 
 class EsModelWrapper(torch.nn.Module):
@@ -50,6 +96,7 @@ class EsModelWrapper(torch.nn.Module):
         self.vbn_stats = VirtualBatchNormalizationStats(state_shape)
         self.args = args
         self.kwargs = kwargs
+        self.flat_parameters = None
         
         # Setting requires_grad of every layer of the model to False (needed for inplace operations on weight tensors of the model)
         for param in self.model.parameters():
@@ -69,8 +116,25 @@ class EsModelWrapper(torch.nn.Module):
         result = type(self)(model, optimizer, self.vbn_stats.shape, *self.args, **self.kwargs)
         result.vbn_stats.set(self.vbn_stats.mean, self.vbn_stats.std, self.vbn_stats.count)
         
+        if self.flat_parameters is not None: # (deepcopy does not keep the parameters being views into one buffer)
+            result.flatten_parameters()
+        
         return result
     
+    def flatten_parameters(self): # Switch to the flat parameter mode - all the trainable parameters (those given by named_parameters) become views into one contiguous 1-D buffer
+        parameters = [param for _, param in self.named_parameters()]
+        assert all(param.dtype == parameters[0].dtype for param in parameters)
+        
+        self.flat_parameters = torch.cat([param.detach().reshape(-1) for param in parameters])
+        offset = 0
+        for param in parameters:
+            param.data = self.flat_parameters[offset:offset + param.numel()].view_as(param)
+            offset += param.numel()
+            
+        # The optimizer then works on the whole flat vector at once as well
+        if self.optimizer is not None:
+            self.optimizer.flatten_memory([name[6:] for name, _ in self.named_parameters()]) # Getting rid of the "model." part of the parameter name
+    
     def copy_from(self, reference_model):
         self.load_state_dict(reference_model.state_dict())
         self.vbn_stats.set(reference_model.vbn_stats.mean, reference_model.vbn_stats.std, reference_model.vbn_stats.count)
@@ -83,7 +147,33 @@ class EsModelWrapper(torch.nn.Module):
     
     def reset_inner_state(self): # Reset the inner state (before starting new episode)
         raise NotImplementedError()
-    
+
+    # Batched evaluation - the model is evaluated with several sets of parameters at once, each of them in its own environment, all of them stepped in lockstep.
+    # The sets of parameters are passed in as a dictionary of parameter tensors stacked along the first dimension (see utils.get_batch_of_perturbed_parameters),
+    # or as None, in which case the model's own parameters are used for the whole batch.
+    # The indices passed in are the indices of the still running episodes in the batch (the states and the parameters are passed in just for those).
+
+    def choose_batched_actions(self, states, parameters, indices): # Return actions to be taken depending on the current states (obtained) and possibly some inner batched variables or memory
+        raise NotImplementedError()
+
+    def update_after_batched_step(self, states, next_states, actions, rewards, terminated, truncated, indices): # Update the inner batched state
+        raise NotImplementedError()
+
+    def reset_batched_inner_state(self, batch_size): # Reset the inner batched state (before starting new batch of episodes)
+        raise NotImplementedError()
+
+    def batched_model_forward(self, parameters, *args): # Run forward pass of the model for each set of parameters (and corresponding args) in the batch at once
+        # (random operations, like the dropout of a model in train mode, are independent for each member of the batch, as they would be in separate forward passes)
+        def single_forward(single_parameters, *single_args):
+            return torch.func.functional_call(self.model, single_parameters, single_args)
+
+        if parameters is None: # (no parameters are substituted, so the model's own ones are shared by the whole batch)
+            in_dims = (None,) + tuple(None if arg is None else 0 for arg in args)
+            return torch.func.vmap(single_forward, in_dims=in_dims, randomness="different")(dict(), *args)
+
+        in_dims = (0,) + tuple(None if arg is None else 0 for arg in args) # None args (unused inputs) are passed as they are
+        return torch.func.vmap(single_forward, in_dims=in_dims, randomness="different")(parameters, *args)
+
     def save_parameters(self, path, suffix=None):
         path = path + ("" if suffix is None else ("_" + str(suffix)))
         model_path = path + ".model"
@@ -1,79 +1,81 @@
-from collections import defaultdict
 from pathlib import Path
 from argparse import ArgumentParser
-import math
 
 import numpy as np
+import pandas as pd
+
+from data_analysis import dataloading
+
+
+def load_run_performance(run_folder): # Returns the performance of the model of one run for all the rtg values as a table with columns RTG, Run, Return and Length
+    performance_folder = Path.joinpath(run_folder, "ckpts", "performance")
+    
+    # All the non-aggregated rtg files in the run folder
+    # These files contain the performance of the model for a specific rtg value
+    # (the empty ones, e.g. left behind by an interrupted play run, are skipped)
+    different_rtg_files = [f for f in performance_folder.iterdir() if f.is_file() and f.name.endswith(".csv") and not f.name.endswith("_aggregated.csv") and f.stat().st_size > 0]
+    
+    run_performance = [
+        pd.read_csv(file, sep=";", header=0, names=["Return", "Length"], dtype={"Return": np.float64, "Length": np.int64}, float_precision="round_trip").assign(RTG=float(file.stem))
+        for file in different_rtg_files
+    ]
+    if len(run_performance) == 0:
+        return pd.DataFrame({"RTG": pd.Series(dtype=np.float64), "Run": pd.Series(dtype=str), "Return": pd.Series(dtype=np.float64), "Length": pd.Series(dtype=np.int64)})
+    
+    run_performance = pd.concat(run_performance, ignore_index=True)
+    run_performance["Run"] = run_folder.name
+    
+    return run_performance[["RTG", "Run", "Return", "Length"]]
 
 
 def main(args):
     experiment_folder = Path(args.path_to_experiment_folder)
     run_folders = [f for f in experiment_folder.iterdir() if f.is_dir()]
-    rtg_dependent_returns, rtg_dependent_lengths = defaultdict(list), defaultdict(list)
-    rtg_dependent_aggregated_returns, rtg_dependent_aggregated_lengths = defaultdict(list), defaultdict(list)
     
-    for run_folder in run_folders:
-        performance_folder = Path.joinpath(run_folder, "ckpts", "performance")
-        
-        # Data for mean and standard deviations
-        # All the non-aggregated rtg files in the run folder
-        # These files contain the performance of the model for a specific rtg value
-        different_rtg_files = [f for f in performance_folder.iterdir() if f.is_file() and f.name.endswith(".csv") and not f.name.endswith("_aggregated.csv")]
-        
-        for file in different_rtg_files:
-            desired_rtg = float(file.stem)
-            
-            with open(file, "r") as f:
-                lines = f.readlines()
-                if len(lines) > 1:
-                    # Skip the header line
-                    for line in lines[1:]:
-                        episode_return, episode_length = line.strip().split(";")
-                        
-                        rtg_dependent_returns[desired_rtg].append(float(episode_return))
-                        rtg_dependent_lengths[desired_rtg].append(int(episode_length))
-        
-        # Data for median and quartiles
-        # All the aggregated rtg files in the run folder
-        # These files contain the aggregated performance of the model for a specific rtg value
-        different_rtg_aggregated_files = [f for f in performance_folder.iterdir() if f.is_file() and f.name.endswith("_aggregated.csv")]
-        
-        for file in different_rtg_aggregated_files:
-            desired_rtg = float(file.stem.split("_")[0])
-            
-            with open(file, "r") as f:
-                lines = f.readlines()
-                
-                mean_episode_return, _, mean_episode_length, _ = lines[1].strip().split(";")
-                        
-                rtg_dependent_aggregated_returns[desired_rtg].append(float(episode_return))
-                rtg_dependent_aggregated_lengths[desired_rtg].append(int(episode_length))
+    # The runs are loaded in parallel and then merged into a single table
+    performance = pd.concat(dataloading.load_in_parallel(load_run_performance, [(run_folder,) for run_folder in run_folders], args.num_of_processes), ignore_index=True)
     
-    for rtg in rtg_dependent_returns:
-        # Means and standard deviations
-        mean_returns = sum(rtg_dependent_returns[rtg]) / len(rtg_dependent_returns[rtg])
-        mean_lengths = sum(rtg_dependent_lengths[rtg]) / len(rtg_dependent_lengths[rtg])
-        std_returns = math.sqrt(sum((x - mean_returns) ** 2 for x in rtg_dependent_returns[rtg]) / len(rtg_dependent_returns[rtg]))
-        std_lengths = math.sqrt(sum((x - mean_lengths) ** 2 for x in rtg_dependent_lengths[rtg]) / len(rtg_dependent_lengths[rtg]))
-        
+    # All the aggregations for all the rtg values at once
+    grouped_performance = performance.groupby("RTG")[["Return", "Length"]]
+    means, stds = grouped_performance.mean(), grouped_performance.std(ddof=0)
+    quartiles = grouped_performance.quantile([0.25, 0.5, 0.75]).unstack()
+    
+    aggregations = pd.DataFrame({
+        "Mean Return": means["Return"],
+        "Std Return": stds["Return"],
+        "Mean Length": means["Length"],
+        "Std Length": stds["Length"],
+        "Q1 Return": quartiles[("Return", 0.25)],
+        "Median Return": quartiles[("Return", 0.5)],
+        "Q3 Return": quartiles[("Return", 0.75)],
+        "Q1 Length": quartiles[("Length", 0.25)],
+        "Median Length": quartiles[("Length", 0.5)],
+        "Q3 Length": quartiles[("Length", 0.75)],
+        "Num of episodes": grouped_performance.size()
+    })
+    
+    # One combined table for all the rtg values
+    aggregations.to_csv(experiment_folder / "rtgs_aggregations.csv", sep=";")
+    
+    # And the files per rtg value
+    for rtg, aggregation in aggregations.iterrows():
+        ## Means and standard deviations
         aggregated_file_path = experiment_folder / f"{rtg}_mean_and_std.csv"
         with open(aggregated_file_path, "w") as f:
             f.write("Mean Return;Std Return;Mean Length;Std Length\n")
-            f.write(f"{mean_returns};{std_returns};{mean_lengths};{std_lengths}\n")
-            
-        # Median and quartiles
-        mean_return_quartiles = np.quantile(rtg_dependent_returns[rtg], [0.25, 0.5, 0.75])
-        mean_length_quartiles = np.quantile(rtg_dependent_lengths[rtg], [0.25, 0.5, 0.75])
+            f.write(f"{aggregation['Mean Return']};{aggregation['Std Return']};{aggregation['Mean Length']};{aggregation['Std Length']}\n")
         
+        ## Median and quartiles
         aggregated_file_path = experiment_folder / f"{rtg}_quartiles.csv"
         with open(aggregated_file_path, "w") as f:
             f.write("Q1 Return;Median Return;Q3 Return;Q1 Length;Median Length;Q3 Length\n")
-            f.write(f"{mean_return_quartiles[0]};{mean_return_quartiles[1]};{mean_return_quartiles[2]};{mean_length_quartiles[0]};{mean_length_quartiles[1]};{mean_length_quartiles[2]}\n")
+            f.write(f"{aggregation['Q1 Return']};{aggregation['Median Return']};{aggregation['Q3 Return']};{aggregation['Q1 Length']};{aggregation['Median Length']};{aggregation['Q3 Length']}\n")
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     
     parser.add_argument("path_to_experiment_folder", type=str, help="Path to the experiment folder containing the directories of individual runs of the experiment with logged data of various rtgs runs to be processed.")
-        
+    parser.add_argument("-p", "--num_of_processes", type=int, default=None, help="Number of processes loading the data of the individual runs in parallel. (All the available CPUs by default, 1 for loading in the main process.)")
+    
     main(parser.parse_args())
@@ -19,6 +19,7 @@ def main(args):
         clip_rewards_val=False,
         sticky_action_p=args.sticky_action_p,
         sdl=not args.dont_show_gameplay,
+        preallocated_buffers=args.preallocated_env_buffers,
     )
     wrapped_environment = ALEAtariWrapper(env, main_seed)
     
@@ -30,7 +31,9 @@ def main(args):
         int(1e4),
         main_seed,
         None,
-        None
+        None,
+        args.compact_state_history,
+        args.cache_state_embeddings
     )
     wrapped_model.train(False)
     wrapped_model.load_parameters(args.ckpt_path)
@@ -65,6 +68,9 @@ if __name__ == "__main__":
     parser.add_argument("-e", "--episodes", default=1, type=int, help="Number of episodes.")
     parser.add_argument("-d", "--dont_show_gameplay", action="store_true")
     parser.add_argument("--dont_sample_action", action="store_true")
+    parser.add_argument("--compact_state_history", action="store_true", help="Whether the model should keep the history of the states as raw uint8 frames, each of them just once (the overlapping stacks of the frames being strided views), normalizing them (by the VBN stats) only inside its state encoder.")
+    parser.add_argument("--cache_state_embeddings", action="store_true", help="Whether the model should be run incrementally, embedding just the new tokens (the current state, return-to-go and the last action) in each step and keeping the embeddings of the older ones instead of the states themselves.")
+    parser.add_argument("--preallocated_env_buffers", action="store_true", help="Whether the environment should step without allocating any new buffers, returning the observations as views into its preallocated frame stack.")
     parser.add_argument("--sticky_action_p", type=float, default=0)
     parser.add_argument("--seed", type=int, default=None, help="Seed for the environment.")
     parser.add_argument("-s", "--save_outputs", action="store_true", help="Flags whether to save episode returns and lengths. The data is saved into file \"{rtg}.csv\" in a subfolder \"performance\" of the folder the checkpoint was loaded from, which is created, if necessary. The mean and standard deviation of the data are saved to file \"{rtg}_aggregated.csv\" in the same folder.")
@@ -6,12 +6,102 @@ import math
 
 from wrapped_components.env_gym_mujoco_wrappers import GymMujocoWrapper
 from wrapped_components.model_dt_mujoco_wrappers import get_new_wrapped_dt_humanoid
-from es_utilities.play import simulate
+from es_utilities.play import simulate, simulate_batched
+from es_utilities.environment_batches import EnvironmentBatch, SubprocessEnvironmentBatch
+
+
+def save_performance(outputs_folder, rtg, episode_returns, episode_lengths):
+    os.makedirs(outputs_folder, exist_ok=True)
+    
+    with open(os.path.join(outputs_folder, f"{rtg}.csv"), "w") as f:
+        f.write("Episode Return;Episode Length\n")
+        for episode_return, episode_length in zip(episode_returns, episode_lengths):
+            f.write(f"{episode_return};{episode_length}\n")
+            
+    returns_mean = sum(episode_returns) / len(episode_returns)
+    returns_std = math.sqrt(sum((x - returns_mean)**2 for x in episode_returns) / len(episode_returns))
+    lengths_mean = sum(episode_lengths) / len(episode_lengths)
+    lengths_std = math.sqrt(sum((x - lengths_mean)**2 for x in episode_lengths) / len(episode_lengths))
+    
+    with open(os.path.join(outputs_folder, f"{rtg}_aggregated.csv"), "w") as f:
+        f.write("Mean Return;Std Return;Mean Length;Std Length\n")
+        f.write(f"{returns_mean};{returns_std};{lengths_mean};{lengths_std}\n")
+
+
+def get_wrapped_model(args, target_return, timestep_limit):
+    wrapped_model = get_new_wrapped_dt_humanoid(
+        target_return,
+        timestep_limit,
+        args.context_length,
+        args.embed_dim,
+        args.n_layer,
+        args.n_head,
+        args.activation_function,
+        args.dropout,
+        False,
+        args.seed,
+        None,
+        None,
+        args.kv_cache
+    ) 
+    wrapped_model.train(False)
+    wrapped_model.load_parameters(args.ckpt_path)
+    
+    return wrapped_model
+
+
+def run_rtg_sweep(args):
+    # All the rtgs are evaluated at once - the episodes of all of them are run in parallel environments (in lockstep),
+    # with the forward passes of the model batched across the episodes (each episode being conditioned on its own rtg)
+    if args.sweep_rtgs is not None:
+        rtgs = args.sweep_rtgs
+    else:
+        start, stop, step = args.sweep_rtg_range
+        rtgs = [start + i * step for i in range(int(math.floor((stop - start) / step + 1e-9)) + 1)] # (including the stop)
+    
+    scale = 1000.
+    num_of_parallel_episodes = args.num_of_parallel_episodes if args.num_of_parallel_episodes is not None else 32
+    wrapped_environments = [
+        GymMujocoWrapper(gym.make("Humanoid-v4"), args.seed + i if args.seed is not None else None, scale)
+        for i in range(min(num_of_parallel_episodes, len(rtgs) * args.episodes))
+    ]
+    
+    wrapped_model = get_wrapped_model(args, rtgs[0] / scale, wrapped_environments[0].timestep_limit)
+    
+    ## The episodes are ordered by the rtg (args.episodes per rtg)
+    with (SubprocessEnvironmentBatch if args.subprocess_environments else EnvironmentBatch)(wrapped_environments) as environments:
+        episode_returns, episode_lengths = simulate_batched(
+            wrapped_model,
+            environments,
+            len(rtgs) * args.episodes,
+            [{"target_returns": rtg / scale} for rtg in rtgs for _ in range(args.episodes)]
+        )
+    
+    outputs_folder = os.path.join(os.path.dirname(args.ckpt_path), "performance")
+    for i, rtg in enumerate(rtgs):
+        current_returns = episode_returns[i * args.episodes:(i + 1) * args.episodes]
+        current_lengths = episode_lengths[i * args.episodes:(i + 1) * args.episodes]
+        print(f"RTG {rtg} - mean return (mean runtime): {sum(current_returns) / len(current_returns)} ({sum(current_lengths) // len(current_lengths)})")
+        
+        save_performance(outputs_folder, rtg, current_returns, current_lengths)
 
 
 def main(args):
+    if args.kv_cache and (args.sweep_rtgs is not None or args.sweep_rtg_range is not None or (args.num_of_parallel_episodes is not None and args.num_of_parallel_episodes > 1)):
+        raise ValueError("The kv cache is supported neither with parallel episodes, nor by the rtg sweep.")
+    
+    if args.sweep_rtgs is not None or args.sweep_rtg_range is not None:
+        run_rtg_sweep(args)
+        return
+    
+    if args.rtg is None:
+        raise ValueError("Either the return-to-go, or the rtgs to sweep over have to be given.")
+    
     main_seed = args.seed
     
+    if (args.num_of_parallel_episodes is not None and args.num_of_parallel_episodes > 1) and (args.record is not None or not args.dont_show_gameplay):
+        raise ValueError("The gameplay of parallel episodes can be neither shown, nor recorded. (Use --dont_show_gameplay.)")
+    
     env = gym.make("Humanoid-v4", render_mode=("rgb_array" if args.record else (None if args.dont_show_gameplay else "human")))
     
     if args.record is not None:
@@ -32,42 +122,19 @@ def main(args):
     scale = 1000.
     wrapped_environment = GymMujocoWrapper(env, main_seed, scale)
     
-    wrapped_model = get_new_wrapped_dt_humanoid(
-        args.rtg / scale,
-        wrapped_environment.timestep_limit,
-        args.context_length,
-        args.embed_dim,
-        args.n_layer,
-        args.n_head,
-        args.activation_function,
-        args.dropout,
-        False,
-        main_seed,
-        None,
-        None
-    ) 
-    wrapped_model.train(False)
-    wrapped_model.load_parameters(args.ckpt_path)
+    wrapped_model = get_wrapped_model(args, args.rtg / scale, wrapped_environment.timestep_limit)
     
-    episode_returns, episode_lengths = simulate(wrapped_model, wrapped_environment, args.episodes)
+    episode_returns, episode_lengths = simulate(
+        wrapped_model,
+        wrapped_environment,
+        args.episodes,
+        args.num_of_parallel_episodes if args.num_of_parallel_episodes is not None else 1,
+        args.subprocess_environments,
+        main_seed
+    )
     
     if args.save_outputs:
-        outputs_folder = os.path.join(os.path.dirname(args.ckpt_path), "performance")
-        os.makedirs(outputs_folder, exist_ok=True)
-        
-        with open(os.path.join(outputs_folder, f"{args.rtg}.csv"), "w") as f:
-            f.write("Episode Return;Episode Length\n")
-            for episode_return, episode_length in zip(episode_returns, episode_lengths):
-                f.write(f"{episode_return};{episode_length}\n")
-                
-        returns_mean = sum(episode_returns) / len(episode_returns)
-        returns_std = math.sqrt(sum((x - returns_mean)**2 for x in episode_returns) / len(episode_returns))
-        lengths_mean = sum(episode_lengths) / len(episode_lengths)
-        lengths_std = math.sqrt(sum((x - lengths_mean)**2 for x in episode_lengths) / len(episode_lengths))
-        
-        with open(os.path.join(outputs_folder, f"{args.rtg}_aggregated.csv"), "w") as f:
-            f.write("Mean Return;Std Return;Mean Length;Std Length\n")
-            f.write(f"{returns_mean};{returns_std};{lengths_mean};{lengths_std}\n")
+        save_performance(os.path.join(os.path.dirname(args.ckpt_path), "performance"), args.rtg, episode_returns, episode_lengths)
     
 
 if __name__ == "__main__":
@@ -76,17 +143,23 @@ if __name__ == "__main__":
     
     parser = ArgumentParser()
     parser.add_argument("ckpt_path", type=str, help="Checkpoint path.")
-    parser.add_argument("rtg", type=float, help="Return-to-go that should be passed.")
+    parser.add_argument("rtg", type=float, nargs="?", default=None, help="Return-to-go that should be passed. (Not needed for the rtg sweep.)")
     parser.add_argument("--context_length", type=int, default=20, help="Size of blocks (number of steps in the sequence passed to the transformer).")
     parser.add_argument("--embed_dim", type=int, default=128)
     parser.add_argument("--n_layer", type=int, default=3)
     parser.add_argument("--n_head", type=int, default=1)
     parser.add_argument("--activation_function", type=str, default="relu")
     parser.add_argument("--dropout", type=float, default=0.1)
+    parser.add_argument("--kv_cache", action="store_true", help="Uses incremental inference with cached keys and values (in a sliding window of the context length), so that only the new tokens are run through the transformer in each step. (Not supported with parallel episodes, nor by the rtg sweep.)")
     parser.add_argument("-e", "--episodes", default=1, type=int, help="Number of episodes.")
     parser.add_argument("-d", "--dont_show_gameplay", action="store_true")
     parser.add_argument("--seed", type=int, default=None, help="Seed for the environment.")
     parser.add_argument("-r", "--record", nargs="?", type=str, default=None, const="ckpt", help="Flags whether to record a video. If no value is provided, the recording is saved into a new subfolder \"videos\" of the folder the checkpoint was loaded from. Otherwise, the given value is used as a full path the recordings are saved to.")
     parser.add_argument("-s", "--save_outputs", action="store_true", help="Flags whether to save episode returns and lengths. The data is saved into file \"{rtg}.csv\" in a subfolder \"performance\" of the folder the checkpoint was loaded from, which is created, if necessary. The mean and standard deviation of the data are saved to file \"{rtg}_aggregated.csv\" in the same folder.")
     
+    parser.add_argument("--sweep_rtgs", type=float, nargs="+", default=None, help="Evaluates all the given return-to-go values in one batched run (the episodes of all of them being run in parallel environments with batched forward passes of the model). The outputs are always saved the same way as with --save_outputs.")
+    parser.add_argument("--sweep_rtg_range", type=float, nargs=3, default=None, metavar=("START", "STOP", "STEP"), help="The same as --sweep_rtgs, but for the return-to-go values from START to STOP (included) with the given STEP.")
+    parser.add_argument("-p", "--num_of_parallel_episodes", type=int, default=None, help="Number of environments the episodes are run in at once (with batched forward passes of the model). By default 32 for the rtg sweep and 1 otherwise. (The gameplay of parallel episodes can be neither shown, nor recorded.)")
+    parser.add_argument("--subprocess_environments", action="store_true", help="Whether to run each of the parallel environments in its own subprocess, so that they are stepped in parallel.")
+    
     main(parser.parse_args())
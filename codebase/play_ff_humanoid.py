@@ -10,6 +10,9 @@ from es_utilities.play import simulate
 
 
 def main(args):
+    if args.num_of_parallel_episodes > 1 and (args.record is not None or not args.dont_show_gameplay):
+        raise ValueError("The gameplay of parallel episodes can be neither shown, nor recorded. (Use --dont_show_gameplay.)")
+    
     env = gym.make("Humanoid-v4", render_mode=("rgb_array" if args.record else (None if args.dont_show_gameplay else "human")))
     
     if args.record is not None:
@@ -32,7 +35,7 @@ def main(args):
     wrapped_model = get_new_wrapped_ff_humanoid()
     wrapped_model.load_parameters(args.ckpt_path)
             
-    episode_returns, episode_lengths = simulate(wrapped_model, wrapped_environment, args.episodes)
+    episode_returns, episode_lengths = simulate(wrapped_model, wrapped_environment, args.episodes, args.num_of_parallel_episodes, args.subprocess_environments, args.seed)
     
     if args.save_outputs:
         outputs_folder = os.path.join(os.path.dirname(args.ckpt_path), "performance")
@@ -63,6 +66,8 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--dont_show_gameplay", action="store_true")
     parser.add_argument("--seed", type=int, default=None, help="Seed for the environment.")
     parser.add_argument("-r", "--record", nargs="?", type=str, default=None, const="ckpt", help="Flags whether to record a video. If no value is provided, the recording is saved into a new subfolder \"videos\" of the folder the checkpoint was loaded from. Otherwise, the given value is used as a full path the recordings are saved to.")
+    parser.add_argument("-p", "--num_of_parallel_episodes", type=int, default=1, help="Number of environments the episodes are run in at once (with batched forward passes of the model). (The gameplay of parallel episodes can be neither shown, nor recorded.)")
+    parser.add_argument("--subprocess_environments", action="store_true", help="Whether to run each of the parallel environments in its own subprocess, so that they are stepped in parallel.")
     parser.add_argument("-s", "--save_outputs", action="store_true", help="Flags whether to save episode returns and lengths. The data is saved into file \"performance.csv\" in a subfolder \"performance\" of the folder the checkpoint was loaded from, which is created, if necessary. The mean and standard deviation of the data are saved to file \"performance_aggregated.csv\" in the same folder.")
     
     main(parser.parse_args())
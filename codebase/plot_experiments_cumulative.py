@@ -4,6 +4,11 @@ from pathlib import Path
 from argparse import ArgumentParser
 
 
+def get_population_log_path(run_directory, log_type): # The population logs may be either in the csv, or in the binary format
+    binary_log_path = run_directory / f"log.{log_type}.npy"
+    return binary_log_path if binary_log_path.is_file() else run_directory / f"log.{log_type}.csv"
+
+
 def main(args):
     if args.experiment_names is not None:
         if len(args.experiment_names) != len(args.paths_to_experiment_folders):
@@ -26,6 +31,10 @@ def main(args):
         
     values_range = (0, None)
     
+    approximate_population_data = args.approximate_aggregation and args.plot_type in ["fitness", "runtime"]
+    if approximate_population_data:
+        print("Warning: The population data are aggregated approximately (only the mean is exact, the median and the interval are means of the per-run ones).")
+    
     print("Creating the plot...")
     plots.create_plot_for_multiple_experiments(
         plot_dimensions=args.plot_dimensions
@@ -35,7 +44,6 @@ def main(args):
         case "eval":
             for i, experiment_path in enumerate(args.paths_to_experiment_folders):
                 path_to_experiment_folder = Path(experiment_path)
-                current_experiment_evaluation_data = []
 
                 if args.experiment_names is not None:
                     print(f"Processing data from experiment named {experiment_names[i]}...")
@@ -46,12 +54,12 @@ def main(args):
                 print("Loading data...")
                 paths_to_evaluation_data = [run_directory / "log.evaluations.csv" for run_directory in path_to_experiment_folder.iterdir() if run_directory.is_dir()]
 
-                single_run_identifiers = list()
-                for path in paths_to_evaluation_data:
-                    print("Loading data from file:", path)
-                    new_evaluation_dataframe = dataloading.load_evaluation_fitnesses_from_csv(path, args.max_iterations)
-                    current_experiment_evaluation_data.append(new_evaluation_dataframe)
-                    single_run_identifiers.append(path.parent.stem)
+                current_experiment_evaluation_data = dataloading.load_in_parallel(
+                    dataloading.load_evaluation_fitnesses_from_csv,
+                    [(path, args.max_iterations) for path in paths_to_evaluation_data],
+                    args.num_of_processes
+                )
+                single_run_identifiers = [path.parent.stem for path in paths_to_evaluation_data]
 
                 print("Adding evaluation fitnesses to the plot...")
                 plots.add_evaluation_data_from_one_experiment_to_plot(
@@ -67,7 +75,6 @@ def main(args):
         case "fitness":
             for i, experiment_path in enumerate(args.paths_to_experiment_folders):
                 path_to_experiment_folder = Path(experiment_path)
-                current_experiment_fitness_data = []
 
                 if args.experiment_names is not None:
                     print(f"Processing data from experiment named {experiment_names[i]}...")
@@ -76,30 +83,47 @@ def main(args):
                     print(f"Processing data from experiment number {i+1}:")
 
                 print("Loading data...")
-                paths_to_fitness_data = [run_directory / "log.fitness.csv" for run_directory in path_to_experiment_folder.iterdir() if run_directory.is_dir()]
-
-                single_run_identifiers = list()
-                for path in paths_to_fitness_data:
-                    print("Loading data from file:", path)
-                    new_fitness_dataframe = dataloading.load_fitnesses_from_csv(path, args.max_iterations)
-                    current_experiment_fitness_data.append(new_fitness_dataframe)
-                    single_run_identifiers.append(path.parent.stem)
-
-                print("Adding population fitnesses to the plot...")
-                plots.add_fitness_data_from_one_experiment_to_plot(
-                    *current_experiment_fitness_data,
-                    experiment_name=experiment_names[i],
-                    single_run_identifiers=single_run_identifiers,
-                    central_measure=args.central_measure,
-                    interval_measure=args.interval_measure
-                )
+                paths_to_fitness_data = [get_population_log_path(run_directory, "fitness") for run_directory in path_to_experiment_folder.iterdir() if run_directory.is_dir()]
+
+                if not args.approximate_aggregation:
+                    current_experiment_fitness_data = dataloading.load_in_parallel(
+                        dataloading.load_population_data,
+                        [(path, args.max_iterations) for path in paths_to_fitness_data],
+                        args.num_of_processes
+                    )
+                    single_run_identifiers = [path.parent.stem for path in paths_to_fitness_data]
+
+                    print("Adding population fitnesses to the plot...")
+                    plots.add_fitness_data_from_one_experiment_to_plot(
+                        *current_experiment_fitness_data,
+                        experiment_name=experiment_names[i],
+                        single_run_identifiers=single_run_identifiers,
+                        central_measure=args.central_measure,
+                        interval_measure=args.interval_measure
+                    )
+                    
+                else:
+                    # Just the per-iteration aggregates of each run are loaded (computed while streaming through the log, or taken from the cache)
+                    current_experiment_fitness_data = dataloading.load_in_parallel(
+                        dataloading.load_aggregated_population_data,
+                        [(path, args.max_iterations, not args.no_cache) for path in paths_to_fitness_data],
+                        args.num_of_processes
+                    )
+
+                    print("Adding population fitnesses to the plot...")
+                    plots.add_aggregated_population_data_from_one_experiment_to_plot(
+                        *current_experiment_fitness_data,
+                        experiment_name=experiment_names[i],
+                        value_name="Fitness",
+                        central_measure=args.central_measure,
+                        interval_measure=args.interval_measure
+                    )
                 
                 values_range=(0, args.max_fitness)
         
         case "runtime":
             for i, experiment_path in enumerate(args.paths_to_experiment_folders):
                 path_to_experiment_folder = Path(experiment_path)
-                current_experiment_runtime_data = []
 
                 if args.experiment_names is not None:
                     print(f"Processing data from experiment named {experiment_names[i]}...")
@@ -108,28 +132,45 @@ def main(args):
                     print(f"Processing data from experiment number {i+1}:")
 
                 print("Loading data...")
-                paths_to_runtime_data = [run_directory / "log.runtime.csv" for run_directory in path_to_experiment_folder.iterdir() if run_directory.is_dir()]
-
-                single_run_identifiers = list()
-                for path in paths_to_runtime_data:
-                    print("Loading data from file:", path)
-                    new_runtime_dataframe = dataloading.load_runtimes_from_csv(path, args.max_iterations)
-                    current_experiment_runtime_data.append(new_runtime_dataframe)
-                    single_run_identifiers.append(path.parent.stem)
-
-                print("Adding runtimes to the plot...")
-                plots.add_runtime_data_from_one_experiment_to_plot(
-                    *current_experiment_runtime_data,
-                    experiment_name=experiment_names[i],
-                    single_run_identifiers=single_run_identifiers,
-                    central_measure=args.central_measure,
-                    interval_measure=args.interval_measure
-                )
+                paths_to_runtime_data = [get_population_log_path(run_directory, "runtime") for run_directory in path_to_experiment_folder.iterdir() if run_directory.is_dir()]
+
+                if not args.approximate_aggregation:
+                    current_experiment_runtime_data = dataloading.load_in_parallel(
+                        dataloading.load_population_data,
+                        [(path, args.max_iterations) for path in paths_to_runtime_data],
+                        args.num_of_processes
+                    )
+                    single_run_identifiers = [path.parent.stem for path in paths_to_runtime_data]
+
+                    print("Adding runtimes to the plot...")
+                    plots.add_runtime_data_from_one_experiment_to_plot(
+                        *current_experiment_runtime_data,
+                        experiment_name=experiment_names[i],
+                        single_run_identifiers=single_run_identifiers,
+                        central_measure=args.central_measure,
+                        interval_measure=args.interval_measure
+                    )
+                    
+                else:
+                    # Just the per-iteration aggregates of each run are loaded (computed while streaming through the log, or taken from the cache)
+                    current_experiment_runtime_data = dataloading.load_in_parallel(
+                        dataloading.load_aggregated_population_data,
+                        [(path, args.max_iterations, not args.no_cache) for path in paths_to_runtime_data],
+                        args.num_of_processes
+                    )
+
+                    print("Adding runtimes to the plot...")
+                    plots.add_aggregated_population_data_from_one_experiment_to_plot(
+                        *current_experiment_runtime_data,
+                        experiment_name=experiment_names[i],
+                        value_name="Runtime (timesteps)",
+                        central_measure=args.central_measure,
+                        interval_measure=args.interval_measure
+                    )
             
         case "time":
             for i, experiment_path in enumerate(args.paths_to_experiment_folders):
                 path_to_experiment_folder = Path(experiment_path)
-                current_experiment_time_data = []
 
                 if args.experiment_names is not None:
                     print(f"Processing data from experiment named {experiment_names[i]}...")
@@ -140,12 +181,12 @@ def main(args):
                 print("Loading data...")
                 paths_to_time_data = [run_directory / "log.time.csv" for run_directory in path_to_experiment_folder.iterdir() if run_directory.is_dir()]
 
-                single_run_identifiers = list()
-                for path in paths_to_time_data:
-                    print("Loading data from file:", path)
-                    new_time_dataframe = dataloading.load_times_from_csv(path, args.max_iterations)
-                    current_experiment_time_data.append(new_time_dataframe)
-                    single_run_identifiers.append(path.parent.stem)
+                current_experiment_time_data = dataloading.load_in_parallel(
+                    dataloading.load_times_from_csv,
+                    [(path, args.max_iterations) for path in paths_to_time_data],
+                    args.num_of_processes
+                )
+                single_run_identifiers = [path.parent.stem for path in paths_to_time_data]
 
                 print("Adding wall-clock times to the plot...")
                 plots.add_time_data_from_one_experiment_to_plot(
@@ -167,7 +208,8 @@ def main(args):
     plots.show_plot_for_multiple_experiments(
         num_of_iterations_to_plot=args.max_iterations,
         values_range=values_range,
-        disable_legend=(args.experiment_names is None)
+        disable_legend=(args.experiment_names is None),
+        title="Approximate aggregation (exact mean)" if approximate_population_data else None
     )
 
 
@@ -182,6 +224,9 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--experiment_names", type=str, nargs="+", help="Names for the individual experiments in the order as passed to the base path argument.")
     parser.add_argument("-cm", "--central_measure", type=str, default="median", help="Central measure to be plotted. Possible values are 'mean' and 'median'.")
     parser.add_argument("-im", "--interval_measure", type=str, default="quartiles", help="Interval measure to be plotted. Possible values are 'quartiles' and 'standard', which stands for standard percentile interval (the whole interval for one-value-per-iteration data and 95% interval for multiple-values-per-iteration data).")
+    parser.add_argument("--approximate_aggregation", action="store_true", help="Whether to just stream through the population logs (fitnesses and runtimes) of the runs and compute per-run aggregates, instead of loading the whole logs of all the runs for the exact aggregation. Only the mean is then exact, the median and the interval of the experiment are approximated by means of the per-run ones (and the plot is labeled as approximate).")
+    parser.add_argument("--no_cache", action="store_true", help="Whether not to use (nor create) the cache of the per-run aggregates of the population logs (stored next to the logs). (Only with --approximate_aggregation.)")
+    parser.add_argument("-p", "--num_of_processes", type=int, default=None, help="Number of processes loading (and pre-aggregating) the data of the individual runs in parallel. (All the available CPUs by default, 1 for loading in the main process.)")
     parser.add_argument("-l", "--add_line", nargs=2, type=str, metavar=("NAME", "Y_VALUE"), help="Add a horizontal dashed line with the given name (string) and y-value (float) to the plot. (The name of the line will be shown only when the experiments are named as well, otherwise the legend will be disabled.)")
     
     main(parser.parse_args())
@@ -0,0 +1,6 @@
+# The tests import the packages of the codebase the same way the scripts in its root do
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
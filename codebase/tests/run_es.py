@@ -0,0 +1,83 @@
+# Small ES run for the tests, which has to be started by mpirun (see test_resuming.py):
+#   python run_es.py OUTPUT_DIRECTORY NUM_OF_ITERATIONS [--resume_with_pending_evaluation]
+# With --resume_with_pending_evaluation, the saved run state gets a model of its last iteration as not yet evaluated (with no best result yet) and the run is resumed from it
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from es_utilities import utils
+from es_utilities.wrappers import EsEnvironmentWrapper
+from wrapped_components.model_ff_mujoco_wrappers import get_new_wrapped_ff
+
+utils.NOISE_TABLE_LENGTH = int(1e6) # (the whole table is not needed by such a small model)
+
+from es import funcs
+from es.es import es
+from mpi4py import MPI
+
+
+STATE_DIMENSION, ACTION_DIMENSION = 5, 3
+
+
+class SmallEnvironment(EsEnvironmentWrapper):
+    def __init__(self):
+        super().__init__(None, 0)
+
+    def reset(self):
+        self.timestep = 0
+        self.state = self.generator.normal(size=STATE_DIMENSION)
+        return self.state.copy()
+
+    def step(self, action):
+        self.timestep += 1
+        self.state = np.tanh(self.state + 0.1 * np.resize(action, STATE_DIMENSION))
+        return self.state.copy(), float(np.sum(action)), False, self.timestep >= self.timestep_limit
+
+    def set_seed(self, seed):
+        self.generator = np.random.default_rng(seed)
+
+    @property
+    def state_shape(self):
+        return (STATE_DIMENSION,)
+
+    @property
+    def timestep_limit(self):
+        return 10
+
+
+if __name__ == "__main__":
+    output_directory, num_of_iterations = sys.argv[1], int(sys.argv[2])
+    resume_with_pending_evaluation = "--resume_with_pending_evaluation" in sys.argv[3:]
+
+    model = get_new_wrapped_ff(STATE_DIMENSION, ACTION_DIMENSION, 8, model_initialization_seed=0)
+    path_for_checkpoints = os.path.join(output_directory, "checkpoints", "model")
+
+    if resume_with_pending_evaluation and MPI.COMM_WORLD.Get_rank() == 0:
+        run_state_path = path_for_checkpoints + "_run_state.state"
+        run_state = funcs.load_run_state(run_state_path)
+        run_state["unevaluated_models"] = {run_state["iteration"] - 1: funcs.get_model_snapshot(model)}
+        run_state["best_return_yet"] = -float("inf") # (so that its result is the best yet)
+        funcs.save_run_state(run_state_path, run_state)
+    MPI.COMM_WORLD.Barrier()
+
+    es(
+        model,
+        SmallEnvironment(),
+        8,
+        num_of_iterations,
+        0,
+        0.02,
+        0.995,
+        None,
+        0.5,
+        path_for_checkpoints,
+        os.path.join(output_directory, "logs", "log"),
+        task_scheduling="dynamic",
+        dedicated_evaluation_rank=True,
+        resume=resume_with_pending_evaluation,
+        run_state_checkpoint_interval=1
+    )
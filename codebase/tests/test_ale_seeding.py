@@ -0,0 +1,29 @@
+import pytest
+import torch
+
+pytest.importorskip("ale_py")
+pytest.importorskip("cv2")
+
+from components.ale_atari_env.ale_env import ALEModern
+from wrapped_components.env_ale_atari_wrappers import ALEAtariWrapper, get_ale_atari_environment_pool
+
+
+def get_states_of_pool(seed, num_of_steps=200):
+    wrapped_environment = ALEAtariWrapper(ALEModern("Pong", 0, torch.device("cpu"), sdl=False), None)
+    pool = get_ale_atari_environment_pool(wrapped_environment, 2, seed=seed)
+
+    states = [pool.reset(range(2)).clone()]
+    for step in range(num_of_steps): # (the same actions in both of the copies, the sticky ones differing just by the seeds)
+        next_states, _, _, _ = pool.step(range(2), [step % len(wrapped_environment.env.actions)] * 2)
+        states.append(next_states.clone())
+
+    return torch.stack(states)
+
+
+def test_copies_with_different_seeds_diverge():
+    states = get_states_of_pool(seed=1)
+    assert not torch.equal(states[:, 0], states[:, 1])
+
+
+def test_copies_with_the_same_seed_match():
+    assert torch.equal(get_states_of_pool(seed=1), get_states_of_pool(seed=1))
@@ -0,0 +1,35 @@
+import torch
+
+from wrapped_components.model_dt_atari_wrappers import get_new_wrapped_dt
+
+
+STATE_SHAPE, CONTEXT_LENGTH = (1, 4, 84, 84), 3
+
+
+def get_model(compact_state_history):
+    return get_new_wrapped_dt(STATE_SHAPE, 1., False, 4, CONTEXT_LENGTH, 100, model_initialization_seed=0, optimizer_name=None, compact_state_history=compact_state_history)
+
+
+def get_states(num_of_steps):
+    # Overlapping stacks of the last frames (zeros before the first one), as produced by the ALEModern
+    frames = torch.cat((torch.zeros((3, 84, 84), dtype=torch.uint8), torch.randint(0, 256, (num_of_steps, 84, 84), dtype=torch.uint8, generator=torch.Generator().manual_seed(0))))
+    return [frames[step : step + 4].unsqueeze(0) for step in range(num_of_steps)]
+
+
+def test_compact_state_history_keeps_each_frame_once():
+    compact_model, model = get_model(compact_state_history=True), get_model(compact_state_history=False)
+    compact_model.reset_inner_state()
+    model.reset_inner_state()
+
+    states = get_states(2 * CONTEXT_LENGTH)
+    for step, state in enumerate(states):
+        compact_action = compact_model.choose_action(state)
+        action = model.choose_action(state)
+
+        expected_state_history = torch.stack(states[max(step - CONTEXT_LENGTH + 1, 0) : step + 1], dim=1)
+        assert torch.equal(compact_model.get_state_history(), expected_state_history)
+        assert compact_model.state_history_window.storage.numel() == 2 * (CONTEXT_LENGTH + 3) * 84 * 84
+        assert compact_action == action
+
+        compact_model.update_after_step(state, None, compact_action, 0., False, False)
+        model.update_after_step(state, None, action, 0., False, False)
@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+
+from wrapped_components.model_dt_mujoco_wrappers import get_new_wrapped_dt
+
+
+STATE_DIMENSION, ACTION_DIMENSION = 5, 3
+
+
+def get_model(train):
+    model = get_new_wrapped_dt(STATE_DIMENSION, ACTION_DIMENSION, 1., timestep_limit=50, context_length=4, embed_dim=16, n_layer=1, n_head=1, model_initialization_seed=0, optimizer_name=None)
+    model.train(train)
+    return model
+
+
+def get_states(num_of_episodes, num_of_steps):
+    return np.random.default_rng(0).normal(size=(num_of_steps, num_of_episodes, STATE_DIMENSION))
+
+
+def test_batched_actions_match_sequential_ones():
+    model = get_model(train=False)
+    num_of_episodes, num_of_steps = 3, 7 # (more steps than the context length)
+    states = get_states(num_of_episodes, num_of_steps)
+
+    sequential_actions = np.zeros((num_of_steps, num_of_episodes, ACTION_DIMENSION))
+    for episode in range(num_of_episodes):
+        model.reset_inner_state()
+        for step in range(num_of_steps):
+            action = model.choose_action(states[step, episode])
+            model.update_after_step(states[step, episode], None, action, 0.1 * step, False, False)
+            sequential_actions[step, episode] = action
+
+    indices = list(range(num_of_episodes))
+    model.reset_batched_inner_state(num_of_episodes)
+    for step in range(num_of_steps):
+        actions = model.choose_batched_actions(list(states[step]), None, indices)
+        model.update_after_batched_step(None, None, list(actions), [0.1 * step] * num_of_episodes, [False] * num_of_episodes, [False] * num_of_episodes, indices)
+        np.testing.assert_allclose(actions, sequential_actions[step], atol=1e-5)
+
+
+def test_batched_actions_with_dropout_in_train_mode():
+    model = get_model(train=True)
+    states = get_states(2, 2)
+    model.reset_batched_inner_state(2)
+    with torch.no_grad():
+        actions = model.choose_batched_actions(list(states[0]), None, [0, 1])
+
+    assert actions.shape == (2, ACTION_DIMENSION)
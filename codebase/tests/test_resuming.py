@@ -0,0 +1,33 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("mpi4py")
+
+if shutil.which("mpirun") is None:
+    pytest.skip("mpirun is not available", allow_module_level=True)
+
+if sys.version_info >= (3, 11):
+    pytest.skip("the seeds of the noises are numpy integers, which random.seed does not accept since Python 3.11", allow_module_level=True)
+
+
+NUM_OF_ITERATIONS = 2
+
+
+def run_es(output_directory, *arguments):
+    command = ["mpirun", "--allow-run-as-root", "--oversubscribe", "-n", "3", sys.executable, os.path.join(os.path.dirname(__file__), "run_es.py"), str(output_directory), str(NUM_OF_ITERATIONS), *arguments]
+    return subprocess.run(command, capture_output=True, text=True, timeout=600)
+
+
+def test_resuming_finished_run_with_pending_evaluation(tmp_path):
+    assert run_es(tmp_path).returncode == 0
+
+    # (no iteration is run after resuming, just the pending evaluation and the final one)
+    result = run_es(tmp_path, "--resume_with_pending_evaluation")
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    with open(tmp_path / "logs" / "log.evaluations") as log:
+        assert log.readlines()[-1].startswith(f"Iteration {NUM_OF_ITERATIONS - 1} - ")
@@ -20,7 +20,8 @@ def main(args):
         torch.device("cpu"),
         clip_rewards_val=False,
         sticky_action_p=0,
-        sdl=False
+        sdl=False,
+        preallocated_buffers=args.preallocated_env_buffers
     )
     test_environment = ALEAtariWrapper(env, main_seed)
     model = get_new_wrapped_dt_for_ale_environment(
@@ -31,7 +32,9 @@ def main(args):
         int(1e4),
         main_seed,
         args.optimizer,
-        args.learning_rate
+        args.learning_rate,
+        args.compact_state_history,
+        args.cache_state_embeddings
     )
     size_of_population = args.size_of_population
     num_of_iterations = args.num_of_iterations
@@ -56,7 +59,19 @@ def main(args):
         batch_size,
         update_vbn_stats_probability,
         path_for_checkpoints,
-        logging_path
+        logging_path,
+        noise_table_mode=args.noise_table_mode,
+        noise_table_path=args.noise_table_path,
+        noise_table_cache_directory=args.noise_table_cache_directory,
+        flat_parameters=args.flat_parameters,
+        sharded_update=args.sharded_update,
+        task_scheduling=args.task_scheduling,
+        dedicated_evaluation_rank=args.dedicated_evaluation_rank,
+        resume=args.resume,
+        run_state_checkpoint_interval=args.run_state_checkpoint_interval,
+        straggler_cutoff_fraction=args.straggler_cutoff_fraction,
+        log_phase_timings=args.log_phase_timings,
+        population_log_format=args.population_log_format
     )
 
 
@@ -69,13 +84,28 @@ if __name__ == "__main__":
     parser.add_argument("--seed", type=int, default=None, help="Main seed.")
     parser.add_argument("--noise_deviation", type=float, default=0.02, help="Deviation of the noise added during training.")
     parser.add_argument("--weight_decay_factor", type=float, default=0.995, help="Factor of the weight decay.")
-    parser.add_argument("--batch_size", type=int, default=100, help="A size of a batch for a batched weighted sum of noises during model update.")
+    parser.add_argument("--batch_size", type=int, default=None, help="Deprecated and ignored (a warning is issued, if it is set). (It was a size of a batch for a batched weighted sum of noises during model update, now the noises are accumulated one at a time.)")
     parser.add_argument("--update_vbn_stats_probability", type=float, default=0.01, help="How often to use data obtained during evaluation to update the Virtual Batch Norm stats.")
+    parser.add_argument("--noise_table_mode", type=str, default="broadcast", help="How the shared noise table is distributed among the processes. Either \"broadcast\" (created by the master and sent to every process), or \"file\" (generated into a file by the master and memory-mapped read-only by every process), or \"shared_memory\" (generated into an MPI shared-memory window on each node).")
+    parser.add_argument("--noise_table_path", type=str, default=None, help="Path of the noise table file for the \"file\" noise table mode. (It has to be accessible by all the processes. By default, it is stored next to the logs.)")
+    parser.add_argument("--noise_table_cache_directory", type=str, default=None, help="Directory in which the generated noise tables are cached (keyed by the seed and the deviation), so that the runs with the same seed and deviation generate the table only once. (The table is then generated in parallel, so it differs from the one generated without the cache.)")
+    parser.add_argument("--flat_parameters", action="store_true", help="Whether to keep all the trainable parameters in one flat vector, perturbing and updating it at once. (The noise for each individual is then one contiguous slice of the noise table, so the noises differ from those used without this option.)")
+    parser.add_argument("--sharded_update", action="store_true", help="Whether each process should compute the weighted sum of noises during model update just for its own slice of the population, the partial sums being then summed up across all the processes.")
+    parser.add_argument("--task_scheduling", type=str, default="executor", help="How the noise evaluation tasks are distributed among the workers. Either \"executor\" (mapped one by one through the MPICommExecutor), or \"static\" (each worker gets one contiguous chunk of the tasks), or \"dynamic\" (the workers keep asking for chunks of tasks, the size of which adapts to the observed episode lengths). With the latter two the results are gathered from the workers at once.")
+    parser.add_argument("--dedicated_evaluation_rank", action="store_true", help="Whether the evaluation (and saving of the best yet model) after each iteration should be done in the background by the last process (which then does not take part in the training), instead of by the master.")
+    parser.add_argument("--resume", action="store_true", help="Whether to resume the training from the last saved run state (stored next to the checkpoints), if there is any. The logs are then continued instead of being cleared.")
+    parser.add_argument("--run_state_checkpoint_interval", type=int, default=None, help="After how many iterations to save the whole run state (the model, the optimizer memory, the progress, etc.) for resuming. (By default, it is not saved at all, so set it for the run to be resumable by --resume.)")
+    parser.add_argument("--straggler_cutoff_fraction", type=float, default=None, help="If given, once this fraction of the population is evaluated, the remaining tasks are cancelled (both those not yet handed out and the rest of those being evaluated - the workers stop after the task they are evaluating) and the population is ranked just by the evaluated ones. (Only with the dynamic task scheduling. The numbers of evaluated and cancelled tasks are logged. When some tasks are cancelled, the maximal runtime of the evaluations is not lowered, as the evaluated tasks are the ones with the shortest episodes.)")
+    parser.add_argument("--log_phase_timings", action="store_true", help="Whether to log wall-clock durations of the individual phases of each iteration together with the statistics of the noise evaluations in the workers (environment steps, time spent in the environment and in the model) as JSON lines.")
+    parser.add_argument("--population_log_format", type=str, default="csv", help="Format of the logs of the fitnesses and runtimes of the whole population. Either \"csv\" (a text row per iteration), or \"npy\" (a binary row per iteration appended to an .npy file, which can be memory-mapped when loading).")
     parser.add_argument("--optimizer", type=str, default="SGDM", help="Optimizer to be used. Either \"ADAM\", or \"SGDM\" (standing for SGD with Momentum), or \"SGD\".")
     parser.add_argument("--learning_rate", type=float, default=5e-2, help="Learning rate (or can be called step size).")
     parser.add_argument("--load_model", type=str, default=None, help="Path from which to load the weights (and possibly vbn stats) into the model.")
     parser.add_argument("--context_length", type=int, default=30, help="Size of blocks (number of steps in the sequence passed to the transformer).")
     parser.add_argument("--game", type=str, default="Hero")
     parser.add_argument("--dont_sample_action", action="store_true")
+    parser.add_argument("--compact_state_history", action="store_true", help="Whether the model should keep the history of the states as raw uint8 frames, each of them just once (the overlapping stacks of the frames being strided views), normalizing them (by the VBN stats) only inside its state encoder.")
+    parser.add_argument("--cache_state_embeddings", action="store_true", help="Whether the model should be run incrementally, embedding just the new tokens (the current state, return-to-go and the last action) in each step and keeping the embeddings of the older ones instead of the states themselves.")
+    parser.add_argument("--preallocated_env_buffers", action="store_true", help="Whether the environment should step without allocating any new buffers, returning the observations as views into its preallocated frame stack.")
     
     main(parser.parse_args())
@@ -37,7 +37,21 @@ def main(args):
         batch_size,
         update_vbn_stats_probability,
         path_for_checkpoints,
-        logging_path
+        logging_path,
+        args.evaluation_batch_size,
+        args.noise_table_mode,
+        args.noise_table_path,
+        args.noise_table_cache_directory,
+        args.flat_parameters,
+        args.sharded_update,
+        args.task_scheduling,
+        args.dedicated_evaluation_rank,
+        args.resume,
+        args.run_state_checkpoint_interval,
+        args.straggler_cutoff_fraction,
+        args.log_phase_timings,
+        args.population_log_format,
+        args.pipelined_evaluation
     )
 
 
@@ -49,8 +63,22 @@ if __name__ == "__main__":
     parser.add_argument("--seed", type=int, default=None, help="Main seed.")
     parser.add_argument("--noise_deviation", type=float, default=0.02, help="Deviation of the noise added during training.")
     parser.add_argument("--weight_decay_factor", type=float, default=0.995, help="Factor of the weight decay.")
-    parser.add_argument("--batch_size", type=int, default=1000, help="A size of a batch for a batched weighted sum of noises during model update.")
+    parser.add_argument("--batch_size", type=int, default=None, help="Deprecated and ignored (a warning is issued, if it is set). (It was a size of a batch for a batched weighted sum of noises during model update, now the noises are accumulated one at a time.)")
     parser.add_argument("--update_vbn_stats_probability", type=float, default=0.01, help="How often to use data obtained during evaluation to update the Virtual Batch Norm stats.")
+    parser.add_argument("--evaluation_batch_size", type=int, default=1, help="Number of tasks (pairs of +noise and -noise) evaluated by a worker at once, with their episodes run in lockstep and with a single batched forward pass of the model per timestep.")
+    parser.add_argument("--noise_table_mode", type=str, default="broadcast", help="How the shared noise table is distributed among the processes. Either \"broadcast\" (created by the master and sent to every process), or \"file\" (generated into a file by the master and memory-mapped read-only by every process), or \"shared_memory\" (generated into an MPI shared-memory window on each node).")
+    parser.add_argument("--noise_table_path", type=str, default=None, help="Path of the noise table file for the \"file\" noise table mode. (It has to be accessible by all the processes. By default, it is stored next to the logs.)")
+    parser.add_argument("--noise_table_cache_directory", type=str, default=None, help="Directory in which the generated noise tables are cached (keyed by the seed and the deviation), so that the runs with the same seed and deviation generate the table only once. (The table is then generated in parallel, so it differs from the one generated without the cache.)")
+    parser.add_argument("--flat_parameters", action="store_true", help="Whether to keep all the trainable parameters in one flat vector, perturbing and updating it at once. (The noise for each individual is then one contiguous slice of the noise table, so the noises differ from those used without this option.)")
+    parser.add_argument("--sharded_update", action="store_true", help="Whether each process should compute the weighted sum of noises during model update just for its own slice of the population, the partial sums being then summed up across all the processes.")
+    parser.add_argument("--task_scheduling", type=str, default="executor", help="How the noise evaluation tasks are distributed among the workers. Either \"executor\" (mapped one by one through the MPICommExecutor), or \"static\" (each worker gets one contiguous chunk of the tasks), or \"dynamic\" (the workers keep asking for chunks of tasks, the size of which adapts to the observed episode lengths). With the latter two the results are gathered from the workers at once.")
+    parser.add_argument("--dedicated_evaluation_rank", action="store_true", help="Whether the evaluation (and saving of the best yet model) after each iteration should be done in the background by the last process (which then does not take part in the training), instead of by the master.")
+    parser.add_argument("--resume", action="store_true", help="Whether to resume the training from the last saved run state (stored next to the checkpoints), if there is any. The logs are then continued instead of being cleared.")
+    parser.add_argument("--run_state_checkpoint_interval", type=int, default=None, help="After how many iterations to save the whole run state (the model, the optimizer memory, the progress, etc.) for resuming. (By default, it is not saved at all, so set it for the run to be resumable by --resume.)")
+    parser.add_argument("--straggler_cutoff_fraction", type=float, default=None, help="If given, once this fraction of the population is evaluated, the remaining tasks are cancelled (both those not yet handed out and the rest of those being evaluated - the workers stop after the task they are evaluating) and the population is ranked just by the evaluated ones. (Only with the dynamic task scheduling. The numbers of evaluated and cancelled tasks are logged. When some tasks are cancelled, the maximal runtime of the evaluations is not lowered, as the evaluated tasks are the ones with the shortest episodes.)")
+    parser.add_argument("--log_phase_timings", action="store_true", help="Whether to log wall-clock durations of the individual phases of each iteration together with the statistics of the noise evaluations in the workers (environment steps, time spent in the environment and in the model) as JSON lines.")
+    parser.add_argument("--population_log_format", type=str, default="csv", help="Format of the logs of the fitnesses and runtimes of the whole population. Either \"csv\" (a text row per iteration), or \"npy\" (a binary row per iteration appended to an .npy file, which can be memory-mapped when loading).")
+    parser.add_argument("--pipelined_evaluation", action="store_true", help="Whether the copies of the environment for the batched evaluation should run in subprocesses (connected through shared memory), the batch being evaluated in two groups, so that the forward pass of the model for one of them overlaps the stepping of the environments of the other. (Only with evaluation batch size greater than 1. The subprocesses are started with the spawn start method, as forking after the initialization of MPI is unsafe.)")
     parser.add_argument("--optimizer", type=str, default="SGDM", help="Optimizer to be used. Either \"ADAM\", or \"SGDM\" (standing for SGD with Momentum), or \"SGD\".")
     parser.add_argument("--learning_rate", type=float, default=5e-2, help="Learning rate (or could be called step size).")
     
@@ -1,4 +1,9 @@
 from es_utilities.wrappers import EsEnvironmentWrapper
+from es_utilities.environment_batches import ThreadEnvironmentBatch
+
+import copy
+
+import torch
 
 
 class ALEAtariWrapper(EsEnvironmentWrapper):
@@ -15,7 +20,7 @@ class ALEAtariWrapper(EsEnvironmentWrapper):
     
     def set_seed(self, seed):
         if seed is not None:
-            self.env.ale.setInt("random_seed", seed)
+            self.env.set_seed(seed)
     
     @property
     def state_shape(self):
@@ -24,3 +29,46 @@ class ALEAtariWrapper(EsEnvironmentWrapper):
     @property
     def timestep_limit(self):
         return 108000
+
+
+class ALEAtariEnvironmentPool(ThreadEnvironmentBatch):
+    # Copies of the ALE Atari environment (each with its own ALEInterface, so with its own sticky actions and seed) stepped in parallel by threads
+    # (the ALE releases the GIL while emulating) - the states of all the reset or stepped environments are written by the threads right into one preallocated buffer
+    # and returned at once as a batched uint8 tensor of shape (len(indices),) + state_shape
+    def __init__(self, wrapped_environments, num_of_threads=None):
+        super().__init__(wrapped_environments, num_of_threads)
+        
+        self.states = torch.zeros((len(self),) + tuple(self.state_shape), dtype=torch.uint8)
+        
+    def _reset_environment(self, i):
+        self.states[i] = self.wrapped_environments[i].reset()
+        
+    def _step_environment(self, i, action):
+        next_state, reward, terminated, truncated = self.wrapped_environments[i].step(action)
+        self.states[i] = next_state
+        return reward, terminated, truncated
+        
+    def reset(self, indices):
+        indices = list(indices)
+        list(self.executor.map(self._reset_environment, indices))
+        return self.states[indices]
+    
+    def step(self, indices, actions):
+        indices = list(indices)
+        rewards, terminated, truncated = list(), list(), list()
+        for reward, current_terminated, current_truncated in self.executor.map(self._step_environment, indices, actions):
+            rewards.append(reward)
+            terminated.append(current_terminated)
+            truncated.append(current_truncated)
+            
+        return self.states[indices], rewards, terminated, truncated
+
+
+def get_ale_atari_environment_pool(wrapped_environment, num_of_environments, num_of_threads=None, seed=None):
+    # The i-th copy of the environment is seeded by seed+i (or keeps the seed of the original environment, if seed is None)
+    wrapped_environments = [copy.deepcopy(wrapped_environment) for _ in range(num_of_environments)]
+    if seed is not None:
+        for i, current_wrapped_environment in enumerate(wrapped_environments):
+            current_wrapped_environment.set_seed(seed + i)
+            
+    return ALEAtariEnvironmentPool(wrapped_environments, num_of_threads)
@@ -1,15 +1,21 @@
-from es_utilities.wrappers import EsModelWrapper
+from es_utilities.wrappers import EsModelWrapper, RingBuffer
 from es_utilities import optimizers
 
-from components.decision_transformer.atari.mingpt.utils import sample
+from components.decision_transformer.atari.mingpt.utils import sample, sample_incremental
 from components.decision_transformer.atari.mingpt.model_atari import GPT, GPTConfig
 
 import torch
 
 
 class DTAtari(EsModelWrapper):
-    def __init__(self, model, optimizer, state_shape, target_return, sample_action):
-        super().__init__(model, optimizer, state_shape, target_return, sample_action)
+    # With compact_state_history, the window keeps the raw uint8 frames (as produced by the ALEModern) instead of the normalized float32 ones
+    # and the VBN normalization is done inside the state encoder of the model (folded into its first conv). Each frame is then kept just once (the consecutive states
+    # of the ALEModern being overlapping stacks of its last frames), the stacks of the window being strided views into the frames (see get_state_history).
+    # With cache_state_embeddings, the model is run incrementally (see GPT.incremental_forward) - just the new tokens (among them the current state) are embedded in each step
+    # and the model keeps the embeddings of the older ones, so no window of the states is kept here
+    # (the parameters and the VBN stats do not change during an episode, so the embeddings of the older tokens stay valid).
+    def __init__(self, model, optimizer, state_shape, target_return, sample_action, compact_state_history=False, cache_state_embeddings=False):
+        super().__init__(model, optimizer, state_shape, target_return, sample_action, compact_state_history, cache_state_embeddings)
         
         assert isinstance(sample_action, bool)
         
@@ -23,60 +29,101 @@ class DTAtari(EsModelWrapper):
         self.action_shape = 1
         self.target_return = target_return
         
-        self.state_history_window = torch.zeros((1, 0,) + tuple(self.state_shape), dtype=torch.float32)
-        self.action_history_window = None
-        self.return_to_go_history_window = torch.zeros((1, 0, 1), dtype=torch.float32)
-        self.timesteps = torch.zeros((1, 0, 1), dtype=torch.long)
+        self.compact_state_history = compact_state_history
+        self.state_normalization = None # (mean, inv_std) tensors, taken from the VBN stats at the start of each episode
+        
+        self.cache_state_embeddings = cache_state_embeddings
+        
+        if cache_state_embeddings:
+            self.state_history_window = None
+        elif compact_state_history:
+            self.frames_per_state = self.state_shape[-3]
+            self.state_history_window = RingBuffer(self.context_length + self.frames_per_state - 1, tuple(self.state_shape[-2:]), torch.uint8)
+        else:
+            self.state_history_window = RingBuffer(self.context_length, self.state_shape, torch.uint8 if compact_state_history else torch.float32)
+        self.action_history_window = RingBuffer(self.context_length, (self.action_shape,), torch.long)
+        self.return_to_go_history_window = RingBuffer(self.context_length, (1,), torch.float32)
+        self.timesteps = torch.zeros((1, 1, 1), dtype=torch.long)
         
         self.sample_action = sample_action
     
     def choose_action(self, state):
-        # Add normalized current state
-        state = (state - self.vbn_stats.mean) / self.vbn_stats.std
-        state = state.reshape((1,1) + tuple(self.state_shape)).to(dtype=torch.float32)
-        self.state_history_window = torch.cat([self.state_history_window, state], dim=1)
+        # Add (normalized, unless the history is compact) current state
+        if not self.compact_state_history:
+            state = (state - self.vbn_stats.mean) / self.vbn_stats.std
+        state = state.reshape(tuple(self.state_shape))
         
-        if self.state_history_window.size(1) > self.context_length:
-            self.state_history_window = self.state_history_window[:,-self.context_length:,:]
+        if self.cache_state_embeddings:
+            # Just the last entries of the windows are passed in
+            action = sample_incremental(
+                self.model, state.reshape(-1, 4, 84, 84), self.return_to_go_history_window.last(1), self.timesteps,
+                previous_action=self.action_history_window.last(1) if len(self.action_history_window) > 0 else None,
+                sample=self.sample_action,
+                state_normalization=self.state_normalization
+            )
             
-        action = sample(
-            self.model, self.state_history_window, 1,
-            sample=self.sample_action,
-            actions=self.action_history_window,
-            rtgs=self.return_to_go_history_window,
-            timesteps=self.timesteps
-        )
+        else:
+            if not self.compact_state_history:
+                self.state_history_window.append(state)
+            else:
+                # Just the newest frame of the state is added (all of its frames at the start of the episode)
+                frames = state.reshape((-1,) + tuple(self.state_shape[-2:]))
+                for frame in (frames if len(self.state_history_window) == 0 else frames[-1:]):
+                    self.state_history_window.append(frame)
+            
+            # Windows are passed in as views into the ring buffers (with an added batch dimension)
+            action = sample(
+                self.model, self.get_state_history(), 1,
+                sample=self.sample_action,
+                actions=self.action_history_window.last().unsqueeze(0) if len(self.action_history_window) > 0 else None,
+                rtgs=self.return_to_go_history_window.last().unsqueeze(0),
+                timesteps=self.timesteps,
+                state_normalization=self.state_normalization
+            )
         action = action.cpu().numpy()[0,-1]
         
         return action
     
+    def get_state_history(self): # View of the states in the window with an added batch dimension, i.e. of shape (1, len(window)) + state_shape[-3:]
+        if not self.compact_state_history:
+            return self.state_history_window.last().unsqueeze(0)
+        
+        # (the i-th state is the stack of the frames from i to i + frames_per_state - 1, so the stacks just overlap in the memory of the frames)
+        frames = self.state_history_window.last()
+        num_of_states = len(frames) - self.frames_per_state + 1
+        frame_stride, row_stride, column_stride = frames.stride()
+        return frames.as_strided(
+            (1, num_of_states, self.frames_per_state) + tuple(frames.shape[1:]),
+            (num_of_states * frame_stride, frame_stride, frame_stride, row_stride, column_stride),
+            frames.storage_offset()
+        )
+    
     def update_after_step(self, state, next_state, action, reward, terminated, truncated):
         # Update action history window
-        action = torch.tensor(action, dtype=torch.long).reshape(1, 1, self.action_shape)
-        
-        if self.action_history_window is not None:
-            self.action_history_window = torch.cat([self.action_history_window, action], dim=1)
-        else:
-            self.action_history_window = action
-            
-        if self.action_history_window.size(1) > self.context_length:
-            self.action_history_window = self.action_history_window[:,-self.context_length:,:]
+        self.action_history_window.append(torch.tensor(action, dtype=torch.long).reshape(self.action_shape))
             
         # Update return-to-go history window
-        new_rtg = (self.return_to_go_history_window[0,-1,0] - reward).reshape(1, 1, 1).to(dtype=torch.float32)
-        self.return_to_go_history_window = torch.cat([self.return_to_go_history_window, new_rtg], dim=1)
-        
-        if self.return_to_go_history_window.size(1) > self.context_length:
-            self.return_to_go_history_window = self.return_to_go_history_window[:,-self.context_length:,:]
+        self.return_to_go_history_window.append(self.return_to_go_history_window.last(1)[0] - reward)
         
         # Update timesteps
         self.timesteps += 1
     
     def reset_inner_state(self):
-        self.state_history_window = torch.zeros((1, 0,) + tuple(self.state_shape), dtype=torch.float32)
-        self.action_history_window = None
-        self.return_to_go_history_window = torch.tensor(self.target_return, dtype=torch.float32).reshape(1, 1, 1)
+        if self.cache_state_embeddings:
+            self.model.reset_incremental_state()
+        else:
+            self.state_history_window.clear()
+        self.action_history_window.clear()
+        self.return_to_go_history_window.clear()
+        self.return_to_go_history_window.append(self.target_return)
         self.timesteps = torch.zeros((1, 1, 1), dtype=torch.long)
+        
+        # The VBN stats do not change during an episode
+        if self.compact_state_history:
+            self.state_normalization = (
+                torch.as_tensor(self.vbn_stats.mean, dtype=torch.float32).reshape(1, *self.state_shape[-3:]),
+                torch.as_tensor(1 / self.vbn_stats.std, dtype=torch.float32).reshape(1, *self.state_shape[-3:])
+            )
 
     def set_target_return(self, new_target_return):
         self.target_return = new_target_return
@@ -92,6 +139,8 @@ def get_new_wrapped_dt(
     model_initialization_seed=None,
     optimizer_name="ADAM",
     learning_rate=1e-2,
+    compact_state_history=False,
+    cache_state_embeddings=False,
     **kwargs
 ):
     if model_initialization_seed is not None:
@@ -110,7 +159,7 @@ def get_new_wrapped_dt(
     
     optimizer = optimizers.create_optimizer_to_model_from_string_name(model, optimizer_name, learning_rate, **kwargs)
     
-    return DTAtari(model, optimizer, state_shape, target_return, sample_action)
+    return DTAtari(model, optimizer, state_shape, target_return, sample_action, compact_state_history, cache_state_embeddings)
 
 
 def get_new_wrapped_dt_for_ale_environment(
@@ -122,6 +171,8 @@ def get_new_wrapped_dt_for_ale_environment(
     model_initialization_seed=None,
     optimizer_name="ADAM",
     learning_rate=1e-2,
+    compact_state_history=False,
+    cache_state_embeddings=False,
     **kwargs
 ):
     return get_new_wrapped_dt(
@@ -134,5 +185,7 @@ def get_new_wrapped_dt_for_ale_environment(
         model_initialization_seed,
         optimizer_name,
         learning_rate,
+        compact_state_history,
+        cache_state_embeddings,
         **kwargs
     )
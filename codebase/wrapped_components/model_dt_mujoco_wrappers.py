@@ -1,14 +1,15 @@
-from es_utilities.wrappers import EsModelWrapper
+from es_utilities.wrappers import EsModelWrapper, RingBuffer
 from es_utilities import optimizers
 
 from components.decision_transformer.gym.models.decision_transformer import DecisionTransformer
 
+import numpy as np
 import torch
 
 
 class DTMujoco(EsModelWrapper):
-    def __init__(self, model, optimizer, state_shape, action_shape, target_return):
-        super().__init__(model, optimizer, state_shape, action_shape, target_return)
+    def __init__(self, model, optimizer, state_shape, action_shape, target_return, use_kv_cache=False):
+        super().__init__(model, optimizer, state_shape, action_shape, target_return, use_kv_cache)
         
         state_dimension = state_shape[0]
         action_dimension = action_shape[0]
@@ -18,58 +19,156 @@ class DTMujoco(EsModelWrapper):
         self.state_dimension = state_dimension
         self.action_dimension = action_dimension
         self.target_return = target_return
+        self.use_kv_cache = use_kv_cache
         
-        self.state_history = torch.zeros((0, self.state_dimension), dtype=torch.float32)
-        self.action_history = torch.zeros((0, self.action_dimension), dtype=torch.float32)
-        self.return_to_go_history = torch.zeros((0,), dtype=torch.float32)
-        self.timesteps_history = torch.zeros((0,), dtype=torch.long)
+        # Only the last context-length steps are ever passed to the transformer, so that is all we keep in the histories
+        self.history_length = model.max_length if model.max_length is not None else model.embed_timestep.num_embeddings
+        
+        self.state_history = RingBuffer(self.history_length, (self.state_dimension,), torch.float32)
+        self.action_history = RingBuffer(self.history_length, (self.action_dimension,), torch.float32)
+        self.return_to_go_history = RingBuffer(self.history_length, (), torch.float32)
+        self.timesteps_history = RingBuffer(self.history_length, (), torch.long)
+        self.past_key_values = None
+        
+        self.batched_state_history = None
+        self.batched_action_history = None
+        self.batched_return_to_go_history = None
+        self.batched_timesteps_history = None
     
     def choose_action(self, state):
-        # Add normalized current state (We keep whole history - unlike in the Atari, here it does not slow down the program)
+        # Add normalized current state
         state = (state - self.vbn_stats.mean) / self.vbn_stats.std
-        current_state = torch.from_numpy(state).reshape(1, self.state_dimension).to(dtype=torch.float32)
-        self.state_history = torch.cat([self.state_history, current_state], dim=0)
+        self.state_history.append(torch.from_numpy(state).reshape(self.state_dimension))
 
         # Add action padding
-        self.action_history = torch.cat([self.action_history, torch.zeros((1, self.action_dimension), dtype=torch.float32)], dim=0)
+        self.action_history.append(0)
         
-        action = self.model.get_action(
-            self.state_history.to(dtype=torch.float32),
-            self.action_history.to(dtype=torch.float32),
-            None,
-            self.return_to_go_history.to(dtype=torch.float32),
-            self.timesteps_history.to(dtype=torch.long),
-        )
+        if self.use_kv_cache:
+            # Only the new tokens are run through the transformer, keys and values of the older ones are kept in the cache
+            if len(self.action_history) > 1:
+                previous_action, previous_timestep = self.action_history.last(2)[0], self.timesteps_history.last(2)[0]
+            else:
+                previous_action, previous_timestep = None, None
+                
+            action, self.past_key_values = self.model.get_action_with_cache(
+                self.state_history.last(1)[0],
+                self.return_to_go_history.last(1)[0],
+                self.timesteps_history.last(1)[0],
+                previous_action,
+                previous_timestep,
+                self.past_key_values
+            )
+            
+        else:
+            action = self.model.get_action(
+                self.state_history.last(),
+                self.action_history.last(),
+                None,
+                self.return_to_go_history.last(),
+                self.timesteps_history.last(),
+            )
         action = action.detach().cpu().numpy()
         
         return action
     
     def update_after_step(self, state, next_state, action, reward, terminated, truncated):
         # Update action history
-        self.action_history[-1] = torch.from_numpy(action).to(dtype=torch.float32)
+        self.action_history.set_last(torch.from_numpy(action))
         
         # Update return-to-go history
-        predicted_return = self.return_to_go_history[-1] - reward
-        self.return_to_go_history = torch.cat([self.return_to_go_history, predicted_return.reshape(1,).to(dtype=torch.float32)], dim=0)
+        self.return_to_go_history.append(self.return_to_go_history.last(1)[0] - reward)
         
         # Update timesteps history
-        self.timesteps_history = torch.cat(
-            [self.timesteps_history, torch.ones((1,), dtype=torch.long) * (self.timesteps_history[-1]+1)], dim=0
-        )
+        self.timesteps_history.append(self.timesteps_history.last(1)[0] + 1)
     
     def reset_inner_state(self):
-        self.state_history = torch.zeros((0, self.state_dimension), dtype=torch.float32)
-        self.action_history = torch.zeros((0, self.action_dimension), dtype=torch.float32)
-        self.return_to_go_history = torch.tensor([self.target_return], dtype=torch.float32)
-        self.timesteps_history = torch.zeros((1,), dtype=torch.long)
+        self.state_history.clear()
+        self.action_history.clear()
+        self.return_to_go_history.clear()
+        self.return_to_go_history.append(self.target_return)
+        self.timesteps_history.clear()
+        self.timesteps_history.append(0)
+        self.past_key_values = None
+
+    def choose_batched_actions(self, states, parameters, indices):
+        batch_size = self.batched_state_history.batch_size
+
+        # Add normalized current states (rows of the already finished episodes are just padded with zeros)
+        states = (np.stack(states) - self.vbn_stats.mean) / self.vbn_stats.std
+        current_states = torch.zeros((batch_size, self.state_dimension), dtype=torch.float32)
+        current_states[indices] = torch.from_numpy(states).to(dtype=torch.float32)
+        self.batched_state_history.append(current_states)
+
+        # Add action padding
+        self.batched_action_history.append(0)
+
+        # Take the context of the still running episodes and pad it to the context length (the same way as DecisionTransformer.get_action does)
+        max_length = self.history_length
+        states = self.batched_state_history.last()[indices]
+        actions = self.batched_action_history.last()[indices]
+        returns_to_go = self.batched_return_to_go_history.last()[indices].unsqueeze(-1)
+        timesteps = self.batched_timesteps_history.last()[indices]
+
+        num_of_episodes, sequence_length = states.size(0), states.size(1)
+        padding_length = max_length - sequence_length
+        attention_mask = torch.cat([torch.zeros((num_of_episodes, padding_length)), torch.ones((num_of_episodes, sequence_length))], dim=1).to(dtype=torch.long)
+        states = torch.cat([torch.zeros((num_of_episodes, padding_length, self.state_dimension)), states], dim=1)
+        actions = torch.cat([torch.zeros((num_of_episodes, padding_length, self.action_dimension)), actions], dim=1)
+        returns_to_go = torch.cat([torch.zeros((num_of_episodes, padding_length, 1)), returns_to_go], dim=1)
+        timesteps = torch.cat([torch.zeros((num_of_episodes, padding_length), dtype=torch.long), timesteps], dim=1)
+
+        # Each episode forms a batch of size 1 for its own set of parameters
+        _, action_preds, _ = self.batched_model_forward(
+            parameters,
+            states.unsqueeze(1),
+            actions.unsqueeze(1),
+            None,
+            returns_to_go.unsqueeze(1),
+            timesteps.unsqueeze(1),
+            attention_mask.unsqueeze(1)
+        )
+        actions = action_preds[:, 0, -1].detach().cpu().numpy()
+
+        return actions
+
+    def update_after_batched_step(self, states, next_states, actions, rewards, terminated, truncated, indices):
+        batch_size = self.batched_state_history.batch_size
+
+        # Update action history
+        self.batched_action_history.set_last(torch.from_numpy(np.stack(actions)).to(dtype=torch.float32), indices)
+
+        # Update return-to-go history
+        current_rewards = torch.zeros((batch_size,), dtype=torch.float32)
+        current_rewards[indices] = torch.tensor(rewards, dtype=torch.float32)
+        self.batched_return_to_go_history.append(self.batched_return_to_go_history.last(1)[:, 0] - current_rewards)
+
+        # Update timesteps history
+        self.batched_timesteps_history.append(self.batched_timesteps_history.last(1)[:, 0] + 1)
+
+    def reset_batched_inner_state(self, batch_size, target_returns=None): # Optionally, each of the episodes in the batch can be conditioned on its own target return
+        if self.use_kv_cache:
+            raise ValueError("The batched evaluation does not support the kv cache. (Use it only with the evaluation batch size 1 and without parallel episodes.)")
+        
+        if self.batched_state_history is None or self.batched_state_history.batch_size != batch_size:
+            self.batched_state_history = RingBuffer(self.history_length, (self.state_dimension,), torch.float32, batch_size)
+            self.batched_action_history = RingBuffer(self.history_length, (self.action_dimension,), torch.float32, batch_size)
+            self.batched_return_to_go_history = RingBuffer(self.history_length, (), torch.float32, batch_size)
+            self.batched_timesteps_history = RingBuffer(self.history_length, (), torch.long, batch_size)
+        
+        self.batched_state_history.clear()
+        self.batched_action_history.clear()
+        self.batched_return_to_go_history.clear()
+        self.batched_return_to_go_history.append(self.target_return if target_returns is None else torch.tensor(target_returns, dtype=torch.float32))
+        self.batched_timesteps_history.clear()
+        self.batched_timesteps_history.append(0)
 
     def set_target_return(self, new_target_return):
         self.target_return = new_target_return
 
 
 class DTMujocoFixedLN(DTMujoco):
-    def __init__(self, model, optimizer, state_shape, action_shape, target_return):
-        super().__init__(model, optimizer, state_shape, action_shape, target_return)
+    def __init__(self, model, optimizer, state_shape, action_shape, target_return, use_kv_cache=False):
+        super().__init__(model, optimizer, state_shape, action_shape, target_return, use_kv_cache)
         
     def named_parameters(self, prefix: str = '', recurse: bool = True, remove_duplicate: bool = True):
         for name, param in super().named_parameters(prefix, recurse, remove_duplicate):
@@ -93,6 +192,7 @@ def get_new_wrapped_dt(
     model_initialization_seed=None,
     optimizer_name="ADAM",
     learning_rate=1e-2,
+    use_kv_cache=False,
     **kwargs
 ):
     if model_initialization_seed is not None:
@@ -116,10 +216,10 @@ def get_new_wrapped_dt(
     optimizer = optimizers.create_optimizer_to_model_from_string_name(model, optimizer_name, learning_rate, **kwargs)
     
     if not fixed_layer_norm:
-        return DTMujoco(model, optimizer, (state_dimension,), (action_dimension,), target_return)
+        return DTMujoco(model, optimizer, (state_dimension,), (action_dimension,), target_return, use_kv_cache)
     
     else:
-        return DTMujocoFixedLN(model, optimizer, (state_dimension,), (action_dimension,), target_return)
+        return DTMujocoFixedLN(model, optimizer, (state_dimension,), (action_dimension,), target_return, use_kv_cache)
 
 
 def get_new_wrapped_dt_humanoid(
@@ -135,6 +235,7 @@ def get_new_wrapped_dt_humanoid(
     model_initialization_seed=None,
     optimizer_name="ADAM",
     learning_rate=1e-2,
+    use_kv_cache=False,
     **kwargs
 ):
     return get_new_wrapped_dt(
@@ -152,5 +253,6 @@ def get_new_wrapped_dt_humanoid(
         model_initialization_seed,
         optimizer_name,
         learning_rate,
+        use_kv_cache,
         **kwargs
     )
@@ -19,7 +19,18 @@ class FFMujoco(EsModelWrapper):
     
     def reset_inner_state(self):
         pass
-    
+
+    def choose_batched_actions(self, states, parameters, indices):
+        normalized_states = (np.stack(states) - self.vbn_stats.mean) / self.vbn_stats.std
+        actions = self.batched_model_forward(parameters, torch.from_numpy(normalized_states)).numpy()
+        return actions
+
+    def update_after_batched_step(self, states, next_states, actions, rewards, terminated, truncated, indices):
+        pass
+
+    def reset_batched_inner_state(self, batch_size):
+        pass
+
     
 class FFModel(torch.nn.Module):
     def __init__(self, input_dim, output_dim, inner_dim, model_initialization_seed=None):